@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Starts a local [cluster] of three qapiproxy nodes (insecure mode, lazy workers, so no broker is needed) on
+different ports and checks by epId that every node forwards to the owner on the ring, that the owner refuses a hop
+it does not own, and that event streams and mode = redirect nodes answer 307 to the owner.
+
+Usage: PYTHONPATH=src python3 bench/cluster_local.py [first port]
+"""
+
+from sys import argv, executable, exit as sys_exit
+from os import environ, path
+from tempfile import TemporaryDirectory
+from subprocess import Popen, DEVNULL
+from socket import create_connection
+from http.client import HTTPConnection
+from time import monotonic, sleep
+
+from qapiproxy.Cluster import HashRing, HOP_HEADER
+
+AGENTS = 12
+# The last node redirects instead of forwarding
+MODES = ('forward', 'forward', 'redirect')
+START_TIMEOUT = 30
+
+CONFIG = """[config]
+mode = ini
+agents = {agents}
+
+[qapimanager]
+new_worker = 5
+keep_feeddata = 50
+keep_controlreq = 50
+keep_unsolicited = 50
+lazy_workers = true
+
+[https]
+host = localhost
+port = {port}
+ssl_ca =
+ssl_crt =
+ssl_key =
+ssl_pass =
+insecure_mode = True
+
+[cluster]
+nodes = {nodes}
+self = {node}
+mode = {mode}
+timeout = 5
+"""
+
+AGENT = """
+[agent{num}]
+name = agent{num}
+host = localhost:5671
+epid = EP{num}
+passwd = pass
+token = token{num}
+authtokens = auth{num}
+"""
+
+
+def write_config(tmp, port, nodes, node, mode):
+    fname = path.join(tmp, 'node%d.ini' % port)
+    with open(fname, 'w') as f:
+        f.write(CONFIG.format(agents='\n    '.join('agent%d' % num for num in range(AGENTS)), port=port,
+                              nodes='\n    '.join(nodes), node=node, mode=mode))
+        for num in range(AGENTS):
+            f.write(AGENT.format(num=num))
+    return fname
+
+
+def wait_listening(proc, port):
+    end = monotonic() + START_TIMEOUT
+    while True:
+        try:
+            create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError('node on port %d exited with %d' % (port, proc.returncode))
+            if monotonic() > end:
+                raise
+            sleep(0.2)
+
+
+def request(port, url, epid, auth, headers=None):
+    conn = HTTPConnection('localhost', port, timeout=15)
+    try:
+        all_headers = {'epId': epid, 'authToken': auth}
+        all_headers.update(headers or {})
+        conn.request('GET', url, headers=all_headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status, resp.getheader('Location')
+    finally:
+        conn.close()
+
+
+def check(ports, nodes):
+    """List of failures"""
+    ring = HashRing(nodes)
+    failures = []
+
+    def expect(what, got, wanted):
+        if got != wanted:
+            failures.append('%s: got %r, expected %r' % (what, got, wanted))
+
+    for num in range(AGENTS):
+        epid = 'EP%d' % num
+        owner = ring.owner(epid)
+        for port, node, mode in zip(ports, nodes, MODES):
+            what = '%s via %s (owner %s)' % (epid, node, owner)
+            if node == owner:
+                # Answered here (the wrong authToken is refused by the owner only)
+                expect(what, request(port, '/entity', epid, 'bad'), (403, None))
+                expect(what + ' hop', request(port, '/entity', epid, 'bad', {HOP_HEADER: '1'}), (403, None))
+            elif mode == 'redirect':
+                expect(what, request(port, '/entity', epid, 'bad'), (307, owner + '/entity'))
+            else:
+                # Forwarded to the owner, which refuses the wrong authToken
+                expect(what, request(port, '/entity', epid, 'bad'), (403, None))
+                # Not ours: a forwarded request is never forwarded again
+                expect(what + ' hop', request(port, '/entity', epid, 'bad', {HOP_HEADER: '1'}), (503, None))
+                expect(what + ' stream', request(port, '/stream', epid, 'bad'), (307, owner + '/stream'))
+    return failures
+
+
+def main():
+    first = int(argv[1]) if len(argv) > 1 else 18118
+    ports = [first + offset for offset in range(len(MODES))]
+    nodes = ['http://localhost:%d' % port for port in ports]
+    env = dict(environ, IOTIC_BACKGROUND='1')
+    procs = []
+    with TemporaryDirectory() as tmp:
+        try:
+            for port, node, mode in zip(ports, nodes, MODES):
+                fname = write_config(tmp, port, nodes, node, mode)
+                procs.append(Popen([executable, '-m', 'qapiproxy', fname], env=env, stdin=DEVNULL, stderr=DEVNULL))
+            for proc, port in zip(procs, ports):
+                wait_listening(proc, port)
+            failures = check(ports, nodes)
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+    for failure in failures:
+        print(failure)
+    print('%s: %d agents on %d nodes' % ('FAILED' if failures else 'OK', AGENTS, len(nodes)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys_exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmark of the qapiproxy body codecs on /feeddata and /search shaped payloads.  Binary codecs (UBJSON,
+MessagePack) encode share data as raw bytes instead of base64 strings, as the proxy does.
+
+Usage: PYTHONPATH=src python3 bench/codec_bench.py [repeat]
+"""
+
+from sys import argv
+from base64 import b64encode, b64decode
+from binascii import hexlify
+from random import Random
+from timeit import repeat as timeit_repeat
+
+from qapiproxy.Codec import available_json_codecs, get_json_codec, get_binary_codecs
+
+
+def randbytes(rnd, count):
+    return bytes(rnd.getrandbits(8) for _ in range(count))
+
+
+def guid(rnd):
+    return hexlify(randbytes(rnd, 16)).decode('ascii')
+
+
+def feeddata(rnd, rows=50):
+    """As returned by GET /feeddata with keep_feeddata = 50: mix of decoded dicts and base64 binary"""
+    ret = []
+    for num in range(rows):
+        if num % 3:
+            data = {'temperature': rnd.uniform(-10, 40), 'humidity': rnd.uniform(0, 100),
+                    'battery': rnd.randint(0, 100), 'status': 'ok', 'history': [rnd.random() for _ in range(8)]}
+            mime = None
+        else:
+            data = 'base64/' + b64encode(randbytes(rnd, 96)).decode('ascii')
+            mime = 'application/octet-stream'
+        ret.append({'pid': guid(rnd), 'data': data, 'mime': mime, 'time': '2016-06-01T12:%02d:00.000000Z' % num})
+    return ret
+
+
+def search(rnd, things=100):
+    """As returned by POST /search (type full): things with labels, location and points"""
+    result = {}
+    for _ in range(things):
+        points = {}
+        for _ in range(rnd.randint(1, 5)):
+            points[guid(rnd)] = {'label': {'en': 'Point label %d' % rnd.randint(0, 1000)},
+                                 'type': 'Feed', 'values': {'value': {'type': 'float', 'unit': None}}}
+        result[guid(rnd)] = {'label': {'en': 'Thing label', 'fr': u'Étiquette'},
+                             'long': rnd.uniform(-180, 180), 'lat': rnd.uniform(-90, 90),
+                             'points': points}
+    return {'p': {'result': result}, 't': 'complete'}
+
+
+def unbase64(rows):
+    ret = []
+    for row in rows:
+        row = dict(row)
+        if isinstance(row['data'], str) and row['data'].startswith('base64/'):
+            row['data'] = b64decode(row['data'][7:])
+        ret.append(row)
+    return ret
+
+
+def codecs():
+    ret = [get_json_codec(name) for name in available_json_codecs()]
+    for codec in get_binary_codecs().values():
+        if codec not in ret:
+            ret.append(codec)
+    return ret
+
+
+def bench(codec, payload, number, repeats):
+    encoded = codec.dumpb(payload)
+    enc = min(timeit_repeat(lambda: codec.dumpb(payload), number=number, repeat=repeats)) / number
+    dec = min(timeit_repeat(lambda: codec.loadb(encoded), number=number, repeat=repeats)) / number
+    return len(encoded), enc * 1e6, dec * 1e6
+
+
+def main():
+    number = int(argv[1]) if len(argv) > 1 else 200
+    rnd = Random(42)
+    payloads = (('feeddata', feeddata(rnd)), ('search', search(rnd)))
+    print('%-10s %-8s %10s %12s %12s' % ('payload', 'codec', 'bytes', 'encode us', 'decode us'))
+    for pname, payload in payloads:
+        for codec in codecs():
+            if codec.binary and pname == 'feeddata':
+                size, enc, dec = bench(codec, unbase64(payload), number, 5)
+            else:
+                size, enc, dec = bench(codec, payload, number, 5)
+            print('%-10s %-8s %10d %12.1f %12.1f' % (pname, codec.name, size, enc, dec))
+
+
+if __name__ == '__main__':
+    main()
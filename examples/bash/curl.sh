@@ -125,6 +125,10 @@ echo -e "\n\n# === proxy - point share [${LIDA} atad 'databytes']"
 ${PROXY_CALL} -X POST "${C_TYPE[@]}" -H "epId: ${EPID}" -H "authToken: ${AUTH}" --data-binary '{"data":"databytes"}' ${PROXY_URL}/point/${LIDA}/atad/share
 ${WAIT}
 
+echo -e "\n\n# === proxy - point share raw [${LIDA} atad 'databytes']"
+${PROXY_CALL} -X POST -H "Content-Type: application/octet-stream" -H "epId: ${EPID}" -H "authToken: ${AUTH}" --data-binary 'databytes' ${PROXY_URL}/point/${LIDA}/atad/share/raw
+${WAIT}
+
 # todo: /sub/subid/ask or /tell {'data': xx, 'mime': yy}
 
 echo -e "\n\n# === proxy - search [energenie]"
@@ -0,0 +1,313 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""asyncio HTTP front end for RESTServer.Handler.
+
+Connections (and their keep-alive idle time) live on a single event loop instead of one thread each.  Each request is
+parsed by the loop, dispatched by the unmodified Handler routes on a small executor and the resulting IoticAgent
+request event is awaited on the loop, so no thread is held while the QAPI call is in flight (the response is then
+built on the executor too).  Long-polls (e.g. GET /feeddata?wait=10), event streams (GET /stream) and WebSocket
+(GET /ws) downstream messages wait on a separate executor so they don't hold up routing.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from re import compile as re_compile, A as re_A, I as re_I, M as re_M
+from threading import Event, Lock
+
+from .RESTServer import HTTPServerBase
+
+
+MAX_HEADER = 65536      # Largest request line + headers block accepted
+
+
+class AsyncHandler(object):
+    """Mixin for RESTServer.Handler: handle one already-read request from memory and defer the wait on the QAPI
+    request event to the event loop.
+    """
+
+    def __init__(self, raw, client_address, server):  # pylint: disable=super-init-not-called
+        # BaseRequestHandler.__init__ would handle the request on a socket right away
+        self.request = None
+        self.client_address = client_address
+        self.server = server
+        self.rfile = BytesIO(raw)
+        self.wfile = BytesIO()
+        self.pending = None
+        self.polling = None
+        self.streaming = None
+        self.websocket = None
+
+    def setup(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def _qapi_wait(self, evt):
+        self.pending = evt
+
+    def _poll_wait(self, poll):
+        self.polling = poll
+
+    def _stream(self, chunks):
+        self.streaming = chunks
+
+    def _websocket(self, ws, pump, idle):
+        self.websocket = (ws, pump, idle)
+
+    def _ws_result(self, evt, done):
+        self.server.ws_result(evt, self.timeout, done)
+
+    def _acquire_poll(self):
+        return self.server.acquire_poll()
+
+    def complete(self):
+        """Build the response for the pending request event (set or timed out)"""
+        evt, self.pending = self.pending, None
+        try:
+            self._qapi_resp(evt)
+        finally:
+            self._end_call()
+
+    def response(self):
+        ret = self.wfile.getvalue()
+        self.wfile = BytesIO()
+        return ret
+
+
+class AsyncHTTPServer(HTTPServerBase):
+    """socketserver-like server (serve_forever / shutdown / server_close) running an asyncio event loop"""
+
+    request_queue_size = 128
+
+    __contentLengthPattern = re_compile(br'^content-length:[ \t]*([0-9]+)[ \t]*\r?$', re_I | re_A | re_M)
+
+    def __init__(self, server_address, RequestHandlerClass, ssl_context=None, keepalive=60, dispatch_threads=16,
+                 poll_threads=64, reuse_port=False):
+        super().__init__(server_address, type('Async' + RequestHandlerClass.__name__,
+                                              (AsyncHandler, RequestHandlerClass), {}),
+                         reuse_port=reuse_port)
+        self.__ssl_context = ssl_context
+        self.__keepalive = keepalive
+        self.__executor = ThreadPoolExecutor(max_workers=dispatch_threads)
+        self.__poll_executor = ThreadPoolExecutor(max_workers=poll_threads)
+        # Long-polls, streams & WebSocket pumps each hold a poll executor thread, more are refused (not queued)
+        self.__poll_threads = poll_threads
+        self.__polls = 0
+        self.__polls_lock = Lock()
+        self.__tasks = set()
+        self.__loop = None
+        self.__server = None
+        self.__is_shut_down = Event()
+        self.__is_shut_down.set()
+
+    def serve_forever(self, poll_interval=None):  # pylint: disable=unused-argument
+        self.__is_shut_down.clear()
+        loop = self.__loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = self.__server = loop.run_until_complete(asyncio.start_server(
+                self.__client, sock=self.socket, ssl=self.__ssl_context, limit=MAX_HEADER))
+            loop.run_forever()
+            server.close()
+            tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(server.wait_closed())
+        finally:
+            loop.close()
+            self.__loop = None
+            self.__is_shut_down.set()
+
+    def stop_accepting(self):
+        # Open connections (and QAPI calls in flight) carry on until shutdown
+        loop = self.__loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.__server.close)
+
+    def shutdown(self):
+        loop = self.__loop
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+        self.__is_shut_down.wait()
+
+    def server_close(self):
+        super().server_close()
+        self.__executor.shutdown(wait=False)
+        self.__poll_executor.shutdown(wait=False)
+
+    def acquire_poll(self):
+        """Counts a long-poll, stream or WebSocket about to start, returns False if all poll threads are taken"""
+        with self.__polls_lock:
+            if self.__polls >= self.__poll_threads:
+                return False
+            self.__polls += 1
+            return True
+
+    def __release_poll(self, *_):
+        with self.__polls_lock:
+            self.__polls -= 1
+
+    def ws_result(self, evt, timeout, done):
+        """Calls done on the executor once evt is set or after timeout, callable from any thread"""
+        loop = self.__loop
+        if loop is None:
+            done()
+            return
+        loop.call_soon_threadsafe(self.__track, self.__ws_result(evt, timeout, done))
+
+    def __track(self, coro):
+        # The loop only keeps weak references to tasks
+        task = self.__loop.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __ws_result(self, evt, timeout, done):
+        try:
+            await self.__await_event(evt, timeout)
+        except asyncio.CancelledError:
+            # Server shut down, the message's call is no longer in flight
+            done()
+            raise
+        await self.__loop.run_in_executor(self.__executor, done)
+
+    async def __read_request(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.__keepalive)
+        match = self.__contentLengthPattern.search(head)
+        if match is None or int(match.group(1)) == 0:
+            return head
+        length = int(match.group(1))
+        if length > self.RequestHandlerClass.getMaxBody():
+            # Handler answers 413 without reading the body and closes the connection
+            return head
+        return head + await asyncio.wait_for(reader.readexactly(length), self.RequestHandlerClass.timeout)
+
+    async def __await_event(self, evt, timeout):
+        run_on_completion = getattr(evt, '_run_on_completion', None)
+        if run_on_completion is None:
+            await self.__loop.run_in_executor(self.__executor, evt.wait, timeout)
+            return
+        done = self.__loop.create_future()
+
+        def set_done(_evt):
+            if not done.done():
+                done.set_result(None)
+
+        run_on_completion(lambda evt: self.__loop.call_soon_threadsafe(set_done, evt))
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __stream(self, chunks, writer):
+        """Writes chunks (from a blocking generator, run on the poll executor) as they are produced"""
+        try:
+            while True:
+                chunk = await self.__loop.run_in_executor(self.__poll_executor, next, chunks, None)
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                pass  # still running on the executor (cancelled), closed once collected
+
+    async def __websocket(self, reader, writer, ws, pump, idle):
+        """Carries ws (handshake answered) until closed, messages are handled on the executor (their results awaited on
+        the loop, see ws_result) & pump runs on the poll executor"""
+        loop = self.__loop
+
+        def write(data):
+            if not writer.is_closing():
+                writer.write(data)
+
+        ws.write = lambda data: loop.call_soon_threadsafe(write, data)
+        loop.run_in_executor(self.__poll_executor, pump).add_done_callback(self.__release_poll)
+        try:
+            while not ws.closed:
+                data = await asyncio.wait_for(reader.read(65536), idle)
+                if not data:
+                    break
+                await loop.run_in_executor(self.__executor, ws.receive, data)
+                await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            ws.closed = True
+        # Let frames queued by ws.receive (e.g. the close reply) out before the connection is closed
+        await asyncio.sleep(0)
+
+    async def __polled(self, handler, reader, writer):
+        """Answers a long-poll, or carries an event stream or WebSocket, releasing its poll thread once done"""
+        release = True
+        try:
+            if handler.polling is not None:
+                await self.__loop.run_in_executor(self.__poll_executor, handler.polling)
+            writer.write(handler.response())
+            await writer.drain()
+            if handler.streaming is not None:
+                await self.__stream(handler.streaming, writer)
+            elif handler.websocket is not None:
+                # Released once the pump ends
+                release = False
+                await self.__websocket(reader, writer, *handler.websocket)
+        finally:
+            if release:
+                self.__release_poll()
+
+    async def __client(self, reader, writer):
+        loop = self.__loop
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    raw = await self.__read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+                handler = self.RequestHandlerClass(raw, client_address, self)
+                # Routing may take the workers lock, keep it off the event loop
+                await loop.run_in_executor(self.__executor, handler.handle_one_request)
+                if handler.pending is not None:
+                    await self.__await_event(handler.pending, handler.timeout)
+                    # Encoding (& compressing) the result is CPU-bound, keep it off the event loop
+                    await loop.run_in_executor(self.__executor, handler.complete)
+                    writer.write(handler.response())
+                    await writer.drain()
+                elif handler.polling is not None or handler.streaming is not None or handler.websocket is not None:
+                    # Poll thread counted by acquire_poll
+                    await self.__polled(handler, reader, writer)
+                    if handler.polling is None:
+                        break
+                else:
+                    writer.write(handler.response())
+                    await writer.drain()
+                if handler.close_connection:
+                    break
+        except ConnectionError:
+            logger.debug("Client %s closed connection", client_address)
+        except asyncio.CancelledError:
+            # Server shut down (an uncaught cancellation would be logged as an error by asyncio streams)
+            pass
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Unhandled error serving %s", client_address)
+        finally:
+            writer.close()
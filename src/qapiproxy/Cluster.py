@@ -0,0 +1,171 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cluster mode ([cluster] nodes): several proxy nodes share the configured agents, each running the workers of the
+epIds it owns on a consistent hash ring.  Requests for an epId owned by another node are forwarded to that node, or
+the client is redirected there ([cluster] mode).
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from bisect import bisect
+from hashlib import md5
+from threading import Lock
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlsplit
+from ssl import create_default_context
+
+
+VNODES = 64             # Points on the ring per node, more spread the epIds more evenly
+FORWARD_TIMEOUT = 15    # How long (seconds) to wait for the owning node to answer a forwarded request
+HOP_HEADER = 'X-Iotic-Forwarded'    # Set on forwarded requests, which are never forwarded again
+
+# Not passed on in either direction (the connection to the other node is a different one)
+_HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                         'transfer-encoding', 'upgrade', 'host', 'content-length', 'date', 'server'))
+
+
+def _hash(key):
+    return int.from_bytes(md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hash ring: each node has vnodes points on it and a key belongs to the node of the first point at or
+    after the key's hash, so adding or removing a node only moves the keys of that node's points"""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        points = sorted((_hash('%s#%d' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self.__hashes = [point for point, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def owner(self, key):
+        return self.__nodes[bisect(self.__hashes, _hash(key)) % len(self.__nodes)]
+
+
+class Cluster(object):
+    """This node (node, one of nodes) of a cluster of proxies.  Nodes are base URLs (e.g. https://proxy1:8118), for
+    https ones the client certificate & CA of ssl_context are used to forward requests."""
+
+    def __init__(self, nodes, node, redirect=False, vnodes=VNODES, ssl_context=None, timeout=FORWARD_TIMEOUT):
+        nodes = [_node(url) for url in nodes]
+        self.__node = _node(node)
+        if self.__node not in nodes:
+            raise ValueError("[cluster] self (%s) must be one of nodes" % node)
+        self.__ring = HashRing(nodes, vnodes=vnodes)
+        self.__redirect = redirect
+        self.__ssl_context = ssl_context
+        self.__timeout = timeout
+        # node -> idle connections
+        self.__pool = {}
+        self.__pool_lock = Lock()
+
+    @property
+    def node(self):
+        return self.__node
+
+    @property
+    def redirect(self):
+        """Redirect clients (307) to the owning node rather than forwarding their requests?"""
+        return self.__redirect
+
+    def owner(self, epid):
+        return self.__ring.owner(epid)
+
+    def owns(self, epid):
+        return self.__ring.owner(epid) == self.__node
+
+    def forward(self, node, method, path, headers, body=None, wait=0):
+        """Sends request to node, returns (status, [(header, value)], body).  headers: (header, value) pairs of the
+        original request, hop-by-hop ones are dropped.  wait: seconds node may wait before answering (long-poll), on
+        top of the timeout.
+
+        Raises: OSError or http.client.HTTPException if node could not be reached or did not answer
+        """
+        headers = {name: value for name, value in headers if name.lower() not in _HOP_BY_HOP}
+        headers[HOP_HEADER] = self.__node
+        for retry in (False, True):
+            conn, pooled = self.__connection(node, fresh=retry)
+            conn.timeout = self.__timeout + wait
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Pooled connection closed by the other node (keep-alive timeout) before it read the request
+                if pooled and not retry:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                with self.__pool_lock:
+                    self.__pool.setdefault(node, []).append(conn)
+            return resp.status, [(name, value) for name, value in resp.getheaders()
+                                 if name.lower() not in _HOP_BY_HOP], data
+
+    def __connection(self, node, fresh=False):
+        """Returns (connection, whether it was pooled)"""
+        if not fresh:
+            with self.__pool_lock:
+                idle = self.__pool.get(node)
+                if idle:
+                    return idle.pop(), True
+        url = urlsplit(node)
+        if url.scheme == 'https':
+            return HTTPSConnection(url.hostname, url.port or 443, timeout=self.__timeout,
+                                   context=self.__ssl_context), False
+        return HTTPConnection(url.hostname, url.port or 80, timeout=self.__timeout), False
+
+    def close(self):
+        with self.__pool_lock:
+            pool, self.__pool = self.__pool, {}
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+
+
+def _node(url):
+    return url.strip().rstrip('/')
+
+
+def getCluster(config):
+    """Cluster from the [cluster] config section, None if there is none (or it lists no nodes)"""
+    try:
+        options = config['cluster']
+    except KeyError:
+        return None
+    nodes = [url for url in options.get('nodes', '').strip().split('\n') if url.strip()]
+    if not nodes:
+        return None
+    mode = options.get('mode', 'forward').strip().lower()
+    if mode not in ('forward', 'redirect'):
+        raise ValueError("[cluster] mode must be 'forward' or 'redirect'")
+    ssl_context = None
+    if any(urlsplit(_node(url)).scheme == 'https' for url in nodes):
+        ssl_context = create_default_context(cafile=config['https']['ssl_ca'])
+        ssl_context.load_cert_chain(config['https']['ssl_crt'], config['https']['ssl_key'],
+                                    password=config['https'].get('ssl_pass'))
+    return Cluster(nodes, options['self'],
+                   redirect=mode == 'redirect',
+                   vnodes=int(options.get('vnodes', VNODES)),
+                   ssl_context=ssl_context,
+                   timeout=float(options.get('timeout', FORWARD_TIMEOUT)))
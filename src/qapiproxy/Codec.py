@@ -0,0 +1,133 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Codecs for request/response bodies.
+
+JSON: orjson or ujson are used when installed, else the stdlib json module.  Binary: UBJSON and (if installed)
+MessagePack, which carry bytes natively so share data need not be base64 encoded.  All encode straight to bytes and
+decode from bytes.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from json import JSONEncoder, loads as json_loads
+
+orjson = None
+try:
+    import orjson
+except ImportError:
+    pass
+
+ujson = None
+try:
+    import ujson
+except ImportError:
+    pass
+
+msgpack = None
+try:
+    import msgpack
+except ImportError:
+    pass
+
+from ubjson import dumpb as ubjdumpb, loadb as ubjloadb
+
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
+
+class BodyCodec(object):
+    """binary: bytes can be encoded as-is (else they have to be base64 encoded first)"""
+
+    def __init__(self, name, content_type, dumpb, loadb, binary=False):
+        self.name = name
+        self.content_type = content_type
+        self.dumpb = dumpb
+        self.loadb = loadb
+        self.binary = binary
+
+
+def __stdlib():
+    encode = JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+    def dumpb(obj):
+        return encode(obj).encode('utf-8')
+
+    return BodyCodec('json', JSON_CONTENT_TYPE, dumpb, json_loads)
+
+
+def __orjson(fallback):
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj):
+        try:
+            return orjson.dumps(obj, option=options)
+        except TypeError:
+            # e.g. integers > 64 bits
+            return fallback(obj)
+
+    return BodyCodec('orjson', JSON_CONTENT_TYPE, dumpb, orjson.loads)
+
+
+def __ujson(fallback):
+    def dumpb(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError):
+            return fallback(obj)
+
+    return BodyCodec('ujson', JSON_CONTENT_TYPE, dumpb, ujson.loads)
+
+
+def available_json_codecs():
+    """Names of the usable JSON codecs, fastest first"""
+    ret = []
+    if orjson is not None:
+        ret.append('orjson')
+    if ujson is not None:
+        ret.append('ujson')
+    ret.append('json')
+    return ret
+
+
+def get_json_codec(name='auto'):
+    """Returns BodyCodec by name (orjson, ujson, json) or the fastest available for auto.
+
+    Raises: ValueError if the named codec is not available
+    """
+    name = name.strip().lower()
+    available = available_json_codecs()
+    if name == 'auto':
+        name = available[0]
+    elif name not in available:
+        raise ValueError("JSON codec '%s' not available (have: %s)" % (name, ', '.join(available)))
+    stdlib = __stdlib()
+    if name == 'orjson':
+        return __orjson(stdlib.dumpb)
+    elif name == 'ujson':
+        return __ujson(stdlib.dumpb)
+    return stdlib
+
+
+def get_binary_codecs():
+    """Returns {media type: BodyCodec} of the available binary codecs"""
+    ret = {'application/ubjson': BodyCodec('ubjson', 'application/ubjson', ubjdumpb, ubjloadb, binary=True)}
+    if msgpack is not None:
+        codec = BodyCodec('msgpack', 'application/msgpack',
+                          lambda obj: msgpack.packb(obj, use_bin_type=True),
+                          lambda data: msgpack.unpackb(data, raw=False),
+                          binary=True)
+        ret['application/msgpack'] = codec
+        ret['application/x-msgpack'] = codec
+    return ret
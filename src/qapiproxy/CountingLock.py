@@ -0,0 +1,37 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock
+
+
+class CountingLock(object):
+    """Lock (context manager only) counting how many acquisitions had to wait for another holder"""
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.acquired = 0
+        self.contended = 0
+
+    def __enter__(self):
+        if self.__lock.acquire(False):
+            self.acquired += 1
+        else:
+            self.__lock.acquire()
+            # Counters are only updated while holding the lock
+            self.acquired += 1
+            self.contended += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__lock.release()
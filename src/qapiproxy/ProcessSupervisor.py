@@ -0,0 +1,153 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+logger = logging.getLogger(__name__)
+
+from threading import Event
+from time import monotonic
+from os import fork, pipe, read, write, close, kill, waitpid, WNOHANG, _exit
+from signal import signal, SIGINT, SIGTERM, SIG_IGN, SIG_DFL
+
+
+RESTART_SLEEP = 1       # First delay before restarting a child which exited, doubled for each further exit
+RESTART_MAX = 60        # Longest delay between restarts of a child
+RESTART_LIMIT = 8       # Give up on a child after this many exits in a row
+RESTART_RESET = 60      # Exits of a child which ran this long (seconds) are counted from scratch
+
+
+class ProcessSupervisor(object):
+    """Runs target(index) in count child processes (from start() until stop()), restarting those which exit with
+    exponential backoff and giving up on one after RESTART_LIMIT exits in a row.
+
+    The children are forked by a helper process forked when this is created, so create it before starting any threads:
+    children (re)started later do not inherit the threads and sockets (e.g. agent clients) of this process.
+    """
+
+    def __init__(self, name, target, count):
+        self.__name = name
+        self.__target = target
+        self.__count = count
+        self.__alive = True
+        rfd, self.__go = pipe()
+        self.__pid = fork()
+        if self.__pid == 0:
+            close(self.__go)
+            code = 0
+            try:
+                self.__helper(rfd)
+            except:
+                logger.exception("%s supervisor failed", name)
+                code = 1
+            finally:
+                _exit(code)
+        close(rfd)
+
+    def start(self):
+        write(self.__go, b'1')
+
+    def stop(self):
+        """Stops the children (SIGTERM) & waits for them to exit"""
+        if self.__go is not None:
+            # Helper exits if not started yet
+            close(self.__go)
+            self.__go = None
+        try:
+            kill(self.__pid, SIGTERM)
+        except ProcessLookupError:
+            pass
+        try:
+            waitpid(self.__pid, 0)
+        except ChildProcessError:
+            pass
+        self.__alive = False
+
+    def is_alive(self):
+        """False once all children have been given up on"""
+        if self.__alive:
+            try:
+                self.__alive = waitpid(self.__pid, WNOHANG)[0] == 0
+            except ChildProcessError:
+                self.__alive = False
+        return self.__alive
+
+    def __helper(self, rfd):
+        # Interactive ^C is for the parent, which stops the helper with SIGTERM
+        signal(SIGINT, SIG_IGN)
+        stop = Event()
+        signal(SIGTERM, lambda *_: stop.set())
+        started = read(rfd, 1)
+        close(rfd)
+        if not started:
+            return
+        children = {}   # pid -> index
+        since = {}      # index -> when (monotonic) last started
+        exits = {}      # index -> exits in a row
+        restarts = {}   # index -> when (monotonic) to restart
+        for index in range(self.__count):
+            self.__fork(index, children, since)
+        while not stop.wait(0.5):
+            while True:
+                try:
+                    pid, status = waitpid(-1, WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    break
+                index = children.pop(pid)
+                if monotonic() - since[index] >= RESTART_RESET:
+                    exits[index] = 0
+                exits[index] = exits.get(index, 0) + 1
+                if exits[index] >= RESTART_LIMIT:
+                    logger.error("%s process %d exited (status %d) %d times in a row, giving up", self.__name, pid,
+                                 status, exits[index])
+                    continue
+                delay = min(RESTART_MAX, RESTART_SLEEP * 2 ** (exits[index] - 1))
+                logger.error("%s process %d exited (status %d), restarting in %ds", self.__name, pid, status, delay)
+                restarts[index] = monotonic() + delay
+            now = monotonic()
+            for index, when in list(restarts.items()):
+                if when <= now:
+                    del restarts[index]
+                    self.__fork(index, children, since)
+            if not children and not restarts:
+                logger.error("All %s processes given up on", self.__name)
+                return
+        for pid in children:
+            try:
+                kill(pid, SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def __fork(self, index, children, since):
+        pid = fork()
+        if pid == 0:
+            code = 0
+            # Not the helper's handler, target may set its own
+            signal(SIGTERM, SIG_DFL)
+            try:
+                self.__target(index)
+            except:
+                logger.exception("%s process failed", self.__name)
+                code = 1
+            finally:
+                _exit(code)
+        logger.info("Started %s process %d (%d/%d)", self.__name, pid, index, self.__count)
+        children[pid] = index
+        since[index] = monotonic()
@@ -42,5 +42,15 @@ class QAPIConfig(object):
     def config_read(self, name):
         return self.__config[name.lower()]  # TODO: checking etc
 
+    def config_read_all(self):
+        """Returns {name: details} for all agents in config_list"""
+        ret = {}
+        for name in self.config_list():
+            try:
+                ret[name] = self.config_read(name)
+            except KeyError:
+                logger.error("Cannot find agent name: '%s' Skipping!", name)
+        return ret
+
     def __getitem__(self, name):
         return self.__config[name]
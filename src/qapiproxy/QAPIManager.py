@@ -15,12 +15,19 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from threading import Thread, Event, Lock
+from threading import Thread, Event
+from queue import Queue, Empty
+from time import monotonic
+from heapq import nsmallest
+from zlib import crc32
 
 from IoticAgent import Core as IoticAgentCore
 
-from .QAPIWorker import QAPIWorker
+from .QAPIWorker import QAPIWorker, check_authtoken, WAKE_TIMEOUT, RESTART_MAX, CHECK_INTERVAL, START_TIMEOUT
 from .QAPIConfig import QAPIConfig
+from .CountingLock import CountingLock
+from .Startup import StartupScheduler, START_CONCURRENT, START_RATE, START_JITTER
+from .Scheduler import Scheduler
 QAPIMysql = None
 try:
     from .QAPIMysql import QAPIMysql
@@ -28,10 +35,24 @@ except ImportError:
     logger.info("Failed to import MySQLdb.")
 
 
+MIN_RESIDENCY = 60      # Lazy mode: least time (seconds) since last use before a worker may be evicted
+STOP_THREADS = 32       # How many workers to stop at once?
+STOP_TIMEOUT = 30       # How long (seconds) to wait for all workers to stop at shutdown?
+
+
+def shard_of(epid, shards):
+    """Index of the shard (of shards) owning epid, the same in every process"""
+    return crc32(epid.encode('utf-8')) % shards
+
+
 class QAPIManager(object):
+    """shard: (index, count) to only run the agents of one shard (see QAPIShards), None for all.  cluster: Cluster
+    (see getCluster) to only run the agents owned by this node, None for all."""
 
-    def __init__(self, config):
+    def __init__(self, config, shard=None, cluster=None):
         self.__config = config
+        self.__shard = shard
+        self.__cluster = cluster
         #
         if self.__config['config']['mode'] == 'ini':
             self.__config_reader = QAPIConfig(config=self.__config)  # TODO: validation
@@ -52,10 +73,36 @@ class QAPIManager(object):
         self.__stop = Event()
         #
         self.__new_workertime = int(self.__config['qapimanager']['new_worker'])
+        # epId -> QAPIWorker.  Never modified, replaced as a whole (under __workers_lock) so requests can read it
+        # without locking.
         self.__workers = {}
-        self.__workers_lock = Lock()
+        self.__workers_lock = CountingLock()
+        # epId -> details fingerprint of the running worker
+        self.__fingerprints = {}
+        self.__startup = StartupScheduler(
+            concurrent=self.__config['qapimanager'].get('start_concurrent', START_CONCURRENT),
+            rate=self.__config['qapimanager'].get('start_rate', START_RATE),
+            jitter=self.__config['qapimanager'].get('start_jitter', START_JITTER)
+        )
+        # Timers (idle sleep, start retries) and client starts/stops of all workers
+        self.__scheduler = Scheduler(
+            threads=self.__config['qapimanager'].get('start_concurrent', START_CONCURRENT)
+        )
+        self.__readiness = None
+        self.__contention = None
+        #
+        # Lazy mode: workers are created by the first authenticated request for their epId and the least recently
+        # used are evicted when there are more than max_clients (0 for no limit)
+        self.__lazy = str(self.__config['qapimanager'].get('lazy_workers', 'false')).strip().lower() in \
+            ('1', 'true', 'yes', 'on')
+        self.__max_clients = int(self.__config['qapimanager'].get('max_clients', 0))
+        self.__min_residency = float(self.__config['qapimanager'].get('min_residency', MIN_RESIDENCY))
+        self.__stop_timeout = float(self.__config['qapimanager'].get('stop_timeout', STOP_TIMEOUT))
+        # epId -> (name, details, fingerprint) of all configured agents, replaced as a whole like __workers
+        self.__configs = {}
 
     def start(self):
+        self.__scheduler.start()
         self.__thread = Thread(target=self.__run)
         self.__thread.start()
 
@@ -67,99 +114,193 @@ class QAPIManager(object):
     def is_alive(self):
         return self.__thread is not None
 
-    def __check_epid(self, epid, authtoken):
-        """check_epid & accessToken helper
+    def __worker(self, epid, authtoken, create=True):
+        """check_epid & accessToken helper, returns QAPIWorker from the current snapshot (in lazy mode created if
+        configured but not running, unless create is False)
 
-        Raises: ValueError for no ep / bad auth_token.
+        Raises: KeyError for no ep / bad auth_token.
         """
-        if epid in self.__workers:
-            if self.__workers[epid].check_authtoken(authtoken):
-                return True
-        raise KeyError("no such epId")
+        worker = self.__workers.get(epid)
+        if worker is None and self.__lazy and create:
+            worker = self.__lazy_worker(epid, authtoken)
+        if worker is None or not worker.check_authtoken(authtoken):
+            raise KeyError("no such epId")
+        return worker
+
+    def __new_worker(self, name, details):
+        logger.info("Starting new worker:  %s = %s", name, details['epid'])
+        return QAPIWorker(
+            details,
+            self.__stop,
+            keepFeeddata=self.__config['qapimanager']['keep_feeddata'],
+            keepControlreq=self.__config['qapimanager']['keep_controlreq'],
+            keepUnsolicited=self.__config['qapimanager']['keep_unsolicited'],
+            keepFeeddataPerPoint=self.__config['qapimanager'].get('keep_feeddata_per_point', 0),
+            wakeTimeout=self.__config['qapimanager'].get('wake_timeout', WAKE_TIMEOUT),
+            restartMax=self.__config['qapimanager'].get('restart_max', RESTART_MAX),
+            checkInterval=self.__config['qapimanager'].get('check_interval', CHECK_INTERVAL),
+            startTimeout=self.__config['qapimanager'].get('start_timeout', START_TIMEOUT),
+            startup=self.__startup,
+            scheduler=self.__scheduler
+        )
+
+    def __lazy_worker(self, epid, authtoken):
+        """Creates, starts & publishes the worker for a configured epId if authtoken is valid, else returns None"""
+        config = self.__configs.get(epid)
+        if config is None or self.__stop.is_set():
+            return None
+        name, details, fingerprint = config
+        # Before creating anything for the request
+        if not check_authtoken(details, authtoken):
+            return None
+        with self.__workers_lock:
+            current = self.__workers.get(epid)
+            if current is not None:
+                # Created by a concurrent request
+                return current
+            worker = self.__new_worker(name, details)
+            workers = dict(self.__workers)
+            workers[epid] = worker
+            self.__fingerprints[epid] = fingerprint
+            evicted = self.__evict(workers)
+            self.__workers = workers
+        # Creating the client is not done under the lock, other requests would wait for it
+        worker.start()
+        if evicted:
+            Thread(target=self.__stop_workers, args=(evicted,), name='QAPIManager-evict', daemon=True).start()
+        return worker
+
+    def __evict(self, workers):
+        """Removes least recently used workers from workers (a copy being built under __workers_lock) while there
+        are more than max_clients, sparing those used in the last min_residency seconds.  Returns removed workers."""
+        excess = len(workers) - self.__max_clients
+        if not self.__lazy or not self.__max_clients or excess <= 0:
+            return []
+        cutoff = monotonic() - self.__min_residency
+        idle = [(worker.last_used, epid) for epid, worker in workers.items() if worker.last_used < cutoff]
+        evicted = []
+        for _, epid in nsmallest(excess, idle):
+            logger.info("Worker %s least recently used.  Evicting!", epid)
+            evicted.append(workers.pop(epid))
+            del self.__fingerprints[epid]
+        return evicted
+
+    @staticmethod
+    def __stop_workers(workers, timeout=None):
+        """Stops workers, up to STOP_THREADS at once.  Returns how many had not stopped after timeout (None to wait
+        for all)"""
+        pending = Queue()
+        for worker in workers:
+            pending.put(worker)
+
+        def run():
+            while True:
+                try:
+                    worker = pending.get_nowait()
+                except Empty:
+                    break
+                try:
+                    worker.stop()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Failed to stop worker")
+
+        # Daemon threads so that workers which don't stop in time don't hold up process exit
+        threads = [Thread(target=run, name='QAPIManager-stop', daemon=True)
+                   for _ in range(min(STOP_THREADS, len(workers)))]
+        for thread in threads:
+            thread.start()
+        deadline = None if timeout is None else monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - monotonic()))
+        return sum(1 for thread in threads if thread.is_alive()) + pending.qsize()
+
+    def lock_contention(self):
+        """Returns dict of (acquired, contended) counts for the workers registry lock and (summed) worker locks"""
+        workers = self.__workers
+        acquired = contended = 0
+        for worker in workers.values():
+            acquired += worker.lock_acquired
+            contended += worker.lock_contended
+        return {'registry': (self.__workers_lock.acquired, self.__workers_lock.contended),
+                'workers': (acquired, contended)}
+
+    def readiness(self):
+        """Returns (started, total) workers"""
+        return self.__startup.ready, len(self.__workers)
+
+    def __log_readiness(self):
+        readiness = self.readiness()
+        if readiness != self.__readiness:
+            self.__readiness = readiness
+            logger.info("Workers ready: %d/%d", *readiness)
+
+    def __log_contention(self):
+        contention = self.lock_contention()
+        if contention != self.__contention:
+            self.__contention = contention
+            logger.info("Lock contention (acquired, contended): registry %s, workers %s", contention['registry'],
+                        contention['workers'])
 
     def default_lang(self, epid, authtoken):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].default_lang
-
-    def get_feeddata(self, epid, authtoken):
-        with self.__workers_lock:
-            try:
-                self.__check_epid(epid, authtoken)
-            except:
-                return []
-            return self.__workers[epid].get_feeddata()
-
-    def get_controlreq(self, epid, authtoken):
-        with self.__workers_lock:
-            try:
-                self.__check_epid(epid, authtoken)
-            except:
-                return []
-            return self.__workers[epid].get_controlreq()
-
-    def get_unsolicited(self, epid, authtoken):
-        with self.__workers_lock:
-            try:
-                self.__check_epid(epid, authtoken)
-            except:
-                return []
-            return self.__workers[epid].get_unsolicited()
+        return self.__worker(epid, authtoken).default_lang
+
+    def get_feeddata(self, epid, authtoken, since=None, wait=0, pid=None):
+        try:
+            worker = self.__worker(epid, authtoken, create=False)
+        except KeyError:
+            return []
+        return worker.get_feeddata(since=since, wait=wait, pid=pid)
+
+    def get_controlreq(self, epid, authtoken, since=None, wait=0):
+        try:
+            worker = self.__worker(epid, authtoken, create=False)
+        except KeyError:
+            return []
+        return worker.get_controlreq(since=since, wait=wait)
+
+    def get_unsolicited(self, epid, authtoken, since=None, wait=0):
+        try:
+            worker = self.__worker(epid, authtoken, create=False)
+        except KeyError:
+            return []
+        return worker.get_unsolicited(since=since, wait=wait)
+
+    def get_events(self, epid, authtoken, since=None, wait=0):
+        """Raises: KeyError for no ep / bad auth_token (unlike get_feeddata etc), e.g. once the worker was removed"""
+        return self.__worker(epid, authtoken, create=False).get_events(since=since, wait=wait)
 
     def request_entity_create(self, epid, authtoken, lid, tepid=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_create(lid, tepid=tepid)
+        return self.__worker(epid, authtoken).request_entity_create(lid, tepid=tepid)
 
     def request_entity_rename(self, epid, authtoken, lid, newlid):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_rename(lid, newlid)
+        return self.__worker(epid, authtoken).request_entity_rename(lid, newlid)
 
     def request_entity_reassign(self, epid, authtoken, lid, nepid=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_reassign(lid, nepid)
+        return self.__worker(epid, authtoken).request_entity_reassign(lid, nepid)
 
     def request_entity_delete(self, epid, authtoken, lid):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_delete(lid)
+        return self.__worker(epid, authtoken).request_entity_delete(lid)
 
     def request_entity_list(self, epid, authtoken, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_list(limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_entity_list(limit=limit, offset=offset)
 
     def request_entity_list_all(self, epid, authtoken, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_list_all(limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_entity_list_all(limit=limit, offset=offset)
 
     def request_entity_meta_get(self, epid, authtoken, lid, fmt="n3"):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_meta_get(lid, fmt=fmt)
+        return self.__worker(epid, authtoken).request_entity_meta_get(lid, fmt=fmt)
 
     def request_entity_meta_set(self, epid, authtoken, lid, meta, fmt="n3"):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_meta_set(lid, meta, fmt=fmt)
+        return self.__worker(epid, authtoken).request_entity_meta_set(lid, meta, fmt=fmt)
 
     def request_entity_meta_setpublic(self, epid, authtoken, lid, public=True):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_meta_setpublic(lid, public=public)
+        return self.__worker(epid, authtoken).request_entity_meta_setpublic(lid, public=public)
 
     def request_entity_tag_update(self, epid, authtoken, lid, tags, delete=False):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_tag_update(lid, tags, delete=delete)
+        return self.__worker(epid, authtoken).request_entity_tag_update(lid, tags, delete=delete)
 
     def request_entity_tag_list(self, epid, authtoken, lid, limit=100, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_entity_tag_list(lid, limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_entity_tag_list(lid, limit=limit, offset=offset)
 
     def __dummy_cb(self, *args, **kwargs):
         pass
@@ -168,188 +309,171 @@ class QAPIManager(object):
         cb = None
         if foc == IoticAgentCore.Const.R_CONTROL:
             cb = self.__dummy_cb
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_create(foc, lid, pid, control_cb=cb, save_recent=save_recent)
+        return self.__worker(epid, authtoken).request_point_create(foc, lid, pid, control_cb=cb,
+                                                                   save_recent=save_recent)
 
     def request_point_rename(self, epid, authtoken, foc, lid, pid, newpid):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_rename(foc, lid, pid, newpid)
+        return self.__worker(epid, authtoken).request_point_rename(foc, lid, pid, newpid)
 
     def request_point_delete(self, epid, authtoken, foc, lid, pid):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_delete(foc, lid, pid)
+        return self.__worker(epid, authtoken).request_point_delete(foc, lid, pid)
 
     def request_point_list(self, epid, authtoken, foc, lid, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_list(foc, lid, limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_point_list(foc, lid, limit=limit, offset=offset)
 
     def request_point_list_detailed(self, epid, authtoken, foc, lid, pid):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_list_detailed(foc, lid, pid)
+        return self.__worker(epid, authtoken).request_point_list_detailed(foc, lid, pid)
 
     def request_point_meta_get(self, epid, authtoken, foc, lid, pid, fmt="n3"):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_meta_get(foc, lid, pid, fmt=fmt)
+        return self.__worker(epid, authtoken).request_point_meta_get(foc, lid, pid, fmt=fmt)
 
     def request_point_meta_set(self, epid, authtoken, foc, lid, pid, meta, fmt="n3"):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_meta_set(foc, lid, pid, meta, fmt=fmt)
+        return self.__worker(epid, authtoken).request_point_meta_set(foc, lid, pid, meta, fmt=fmt)
 
     def request_point_value_create(self, epid, authtoken, lid, pid, foc, label, vtype,
                                    lang=None, comment=None, unit=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_value_create(lid, pid, foc, label,
-                                                                   vtype, lang=lang, comment=comment, unit=unit)
+        return self.__worker(epid, authtoken).request_point_value_create(lid, pid, foc, label, vtype, lang=lang,
+                                                                         comment=comment, unit=unit)
 
     def request_point_value_delete(self, epid, authtoken, lid, pid, foc, label=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_value_delete(lid, pid, foc, label=label)
+        return self.__worker(epid, authtoken).request_point_value_delete(lid, pid, foc, label=label)
 
     def request_point_value_list(self, epid, authtoken, lid, pid, foc, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_value_list(lid, pid, foc, limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_point_value_list(lid, pid, foc, limit=limit, offset=offset)
 
     def request_point_tag_update(self, epid, authtoken, foc, lid, pid, tags, delete=False):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_tag_update(foc, lid, pid, tags, delete=delete)
+        return self.__worker(epid, authtoken).request_point_tag_update(foc, lid, pid, tags, delete=delete)
 
     def request_point_tag_list(self, epid, authtoken, foc, lid, pid, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_tag_list(foc, lid, pid, limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_point_tag_list(foc, lid, pid, limit=limit, offset=offset)
 
     def request_sub_create(self, epid, authtoken, lid, foc, gpid):
         cb = None
         if foc == IoticAgentCore.Const.R_FEED:
             cb = self.__dummy_cb
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_create(lid, foc, gpid, callback=cb)
+        return self.__worker(epid, authtoken).request_sub_create(lid, foc, gpid, callback=cb)
 
     def request_sub_create_local(self, epid, authtoken, slid, foc, lid, pid):
         cb = None
         if foc == IoticAgentCore.Const.R_FEED:
             cb = self.__dummy_cb
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_create_local(slid, foc, lid, pid, callback=cb)
+        return self.__worker(epid, authtoken).request_sub_create_local(slid, foc, lid, pid, callback=cb)
 
     def request_point_share(self, epid, authtoken, lid, pid, data, mime=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_point_share(lid, pid, data, mime=mime)
+        return self.__worker(epid, authtoken).request_point_share(lid, pid, data, mime=mime)
 
     def request_sub_ask(self, epid, authtoken, sub_id, data, mime=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_ask(sub_id, data, mime=mime)
+        return self.__worker(epid, authtoken).request_sub_ask(sub_id, data, mime=mime)
 
     def request_sub_tell(self, epid, authtoken, sub_id, data, timeout, mime=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_tell(sub_id, data, timeout, mime=mime)
+        return self.__worker(epid, authtoken).request_sub_tell(sub_id, data, timeout, mime=mime)
 
     def request_sub_delete(self, epid, authtoken, sub_id):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_delete(sub_id)
+        return self.__worker(epid, authtoken).request_sub_delete(sub_id)
 
     def request_sub_list(self, epid, authtoken, lid, limit=500, offset=0):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_list(lid, limit=limit, offset=offset)
+        return self.__worker(epid, authtoken).request_sub_list(lid, limit=limit, offset=offset)
 
     def request_sub_recent(self, epid, authtoken, sub_id, count=None):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_sub_recent(sub_id, count=count)
+        return self.__worker(epid, authtoken).request_sub_recent(sub_id, count=count)
 
     def request_search(self, epid, authtoken, text=None, lang=None, location=None, unit=None,
                        limit=100, offset=0, type_='full', local=False):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_search(text=text, lang=lang, location=location,
-                                                       unit=unit, limit=limit, offset=offset, type_=type_, local=local)
+        return self.__worker(epid, authtoken).request_search(text=text, lang=lang, location=location, unit=unit,
+                                                             limit=limit, offset=offset, type_=type_, local=local)
 
     def request_describe(self, epid, authtoken, guid, local=False):
-        with self.__workers_lock:
-            self.__check_epid(epid, authtoken)
-            return self.__workers[epid].request_describe(guid, local=local)
+        return self.__worker(epid, authtoken).request_describe(guid, local=local)
+
+    def __details(self, details):
+        """Agent details with the [qapimanager] wide overrides applied"""
+        details = dict(details)
+        for key in ('vhost', 'prefix', 'sslca', 'queue_size', 'throttle'):
+            if key in self.__config['qapimanager']:
+                details[key] = self.__config['qapimanager'][key]
+        return details
+
+    @staticmethod
+    def __fingerprint(details):
+        return tuple(sorted(details.items()))
+
+    def __reconcile(self):
+        """Starts workers for new agents (unless lazy), re-starts those whose details changed & stops removed ones.
+        Returns list of workers to stop."""
+        configs = {}
+        for name, details in self.__config_reader.config_read_all().items():
+            if self.__shard is not None and shard_of(details['epid'], self.__shard[1]) != self.__shard[0]:
+                continue
+            if self.__cluster is not None and not self.__cluster.owns(details['epid']):
+                continue
+            details = self.__details(details)
+            configs[details['epid']] = (name, details, self.__fingerprint(details))
+        stopping = []
+        starting = []
+        with self.__workers_lock:
+            self.__configs = configs
+            current = self.__workers
+            # Unchanged agents (the common case) cost one fingerprint comparison each
+            if self.__lazy:
+                # Only running workers are compared, they are re-created by the next request
+                changed = [epid for epid in current
+                           if epid in configs and self.__fingerprints.get(epid) != configs[epid][2]]
+            else:
+                changed = [epid for epid, (_, _, fingerprint) in configs.items()
+                           if self.__fingerprints.get(epid) != fingerprint]
+            removed = current.keys() - configs.keys()
+            over = self.__lazy and self.__max_clients and len(current) > self.__max_clients
+            if not changed and not removed and not over:
+                return stopping
+            # Changes are made to a copy which replaces the snapshot requests read from
+            workers = dict(current)
+            for epid in removed:
+                logger.info("Worker %s removed from config list.  Killing!", epid)
+                stopping.append(workers.pop(epid))
+                del self.__fingerprints[epid]
+            for epid in changed:
+                name, details, fingerprint = configs[epid]
+                if epid in workers:
+                    logger.info("Worker %s bad details.  Killing!", epid)
+                    stopping.append(workers.pop(epid))
+                    del self.__fingerprints[epid]
+                if not self.__lazy:
+                    workers[epid] = self.__new_worker(name, details)
+                    starting.append(workers[epid])
+                    self.__fingerprints[epid] = fingerprint
+            stopping.extend(self.__evict(workers))
+            self.__workers = workers
+        # Creating the clients is not done under the lock (see __lazy_worker), requests for them wait until started
+        for worker in starting:
+            worker.start()
+        return stopping
 
     def __run(self):
         #
         # Main loop starting/stopping QAPIWorker(s)
         logger.info("Started")
         while not self.__stop.is_set():
-            agents = self.__config_reader.config_list()
-            with self.__workers_lock:
-                if self.__config['config']['mode'] == 'mysql':
-                    # Remove Agents that have been removed from the config
-                    done = False
-                    while not done:
-                        done = True
-                        for epid in self.__workers:
-                            if epid not in agents:
-                                logger.info("Worker %s removed from config list.  Killing!", epid)
-                                done = False
-                                self.__workers[epid].stop()
-                                del self.__workers[epid]
-                                break
-                # Stop/Re-start Agents that have changed in the config
-                for name in agents:
-                    #
-                    try:
-                        details = self.__config_reader.config_read(name)
-                    except KeyError:
-                        logger.error("Cannot find agent name: '%s' Skipping!", name)
-                        continue
-                    epid = details['epid']
-                    #
-                    if 'vhost' in self.__config['qapimanager']:
-                        details['vhost'] = self.__config['qapimanager']['vhost']
-                    if 'prefix' in self.__config['qapimanager']:
-                        details['prefix'] = self.__config['qapimanager']['prefix']
-                    if 'sslca' in self.__config['qapimanager']:
-                        details['sslca'] = self.__config['qapimanager']['sslca']
-                    if 'queue_size' in self.__config['qapimanager']:
-                        details['queue_size'] = self.__config['qapimanager']['queue_size']
-                    if 'throttle' in self.__config['qapimanager']:
-                        details['throttle'] = self.__config['qapimanager']['throttle']
-                    #
-                    if epid in self.__workers:
-                        if not self.__workers[epid].check_details(details):
-                            logger.info("Worker %s bad details.  Killing!", epid)
-                            self.__workers[epid].stop()
-                            del self.__workers[epid]
-                    #
-                    if epid not in self.__workers:
-                        logger.info("Starting new worker:  %s = %s", name, epid)
-                        self.__workers[epid] = QAPIWorker(
-                            details,
-                            self.__stop,
-                            keepFeeddata=self.__config['qapimanager']['keep_feeddata'],
-                            keepControlreq=self.__config['qapimanager']['keep_controlreq'],
-                            keepUnsolicited=self.__config['qapimanager']['keep_unsolicited']
-                        )
-                        self.__workers[epid].start()
+            try:
+                stopping = self.__reconcile()
+            except Exception:  # pylint: disable=broad-except
+                # e.g. config database unreachable, keep the current workers
+                logger.exception("Failed to read agent config")
+                stopping = []
+            # Removed workers are no longer reachable, stopping them does not hold up requests
+            if stopping:
+                self.__stop_workers(stopping)
+            self.__log_readiness()
+            self.__log_contention()
             #
             logger.debug("QAPIManager sleeping for %s", str(self.__new_workertime))
             self.__stop.wait(self.__new_workertime)
         #
         logger.info("Waiting for workers to die...")
         with self.__workers_lock:
-            for epid in self.__workers:
-                self.__workers[epid].stop()
+            workers, self.__workers = self.__workers, {}
+        left = self.__stop_workers(list(workers.values()), self.__stop_timeout)
+        if left:
+            logger.warning("%d workers did not stop within %ss", left, self.__stop_timeout)
+        self.__scheduler.stop()
         #
         logger.info("Stopped")
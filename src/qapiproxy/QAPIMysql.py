@@ -79,3 +79,17 @@ class QAPIMysql(object):
             raise
         self.__close_conncur(conn, cur)
         return ret
+
+    def config_read_all(self):
+        """Returns {epId: details} for all agents, in one query"""
+        ret = {}
+        conn, cur = self.__get_conncur()
+        try:
+            cur.execute("SELECT host, vhost, prefix, epId, passwd, token FROM qaconfig;")
+            for row in cur.fetchall():
+                details = self.__dict_factory(cur, row)
+                ret[details['epid']] = details
+        except:
+            raise
+        self.__close_conncur(conn, cur)
+        return ret
@@ -0,0 +1,171 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local IPC for QAPIManager: QAPIRemoteServer exposes a manager in the process that owns it, QAPIManagerProxy is used
+in place of the manager in other processes (e.g. pre-forked HTTP servers).
+
+Request events are waited for in the owning process, the proxy receives a completed RemoteEvent snapshot.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from multiprocessing.connection import Listener, Client
+from threading import Thread
+from queue import Queue, Empty
+from os import urandom
+
+from .QAPIWorker import AgentUnavailable
+
+
+# Manager methods callable through the proxy
+def _allowed(name):
+    return name.startswith('request_') or name.startswith('get_') or name == 'default_lang'
+
+
+class RemoteEvent(object):
+    """Snapshot of an IoticAgent RequestEvent, complete or timed out, with the attributes Handler uses"""
+
+    def __init__(self, evt):
+        self.__set = evt.is_set()
+        self.success = evt.success
+        self.payload = evt.payload
+        self.is_crud = evt.is_crud
+        self._messages = list(evt._messages)
+
+    def is_set(self):
+        return self.__set
+
+    def wait(self, timeout=None):  # pylint: disable=unused-argument
+        return self.__set
+
+
+class QAPIRemoteServer(object):
+    """Serves calls to manager from QAPIManagerProxy instances.  Create before forking so children inherit address and
+    authkey, start() afterwards (in the process owning the manager, which can be given then instead)."""
+
+    def __init__(self, manager=None):
+        self.__manager = manager
+        self.authkey = urandom(32)
+        self.__listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        self.address = self.__listener.address
+        self.__thread = None
+
+    def start(self, manager=None):
+        if manager is not None:
+            self.__manager = manager
+        self.__thread = Thread(target=self.__accept, name='QAPIRemote', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__listener.close()
+
+    def __accept(self):
+        while True:
+            try:
+                conn = self.__listener.accept()
+            except OSError:
+                break  # listener closed
+            except Exception:  # pylint: disable=broad-except
+                logger.warning("Rejected IPC connection", exc_info=True)
+                continue
+            Thread(target=self.__serve, args=(conn,), name='QAPIRemote-conn', daemon=True).start()
+
+    def __serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    name, args, kwargs, timeout = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    conn.send((True, self.__call(name, args, kwargs, timeout)))
+                except (EOFError, OSError):
+                    break
+                except Exception as exc:  # pylint: disable=broad-except
+                    try:
+                        conn.send((False, exc))
+                    except Exception:  # pylint: disable=broad-except
+                        # exception not picklable
+                        conn.send((False, Exception(str(exc))))
+
+    def __call(self, name, args, kwargs, timeout):
+        if not _allowed(name):
+            raise ValueError('not callable remotely: %s' % name)
+        ret = getattr(self.__manager, name)(*args, **kwargs)
+        if hasattr(ret, '_messages'):
+            ret.wait(timeout)
+            ret = RemoteEvent(ret)
+        return ret
+
+
+class QAPIManagerProxy(object):
+    """Forwards QAPIManager request_* / get_* / default_lang calls to a QAPIRemoteServer.  Connections are pooled and
+    shared by the calling threads."""
+
+    def __init__(self, address, authkey, timeout=10):
+        self.__address = address
+        self.__authkey = authkey
+        self.__timeout = timeout
+        self.__idle = Queue()
+
+    def __getattr__(self, name):
+        if not _allowed(name):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.__call(name, args, kwargs)
+
+        return call
+
+    def __call(self, name, args, kwargs):
+        conn = self.__connection()
+        try:
+            conn.send((name, args, kwargs, self.__timeout))
+            success, ret = conn.recv()
+        except (EOFError, OSError) as exc:
+            # e.g. shard process exited (restarted by its ProcessSupervisor)
+            conn.close()
+            raise AgentUnavailable('IPC failed: %s' % exc)
+        except:
+            conn.close()
+            raise
+        self.__idle.put(conn)
+        if not success:
+            raise ret
+        return ret
+
+    def __connection(self):
+        """Idle connection, skipping those closed by the server meanwhile (anything readable), or a new one"""
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except Empty:
+                break
+            try:
+                if not conn.poll():
+                    return conn
+            except (EOFError, OSError):
+                pass
+            conn.close()
+        try:
+            return Client(self.__address, authkey=self.__authkey)
+        except (EOFError, OSError) as exc:
+            raise AgentUnavailable('IPC failed: %s' % exc)
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except Empty:
+                break
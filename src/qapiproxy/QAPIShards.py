@@ -0,0 +1,104 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs QAPIWorkers in several processes ([qapimanager] shards) so agent clients use more than one core.  Each shard
+process runs a QAPIManager for the agents whose epId hashes to it (see shard_of) and serves it with a
+QAPIRemoteServer.  QAPIShardedManager is used in place of QAPIManager by the HTTP server and forwards each call to the
+shard owning its epId.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from threading import Event
+from signal import signal, SIGINT, SIGTERM, SIG_IGN
+
+from .QAPIManager import QAPIManager, shard_of
+from .QAPIRemote import QAPIRemoteServer, QAPIManagerProxy, _allowed
+from .ProcessSupervisor import ProcessSupervisor
+
+
+class QAPIShardProxy(object):
+    """Forwards QAPIManager request_* / get_* / default_lang calls to the shard owning the epId (first argument)"""
+
+    def __init__(self, remotes, timeout=10):
+        self.__proxies = [QAPIManagerProxy(remote.address, remote.authkey, timeout=timeout) for remote in remotes]
+
+    def __getattr__(self, name):
+        if not _allowed(name):
+            raise AttributeError(name)
+
+        def call(epid, *args, **kwargs):
+            # As QAPIManager for a request without (valid) epId
+            if not isinstance(epid, str):
+                if name.startswith('get_'):
+                    return []
+                raise KeyError("no such epId")
+            proxy = self.__proxies[shard_of(epid, len(self.__proxies))]
+            return getattr(proxy, name)(epid, *args, **kwargs)
+
+        return call
+
+    def close(self):
+        for proxy in self.__proxies:
+            proxy.close()
+
+
+class QAPIShardedManager(object):
+    """Same interface as QAPIManager, with the workers in shards child processes.  Shard processes which exit
+    unexpectedly are restarted with backoff (their agents are unavailable meanwhile), see ProcessSupervisor: create
+    before starting the HTTP server.
+    """
+
+    def __init__(self, config, shards, timeout=10, cluster=None):
+        self.__config = config
+        self.__cluster = cluster
+        self.__timeout = timeout
+        # Created before forking so HTTP processes and restarted shards inherit the addresses
+        self.__remotes = [QAPIRemoteServer() for _ in range(shards)]
+        self.__proxy = QAPIShardProxy(self.__remotes, timeout=timeout)
+        self.__processes = ProcessSupervisor('Shard', self.__child, shards)
+
+    def __getattr__(self, name):
+        if not _allowed(name):
+            raise AttributeError(name)
+        return getattr(self.__proxy, name)
+
+    def proxy(self):
+        """New QAPIShardProxy, for use in another (forked) process"""
+        return QAPIShardProxy(self.__remotes, timeout=self.__timeout)
+
+    def start(self):
+        self.__processes.start()
+
+    def stop(self):
+        # Shards stop their workers (up to [qapimanager] stop_timeout) when sent SIGTERM
+        self.__processes.stop()
+        self.__proxy.close()
+        for remote in self.__remotes:
+            remote.stop()
+
+    def is_alive(self):
+        return self.__processes.is_alive()
+
+    def __child(self, index):
+        # Interactive ^C is for the parent, which stops shards with SIGTERM
+        signal(SIGINT, SIG_IGN)
+        stop = Event()
+        signal(SIGTERM, lambda *_: stop.set())
+        manager = QAPIManager(self.__config, shard=(index, len(self.__remotes)), cluster=self.__cluster)
+        self.__remotes[index].start(manager)
+        manager.start()
+        while manager.is_alive() and not stop.wait(0.5):
+            pass
+        manager.stop()
@@ -18,14 +18,80 @@ import logging
 logger = logging.getLogger(__name__)
 
 from threading import Thread, Event
-from queue import Queue
-from time import sleep, monotonic
+from time import monotonic
+from functools import wraps
+from random import uniform
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 
 from IoticAgent import Core as IoticAgentCore
+from IoticAgent.Core.Exceptions import LinkException
 
+from .CountingLock import CountingLock
+from .Startup import StartupScheduler
+from .Scheduler import Scheduler
+from .SeqBuffer import SeqBuffer
 
-DATA_KEEP = 50              # How many feed shares etc to keep in a queue until fetched?
+
+DATA_KEEP = 50              # How many feed shares etc to keep (newest) for fetching?
 SLEEP_ON_IDLE = 60 * 5      # How long before sleeping the agent?
+WAKE_TIMEOUT = 8            # How long a request waits for a sleeping agent to wake?
+RESTART_SLEEP = 5           # First delay before restarting a failed client, doubled for each further failure
+RESTART_MAX = 300           # Longest delay between restart attempts
+CHECK_INTERVAL = 30         # How often to check a running client is still alive?
+START_TIMEOUT = 60          # How long a client start may take before it is considered wedged?
+STOPPED_RETRY = 1           # Retry-After for requests to a stopped (e.g. evicted) worker, a retry gets a new one
+
+# Client (qc) states
+SLEEPING = 'sleeping'
+WAKING = 'waking'
+RUNNING = 'running'
+RESTARTING = 'restarting'
+
+# Kinds of data kept for fetching (see SeqBuffer)
+FEEDDATA = 'feeddata'
+CONTROLREQ = 'controlreq'
+UNSOLICITED = 'unsolicited'
+
+
+class AgentUnavailable(Exception):
+    """The agent's client is not running (yet), the request can be retried later (retry_after: in seconds, if known)
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Keep retry_after when pickled (QAPIRemote)
+        return self.__class__, (self.args[0], self.retry_after)
+
+
+def check_authtoken(details, authToken):
+    """Is authToken valid for the agent with (config) details?"""
+    if 'authtokens' in details:
+        tokens = details['authtokens'].strip().split("\n")
+        for et in tokens:
+            if et == authToken:
+                return True
+    elif authToken == details['token']:  # todo: Allow Agent token as API Key ??
+        return True
+    return False
+
+
+def _unavailable_if_stopped(func):
+    """QAPIWorker request method decorator: the client of a stopped (evicted, removed or restarted) worker fails
+    requests with LinkException, the agent is only unloaded so they are AgentUnavailable"""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except LinkException as exc:
+            if not self.stopped:
+                raise
+            raise AgentUnavailable("QAPIWorker %s stopped" % self.epid, retry_after=STOPPED_RETRY) from exc
+
+    return wrapper
 
 
 class QAPIWorker(object):
@@ -36,7 +102,14 @@ class QAPIWorker(object):
                  keepFeeddata=DATA_KEEP,
                  keepControlreq=DATA_KEEP,
                  keepUnsolicited=DATA_KEEP,
-                 sleepOnIdle=SLEEP_ON_IDLE):
+                 keepFeeddataPerPoint=0,
+                 sleepOnIdle=SLEEP_ON_IDLE,
+                 wakeTimeout=WAKE_TIMEOUT,
+                 restartMax=RESTART_MAX,
+                 checkInterval=CHECK_INTERVAL,
+                 startTimeout=START_TIMEOUT,
+                 startup=None,
+                 scheduler=None):
         #
         self.__details = details
         self.__stop = Event()
@@ -59,21 +132,44 @@ class QAPIWorker(object):
             self.__keepUnsolicited = int(keepUnsolicited)
         except:
             pass
+
+        self.__keepFeeddataPerPoint = 0
+        try:
+            self.__keepFeeddataPerPoint = int(keepFeeddataPerPoint)
+        except:
+            logger.warning("QAPIWorker failed to int keepFeeddataPerPoint '%s'", keepFeeddataPerPoint)
         #
-        self.__qFeeddata = Queue()
-        self.__qControlreq = Queue()
-        self.__qUnsolicited = Queue()
+        # Items are kept (& numbered) until pushed out by newer ones, see get_feeddata.  Feed data by point (pid).
+        self.__buffer = SeqBuffer({FEEDDATA: self.__keepFeeddata,
+                                   CONTROLREQ: self.__keepControlreq,
+                                   UNSOLICITED: self.__keepUnsolicited},
+                                  key_maxlens={FEEDDATA: self.__keepFeeddataPerPoint})
         #
-        self.__thread = None
         self.__qc = None        # IoticAgent.Core.Client instance
+        self.__started = Event()    # start() done (a worker can be used by requests before, see __wake)
         #
         self.__sleep_on_idle = sleepOnIdle
-        self.__qc_last = 0          # Last time qc was used for a request
-        self.__qc_running = False   # QC is sleeping? (started (True) or stopped (False))
+        self.__wake_timeout = float(wakeTimeout)
+        self.__qc_last = monotonic()    # Last time qc was used for a request
+        # SLEEPING -> WAKING -> RUNNING (-> SLEEPING when idle), failed/dead/wedged -> RESTARTING -> SLEEPING -> WAKING
+        self.__qc_state = SLEEPING
+        self.__qc_wake = None       # Future for the current/last wake, shared by all requests waiting for it
+        self.__wake_task = None     # Scheduler (pool) Future of the thread running the current/last wake
+        # Held to change __qc_state (wake, sleep or stop the client), not for requests on a running client
+        self.__lock = CountingLock()
+        # Paces client starts across workers (none if not shared)
+        self.__startup = startup if startup is not None else StartupScheduler(rate=0, jitter=0)
+        self.__ready = False    # First start succeeded (counted by __startup)
+        # Timers & client start/stop run on the (shared) scheduler, the worker has no thread of its own
+        self.__own_scheduler = scheduler is None
+        self.__scheduler = Scheduler(threads=2) if scheduler is None else scheduler
+        self.__timer = None     # Pending housekeeping (first start, retry or idle check)
         #
-        self.__polltime = 5
-        self.__dead_max = 6     # How many times to try to start a dead worker?
-        self.__dead_sleep = 5   # How long to sleep between worker.start attempts?
+        self.__dead_count = 0   # Failures since the client last ran
+        self.__restart_max = float(restartMax)
+        self.__check_interval = float(checkInterval)
+        self.__start_timeout = float(startTimeout)
+        self.__restart_at = 0   # When (monotonic) the next restart is due, if RESTARTING
         #
         # IoticAgent Core throttle settings
         self.__queue_size = 128
@@ -103,258 +199,465 @@ class QAPIWorker(object):
         return True
 
     def check_authtoken(self, authToken):
-        if 'authtokens' in self.__details:
-            tokens = self.__details['authtokens'].strip().split("\n")
-            for et in tokens:
-                if et == authToken:
-                    return True
-        elif authToken == self.__details['token']:  # todo: Allow Agent token as API Key ??
-            return True
-        return False
+        return check_authtoken(self.__details, authToken)
 
     def start(self):
-        self.__thread = Thread(target=self.__run)
-        self.__thread.start()
+        # Residency (see last_used) counts from now
+        self.__qc_last = monotonic()
+        # Before the first start so requests can wake the client right away
+        self.__qc = self.__new_client()
+        #
+        if self.__own_scheduler:
+            self.__scheduler.start()
+        # Spread the first starts of many workers (a request can still wake the client meanwhile)
+        with self.__lock:
+            self.__set_timer(self.__startup.initial_delay(), self.__start_attempt)
+        self.__started.set()
+
+    def __new_client(self):
+        qc = IoticAgentCore.Client(
+            self.__details['host'],
+            self.__vhost,
+            self.__details['epid'],
+            self.__details['passwd'],
+            self.__details['token'],
+            prefix=self.__prefix,
+            sslca=self.__sslca,
+            send_queue_size=self.__queue_size,
+            throttle_conf=self.__throttle_conf
+        )
+        # network_retry_timeout=10,  # todo: override in config ?
+        qc.register_callback_feeddata(self.__cb_feeddata)
+        qc.register_callback_controlreq(self.__cb_controlreq)
+        qc.register_callback_reassigned(self.__cb_unsolicited)
+        qc.register_callback_subscription(self.__cb_unsolicited)
+        return qc
 
     def stop(self):
-        self.__stop.set()
-        self.__thread.join()
-
-    def __wake_agent(self):
-        if not self.__qc_running:
-            logger.info("QAPIWorker %s Waking", self.__details['epid'])
-            self.__qc.start()
-            self.__qc_running = True
+        with self.__lock:
+            self.__stop.set()
+            self.__set_timer(None)
+            wake = self.__qc_wake
+        if wake is not None:
+            # Don't stop the client under a wake in progress
+            try:
+                wake.result(self.__wake_timeout)
+            except Exception:  # pylint: disable=broad-except
+                pass
+        with self.__lock:
+            try:
+                self.__qc.stop()
+            except:
+                pass
+            self.__qc_state = SLEEPING
+            if self.__ready:
+                self.__ready = False
+                self.__startup.set_ready(False)
+        # Long-polls waiting for data return now
+        self.__buffer.close()
+        if self.__own_scheduler:
+            self.__scheduler.stop()
+
+    def __set_timer(self, delay, func=None, *args):
+        """Replaces pending housekeeping timer (call with __lock held), delay None to just cancel"""
+        self.__scheduler.cancel(self.__timer)
+        self.__timer = None if delay is None else self.__scheduler.schedule(delay, func, *args)
+
+    def __start_attempt(self):
+        # (timer) first start or restart, woken by a request meanwhile is fine too
+        with self.__lock:
+            if self.__stop.is_set() or self.__managerStop.is_set():
+                return
+            if self.__qc_state is RESTARTING:
+                self.__qc_state = SLEEPING
+        try:
+            self.__begin_wake()
+        except AgentUnavailable:
+            pass  # stopped
+
+    def __restart_later(self, reason):
+        """Schedules the next start with exponential backoff & jitter (call with __lock held).  Until then requests
+        fail straight away with AgentUnavailable.
+        """
+        self.__qc_state = RESTARTING
+        if self.__stop.is_set() or self.__managerStop.is_set():
+            return
+        self.__dead_count += 1
+        delay = min(self.__restart_max, RESTART_SLEEP * 2 ** (self.__dead_count - 1))
+        # Jittered so workers failing together (e.g. broker restart) don't retry together
+        delay = uniform(delay / 2, delay)
+        logger.error("QAPIWorker %s %s (failure %d), restarting in %.1fs", self.__details['epid'], reason,
+                     self.__dead_count, delay)
+        self.__restart_at = monotonic() + delay
+        self.__set_timer(delay, self.__start_attempt)
+
+    def __check(self):
+        # (timer) restart the client if it died, sleep it if unused for sleepOnIdle, else check again later
+        with self.__lock:
+            if self.__qc_state is not RUNNING or self.__stop.is_set():
+                return
+            if not self.__qc.is_alive():
+                # Stop (e.g. remaining thread) before the next start, which waits for __qc_wake
+                self.__qc_wake = self.__scheduler.submit(self.__qc.stop)
+                self.__timer = None
+                self.__restart_later('client died')
+                return
+            idle = monotonic() - self.__qc_last
+            if idle <= self.__sleep_on_idle:
+                self.__set_timer(min(self.__check_interval, self.__sleep_on_idle - idle + 0.1), self.__check)
+                return
+            logger.info("QAPIWorker %s Sleeping", self.__details['epid'])
+            self.__qc_state = SLEEPING
+            self.__timer = None
+            # Stopping can block, not on the timer thread
+            self.__qc_wake = self.__scheduler.submit(self.__qc.stop)
+
+    def __check_wedged(self, wake, slot):
+        # (timer) client start taking longer than startTimeout: abandon that client for a new one
+        with self.__lock:
+            if wake.done() or self.__qc_wake is not wake or self.__stop.is_set():
+                return
+            qc, self.__qc = self.__qc, self.__new_client()
+            self.__timer = None
+            self.__restart_later('start wedged')
+            wake.set_exception(AgentUnavailable("QAPIWorker %s start timed out" % self.__details['epid'],
+                                                retry_after=self.__restart_at - monotonic()))
+            task = self.__wake_task
+        # The blocked start must not hold up others: give up its connect slot & pool thread.  The thread running it
+        # finishes (see __wake) whenever it returns.
+        self.__startup.release(slot)
+        self.__scheduler.replace_blocked(task)
+        # Might unblock the start.  Not on the pool, it could block too.
+        Thread(target=qc.stop, name='QAPIWorker-wedged', daemon=True).start()
+
+    @property
+    def epid(self):
+        return self.__details['epid']
+
+    @property
+    def stopped(self):
+        return self.__stop.is_set()
+
+    @property
+    def last_used(self):
+        """When (monotonic) the worker was started or last used for a request"""
+        return self.__qc_last
+
+    @property
+    def lock_acquired(self):
+        return self.__lock.acquired
+
+    @property
+    def lock_contended(self):
+        return self.__lock.contended
+
+    def __wake_agent(self, timeout=None):
+        """Starts the client in the background if sleeping and waits (up to timeout, default wakeTimeout) for it to
+        be running.  Requests arriving while the client wakes wait on the same wake.
+
+        Raises: AgentUnavailable if the client is not running by then (or restarting after a failure)
+        """
+        if self.__qc_state is not RUNNING:
+            wake = self.__begin_wake()
+            try:
+                wake.result(self.__wake_timeout if timeout is None else timeout)
+            except FutureTimeout:
+                raise AgentUnavailable("QAPIWorker %s waking" % self.__details['epid'])
+            except AgentUnavailable:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                if self.__stop.is_set():
+                    raise AgentUnavailable("QAPIWorker %s stopped" % self.__details['epid'], retry_after=STOPPED_RETRY)
+                raise AgentUnavailable("QAPIWorker %s failed to start: %s" % (self.__details['epid'], exc),
+                                       retry_after=max(0, self.__restart_at - monotonic()))
         self.__qc_last = monotonic()
 
+    def __begin_wake(self):
+        """Returns Future of the running client, starting a wake if sleeping
+
+        Raises: AgentUnavailable if stopped or waiting to restart
+        """
+        with self.__lock:
+            if self.__stop.is_set():
+                raise AgentUnavailable("QAPIWorker %s stopped" % self.__details['epid'], retry_after=STOPPED_RETRY)
+            if self.__qc_state is RESTARTING:
+                retry_after = max(0, self.__restart_at - monotonic())
+                raise AgentUnavailable("QAPIWorker %s restarting in %.0fs" % (self.__details['epid'], retry_after),
+                                       retry_after=retry_after)
+            if self.__qc_state is SLEEPING:
+                self.__qc_state = WAKING
+                # After any stop of the client (sleep) still in progress
+                sleeping, wake = self.__qc_wake, Future()
+                self.__qc_wake = wake
+                self.__wake_task = self.__scheduler.submit(self.__wake, wake, sleeping)
+            return self.__qc_wake
+
+    def __wake(self, wake, sleeping):
+        if sleeping is not None:
+            try:
+                sleeping.result()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        logger.info("QAPIWorker %s Waking", self.__details['epid'])
+        try:
+            # Published (lazy mode) just before start() is called
+            if not self.__started.wait(self.__wake_timeout):
+                raise AgentUnavailable("QAPIWorker %s not started" % self.__details['epid'])
+            qc = self.__qc
+            slot = self.__startup.acquire()
+            try:
+                with self.__lock:
+                    stopped = self.__stop.is_set()
+                    if not stopped:
+                        # Timed from here, not whilst queued for the startup scheduler
+                        self.__set_timer(self.__start_timeout, self.__check_wedged, wake, slot)
+                if stopped:
+                    # Stopped whilst queued, stop() might not have waited for this wake
+                    raise LinkException("QAPIWorker %s stopped" % self.__details['epid'])
+                qc.start()
+            finally:
+                # (unless already released by __check_wedged)
+                self.__startup.release(slot)
+        except Exception as exc:  # pylint: disable=broad-except
+            with self.__lock:
+                if wake.done():
+                    return  # wedged, already given up on
+                self.__restart_later('failed to start: %s' % exc)
+            wake.set_exception(exc)
+        else:
+            with self.__lock:
+                # Wedged start returned after all (that client has been replaced) or stopped whilst starting
+                abandoned = wake.done()
+                stopped = self.__stop.is_set()
+                if stopped:
+                    self.__set_timer(None)
+                elif not abandoned:
+                    self.__qc_last = monotonic()
+                    self.__qc_state = RUNNING
+                    self.__dead_count = 0
+                    self.__set_timer(min(self.__check_interval, self.__sleep_on_idle), self.__check)
+                    if not self.__ready:
+                        self.__ready = True
+                        self.__startup.set_ready(True)
+            if abandoned or stopped:
+                try:
+                    qc.stop()
+                except:
+                    pass
+                if not abandoned:
+                    wake.set_exception(LinkException("QAPIWorker %s stopped" % self.__details['epid']))
+                return
+            wake.set_result(None)
+
     @property
     def default_lang(self):
         return self.__qc.default_lang
 
+    @_unavailable_if_stopped
     def request_entity_create(self, lid, tepid=None):
         self.__wake_agent()
         return self.__qc.request_entity_create(lid, epId=tepid)
 
+    @_unavailable_if_stopped
     def request_entity_rename(self, lid, newlid):
         self.__wake_agent()
         return self.__qc.request_entity_rename(lid, newlid)
 
+    @_unavailable_if_stopped
     def request_entity_reassign(self, lid, nepid=None):
         self.__wake_agent()
         return self.__qc.request_entity_reassign(lid, nepid)
 
+    @_unavailable_if_stopped
     def request_entity_delete(self, lid):
         self.__wake_agent()
         return self.__qc.request_entity_delete(lid)
 
+    @_unavailable_if_stopped
     def request_entity_list(self, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_entity_list(limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_entity_list_all(self, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_entity_list_all(limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_entity_meta_get(self, lid, fmt="n3"):
         self.__wake_agent()
         return self.__qc.request_entity_meta_get(lid, fmt=fmt)
 
+    @_unavailable_if_stopped
     def request_entity_meta_set(self, lid, meta, fmt="n3"):
         self.__wake_agent()
         return self.__qc.request_entity_meta_set(lid, meta, fmt=fmt)
 
+    @_unavailable_if_stopped
     def request_entity_meta_setpublic(self, lid, public=True):
         self.__wake_agent()
         return self.__qc.request_entity_meta_setpublic(lid, public=public)
 
+    @_unavailable_if_stopped
     def request_entity_tag_update(self, lid, tags, delete=False):
         self.__wake_agent()
         return self.__qc.request_entity_tag_update(lid, tags, delete=delete)
 
+    @_unavailable_if_stopped
     def request_entity_tag_list(self, lid, limit=100, offset=0):
         self.__wake_agent()
         return self.__qc.request_entity_tag_list(lid, limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_point_create(self, foc, lid, pid, control_cb=None, save_recent=0):
         self.__wake_agent()
         return self.__qc.request_point_create(foc, lid, pid, control_cb=control_cb, save_recent=save_recent)
 
+    @_unavailable_if_stopped
     def request_point_rename(self, foc, lid, pid, newpid):
         self.__wake_agent()
         return self.__qc.request_point_rename(foc, lid, pid, newpid)
 
+    @_unavailable_if_stopped
     def request_point_confirm_tell(self, foc, lid, pid, success=True, requestId=None):
         self.__wake_agent()
         return self.__qc.request_point_confirm_tell(foc, lid, pid, success=success, requestId=requestId)
 
+    @_unavailable_if_stopped
     def request_point_delete(self, foc, lid, pid):
         self.__wake_agent()
         return self.__qc.request_point_delete(foc, lid, pid)
 
+    @_unavailable_if_stopped
     def request_point_list(self, foc, lid, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_point_list(foc, lid, limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_point_list_detailed(self, foc, lid, pid):
         self.__wake_agent()
         return self.__qc.request_point_list_detailed(foc, lid, pid)
 
+    @_unavailable_if_stopped
     def request_point_meta_get(self, foc, lid, pid, fmt="n3"):
         self.__wake_agent()
         return self.__qc.request_point_meta_get(foc, lid, pid, fmt=fmt)
 
+    @_unavailable_if_stopped
     def request_point_meta_set(self, foc, lid, pid, meta, fmt="n3"):
         self.__wake_agent()
         return self.__qc.request_point_meta_set(foc, lid, pid, meta, fmt=fmt)
 
+    @_unavailable_if_stopped
     def request_point_value_create(self, lid, pid, foc, label, vtype, lang=None, comment=None, unit=None):
         self.__wake_agent()
         return self.__qc.request_point_value_create(lid, pid, foc, label, vtype, lang=lang, comment=comment, unit=unit)
 
+    @_unavailable_if_stopped
     def request_point_value_delete(self, lid, pid, foc, label=None):
         self.__wake_agent()
         return self.__qc.request_point_value_delete(lid, pid, foc, label=label)
 
+    @_unavailable_if_stopped
     def request_point_value_list(self, lid, pid, foc, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_point_value_list(lid, pid, foc, limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_point_tag_update(self, foc, lid, pid, tags, delete=False):
         self.__wake_agent()
         return self.__qc.request_point_tag_update(foc, lid, pid, tags, delete=delete)
 
+    @_unavailable_if_stopped
     def request_point_tag_list(self, foc, lid, pid, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_point_tag_list(foc, lid, pid, limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_sub_create(self, lid, foc, gpid, callback=None):
         self.__wake_agent()
         return self.__qc.request_sub_create(lid, foc, gpid, callback=callback)
 
+    @_unavailable_if_stopped
     def request_sub_create_local(self, slid, foc, lid, pid, callback=None):
         self.__wake_agent()
         return self.__qc.request_sub_create_local(slid, foc, lid, pid, callback=callback)
 
+    @_unavailable_if_stopped
     def request_point_share(self, lid, pid, data, mime=None):
         self.__wake_agent()
         return self.__qc.request_point_share(lid, pid, data, mime=mime)
 
+    @_unavailable_if_stopped
     def request_sub_ask(self, sub_id, data, mime=None):
         self.__wake_agent()
         return self.__qc.request_sub_ask(sub_id, data, mime=mime)
 
+    @_unavailable_if_stopped
     def request_sub_tell(self, sub_id, data, timeout, mime=None):
         self.__wake_agent()
         return self.__qc.request_sub_tell(sub_id, data, timeout, mime=mime)
 
+    @_unavailable_if_stopped
     def request_sub_delete(self, sub_id):
         self.__wake_agent()
         return self.__qc.request_sub_delete(sub_id)
 
+    @_unavailable_if_stopped
     def request_sub_list(self, lid, limit=500, offset=0):
         self.__wake_agent()
         return self.__qc.request_sub_list(lid, limit=limit, offset=offset)
 
+    @_unavailable_if_stopped
     def request_sub_recent(self, sub_id, count=None):
         self.__wake_agent()
         return self.__qc.request_sub_recent(sub_id, count=count)
 
+    @_unavailable_if_stopped
     def request_search(self, text=None, lang=None, location=None, unit=None, limit=100, offset=0, type_='full',
                        local=False):
         self.__wake_agent()
         return self.__qc.request_search(text=text, lang=lang, location=location, unit=unit,
                                         limit=limit, offset=offset, type_=type_, local=local)
 
+    @_unavailable_if_stopped
     def request_describe(self, guid, local=False):
         self.__wake_agent()
         return self.__qc.request_describe(guid, local=local)
 
     def __cb_feeddata(self, data):
-        if self.__keepFeeddata == 0:
-            return
-        while self.__qFeeddata.qsize() > self.__keepFeeddata:
-            self.__qFeeddata.get()  # throw away element
-        self.__qFeeddata.put(data)
+        self.__buffer.append(FEEDDATA, data, key=data.get('pid'))
 
-    def get_feeddata(self):
-        ret = []
-        while self.__qFeeddata.qsize() > 0:
-            ret.append(self.__qFeeddata.get())
-        return ret
+    def get_feeddata(self, since=None, wait=0, pid=None):
+        """Returns the feed data (of point pid, if not None) received since sequence number since (each item has its
+        'seq'), without removing it.  since None: all kept feed data, which is removed (for clients not passing since).
+        If there is none, waits up to wait seconds for some (long-poll)."""
+        return self.__get(FEEDDATA, since, wait, key=pid)
 
     def __cb_controlreq(self, data):
-        if self.__keepControlreq == 0:
-            return
-        while self.__qControlreq.qsize() > self.__keepControlreq:
-            self.__qControlreq.get()  # throw away element
-        self.__qControlreq.put(data)
+        self.__buffer.append(CONTROLREQ, data)
 
-    def get_controlreq(self):
-        ret = []
-        while self.__qControlreq.qsize() > 0:
-            ret.append(self.__qControlreq.get())
-        return ret
+    def get_controlreq(self, since=None, wait=0):
+        return self.__get(CONTROLREQ, since, wait)
 
     def __cb_unsolicited(self, data):
-        if self.__keepUnsolicited == 0:
-            return
-        while self.__qUnsolicited.qsize() > self.__keepUnsolicited:
-            self.__qUnsolicited.get()  # throw away element
-        self.__qUnsolicited.put(data)
-
-    def get_unsolicited(self):
-        ret = []
-        while self.__qUnsolicited.qsize() > 0:
-            ret.append(self.__qUnsolicited.get())
-        return ret
-
-    def __run(self):
-        #
-        self.__qc = IoticAgentCore.Client(
-            self.__details['host'],
-            self.__vhost,
-            self.__details['epid'],
-            self.__details['passwd'],
-            self.__details['token'],
-            prefix=self.__prefix,
-            sslca=self.__sslca,
-            send_queue_size=self.__queue_size,
-            throttle_conf=self.__throttle_conf
-        )
-        # network_retry_timeout=10,  # todo: override in config ?
-        #
-        # Keep trying to start the worker
-        dead_count = 0
-        done = False
-        while not done and not self.__stop.is_set() and\
-                not self.__managerStop.is_set() and\
-                dead_count < self.__dead_max:
-            done = True
-            try:
-                self.__wake_agent()
-            except:
-                logger.error("Worker %s FAILED TO START sleep(%i)...", self.__details['epid'], self.__dead_sleep)
-                done = False
-                dead_count += 1
-                sleep(self.__dead_sleep)
-        if dead_count >= self.__dead_max:
-            return
-        #
-        self.__qc.register_callback_feeddata(self.__cb_feeddata)
-        self.__qc.register_callback_controlreq(self.__cb_controlreq)
-        self.__qc.register_callback_reassigned(self.__cb_unsolicited)
-        self.__qc.register_callback_subscription(self.__cb_unsolicited)
-        #
-        while not self.__stop.is_set() and not self.__managerStop.is_set():
-            logger.debug("QAPIWorker %s still running", self.__details['epid'])
-            self.__stop.wait(self.__polltime)
-            #
-            if self.__qc_running and (monotonic() - self.__qc_last > self.__sleep_on_idle):
-                logger.info("QAPIWorker %s Sleeping", self.__details['epid'])
-                self.__qc.stop()
-                self.__qc_running = False
-        # Clean-up
-        try:
-            self.__qc.stop()
-        except:
-            pass
+        self.__buffer.append(UNSOLICITED, data)
+
+    def get_unsolicited(self, since=None, wait=0):
+        return self.__get(UNSOLICITED, since, wait)
+
+    def get_events(self, since=None, wait=0):
+        """Returns [(seq, kind, item)] of all kinds (FEEDDATA etc) received since sequence number since, without
+        removing them, oldest first.  If there are none, waits up to wait seconds for some."""
+        if wait > 0:
+            self.__buffer.wait(None, since, wait)
+        return [(seq, kind, dict(item, seq=seq)) for seq, kind, item in self.__buffer.read_all(since)]
+
+    def __get(self, kind, since, wait, key=None):
+        if wait > 0:
+            self.__buffer.wait(kind, since, wait, key=key)
+        if since is None:
+            items = self.__buffer.take(kind, key=key)
+        else:
+            items = self.__buffer.read(kind, since, key=key)
+        return [dict(item, seq=seq) for seq, item in items]
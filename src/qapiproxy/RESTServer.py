@@ -16,19 +16,24 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from json import loads, dumps
 from base64 import b64encode
 from ssl import SSLContext, CERT_REQUIRED, OP_NO_COMPRESSION, PROTOCOL_TLSv1_2, RAND_add
-from socket import socket as createSocket, getaddrinfo, AI_PASSIVE, SOCK_STREAM, AF_UNSPEC
-# from socketserver import ForkingMixIn
+from socket import (socket as createSocket, socketpair, getaddrinfo, getfqdn, AI_PASSIVE, SOCK_STREAM, AF_UNSPEC,
+                    SOL_SOCKET, SO_REUSEPORT)
+from select import select
+from collections import deque
 
 from socketserver import ThreadingMixIn
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.client import HTTPException
 from re import compile as re_compile, A as re_A, I as re_I
-from urllib import parse
-from threading import Thread
+from threading import Thread, Event, Condition, Lock
+from time import time, monotonic
+from math import ceil
+from queue import Queue, Full, Empty
 from os import urandom
-from zlib import decompress
+from signal import signal, SIGINT, SIGTERM, SIG_IGN
+from zlib import decompressobj, compressobj, error as ZlibError, DEFLATED, MAX_WBITS
 
 from ubjson import loadb as ubjloadb
 
@@ -44,35 +49,31 @@ import IoticAgent.Core as IoticAgentCore
 from IoticAgent.Core.Exceptions import LinkException
 from IoticAgent.Core.Mime import expand_idx_mimetype
 
-# future todo: forking + ipc (pipe?) to workers?
-# class ForkingHTTPServer(ForkingMixIn, HTTPServer):
-#
-#    def __init__(self, server_address, RequestHandlerClass):
-#        self.__setSocketFamilyAndTypeFrom(*server_address)
-#        super().__init__(server_address, RequestHandlerClass)
-#
-#    # set parameters based on whether address is IPv4 or IPv6
-#    def __setSocketFamilyAndTypeFrom(self, host, port):
-#        for af, socktype, *_ in getaddrinfo(host, port, AF_UNSPEC, SOCK_STREAM, 0, AI_PASSIVE):
-#            try:
-#                socket = createSocket(af, socktype)
-#            except OSError:
-#                continue
-#            socket.close()
-#            self.address_family = af  # pylint: disable=invalid-name
-#            self.socket_type = socktype  # pylint: disable=invalid-name
-#            return
-#        raise Exception('Could not create socket for %s:%s' % (host, port))
-
-
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-
-    def __init__(self, server_address, RequestHandlerClass):
+from .QAPIRemote import QAPIRemoteServer, QAPIManagerProxy
+from .ProcessSupervisor import ProcessSupervisor
+from .Cluster import HOP_HEADER
+from .QAPIWorker import AgentUnavailable
+from .Routes import RouteTable
+from .Codec import get_json_codec, get_binary_codecs
+from .WebSocket import (WebSocket, accept_key, OP_TEXT, OP_BINARY, OP_PING, CLOSE_GOING_AWAY, CLOSE_INVALID_DATA)
+
+
+class HTTPServerBase(HTTPServer):
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.__reuse_port = reuse_port
         self.__setSocketFamilyAndTypeFrom(*server_address)
         super().__init__(server_address, RequestHandlerClass)
 
-    # todo: test with ab default 5
-    request_queue_size = 16
+    def server_bind(self):
+        # Allows several processes to listen on the same port, see PreforkHTTPServer
+        if self.__reuse_port:
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def stop_accepting(self):
+        """First step of stopServer: no new connections, requests on open ones are still handled"""
+        self.shutdown()
 
     # set parameters based on whether address is IPv4 or IPv6
     def __setSocketFamilyAndTypeFrom(self, host, port):
@@ -88,6 +89,148 @@ class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
         raise Exception('Could not create socket for %s:%s' % (host, port))
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServerBase):
+
+    # todo: test with ab default 5
+    request_queue_size = 16
+    # stopServer drains QAPI calls in flight, don't also wait for idle keep-alive connections
+    daemon_threads = True
+    block_on_close = False
+
+
+class PooledHTTPServer(HTTPServerBase):
+    """Fixed number of handler threads fed from a bounded queue of accepted connections.  Connections arriving while
+    the queue is full are answered with 503 & Retry-After by a single thread using BusyHandlerClass.
+    """
+
+    request_queue_size = 64
+
+    def __init__(self, server_address, RequestHandlerClass, BusyHandlerClass, pool_size=32, queue_size=64,
+                 retry_after=1, reuse_port=False):
+        super().__init__(server_address, RequestHandlerClass, reuse_port=reuse_port)
+        self.BusyHandlerClass = BusyHandlerClass  # pylint: disable=invalid-name
+        self.retry_after = retry_after
+        self.__queue = Queue(maxsize=queue_size)
+        self.__busy = Queue(maxsize=queue_size)
+        self.__threads = [Thread(target=self.__run, args=(self.__queue, self.RequestHandlerClass),
+                                 name='HTTPPool-%d' % num, daemon=True)
+                          for num in range(pool_size)]
+        self.__threads.append(Thread(target=self.__run, args=(self.__busy, self.BusyHandlerClass),
+                                     name='HTTPBusy', daemon=True))
+        for thread in self.__threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.__queue.put_nowait((request, client_address))
+            return
+        except Full:
+            pass
+        logger.debug("Pool queue full, rejecting %s", client_address)
+        try:
+            self.__busy.put_nowait((request, client_address))
+        except Full:
+            self.shutdown_request(request)
+
+    def __run(self, queue, handler_class):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                handler_class(request, client_address, self)
+            except Exception:  # pylint: disable=broad-except
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # Connections still queued (not being handled) are closed, so the queues have room to stop every thread
+        for queue in (self.__queue, self.__busy):
+            while True:
+                try:
+                    request, _ = queue.get_nowait()
+                except Empty:
+                    break
+                self.shutdown_request(request)
+        for queue, count in ((self.__busy, 1), (self.__queue, len(self.__threads) - 1)):
+            for _ in range(count):
+                try:
+                    queue.put_nowait(None)
+                except Full:
+                    break
+        # Threads may be waiting on idle keep-alive connections (up to Handler.timeout)
+        deadline = monotonic() + self.RequestHandlerClass.timeout
+        for thread in self.__threads:
+            thread.join(max(0, deadline - monotonic()))
+
+
+class PreforkHTTPServer(object):
+    """Runs the server returned by make_server() in each of processes pre-forked children, all listening on the same
+    port (SO_REUSEPORT) so TLS handshakes and request encoding use more than one core.  QAPI calls made in the children
+    are forwarded to the QAPIManager in this process by remote (QAPIRemoteServer), None if make_server sets up its
+    own (e.g. QAPIShardProxy).
+
+    Same interface as the socketserver servers.  Children which exit unexpectedly are restarted with backoff (see
+    ProcessSupervisor, create before the QAPIManager is started), serve_forever() returns if all are given up on.
+    """
+
+    def __init__(self, server_address, make_server, remote, processes):
+        self.server_name = getfqdn(server_address[0])
+        self.server_port = server_address[1]
+        self.__make_server = make_server
+        self.__remote = remote
+        self.__stop = Event()
+        self.__is_shut_down = Event()
+        self.__is_shut_down.set()
+        self.__processes = ProcessSupervisor('HTTP', self.__child, processes)
+        self.__processes.start()
+        if remote is not None:
+            remote.start()
+
+    def __child(self, index):  # pylint: disable=unused-argument
+        # Interactive ^C is for the parent, which stops children with SIGTERM
+        signal(SIGINT, SIG_IGN)
+        stop = Event()
+        signal(SIGTERM, lambda *_: stop.set())
+        server = self.__make_server()
+        thread = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.2})
+        thread.start()
+        while thread.is_alive() and not stop.wait(0.5):
+            pass
+        stopServer(server, thread)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.__is_shut_down.clear()
+        try:
+            while not self.__stop.wait(poll_interval):
+                if not self.__processes.is_alive():
+                    logger.error("No HTTP processes left")
+                    break
+        finally:
+            self.__is_shut_down.set()
+
+    def stop_accepting(self):
+        # Children stop accepting (and drain) when sent SIGTERM by server_close
+        pass
+
+    def shutdown(self):
+        self.__stop.set()
+        self.__is_shut_down.wait()
+
+    def server_close(self):
+        self.__processes.stop()
+        if self.__remote is not None:
+            self.__remote.stop()
+
+
+class PayloadTooLarge(Exception):
+    """Request body (as sent or inflated) exceeds the Handler body limits"""
+    pass
+
+
 class Handler(BaseHTTPRequestHandler):
 
     # support multiple requests per connection
@@ -99,9 +242,53 @@ class Handler(BaseHTTPRequestHandler):
     # WARNING: This flag disables HTTPS transport.  Do not touch.
     __secure = True
 
-    __contentTypePattern = re_compile(r'^application/json; charset=utf-8$', re_I | re_A)
     __encodingTypePattern = re_compile(r'^deflate$', re_I | re_A)
 
+    __json = get_json_codec()
+    # Request body Content-Type & response Accept media types -> BodyCodec
+    __codecs = get_binary_codecs()
+    __codecs['application/json'] = __json
+    # Response codec for the current request (JSON unless negotiated otherwise)
+    __respCodec = None
+
+    # Response compression: bodies of at least __compressMin bytes are compressed if the client accepts it.
+    __compressMin = 1024
+    __compressLevel = 6
+    # Content-Encoding -> zlib wbits
+    __compressWbits = {'gzip': 16 + MAX_WBITS, 'deflate': MAX_WBITS}
+
+    # Response header lines & constant error bodies, built on first use (see __send_resp)
+    __statusLines = {}
+    __contentTypeLines = {}
+    __dateLine = (0, b'')
+    __errorBodies = {}
+
+    # Shutdown (see drain): QAPI calls in flight and whether new requests are refused.  Class state, always accessed
+    # through Handler (not cls/self) so that subclasses share it.
+    __inflight = 0
+    __inflightCond = Condition()
+    __draining = False
+    __drainTimeout = 10
+
+    # Request body limits (bytes): as sent (Content-Length) and after inflating Content-Encoding: deflate
+    __maxBody = 1048576
+    __maxBodyInflated = 4194304
+    # Compressed bodies are read & inflated this many bytes at a time
+    __bodyChunk = 65536
+
+    # Long-poll (GET /feeddata etc with wait): longest wait (seconds) allowed
+    __maxWait = 30
+
+    # Server-Sent Events (GET /stream): longest wait (seconds) for data before sending a keep-alive comment, which
+    # also notices clients gone away
+    __streamKeepalive = 15
+
+    # WebSocket (GET /ws): most share/ask/tell messages of a connection waiting for their result at once
+    __wsMaxInflight = 64
+
+    # Cluster mode: requests for epIds owned by other nodes are forwarded (or redirected) to them, see Cluster
+    __cluster = None
+
     @classmethod
     def setSecureMode(cls, secure_mode):
         cls.__secure = True
@@ -116,9 +303,78 @@ class Handler(BaseHTTPRequestHandler):
     def setQapiManager(cls, inst):
         cls.__qapiManager = inst
 
+    @classmethod
+    def setMaxWait(cls, max_wait):
+        cls.__maxWait = max_wait
+
+    @classmethod
+    def setCluster(cls, cluster):
+        cls.__cluster = cluster
+
+    @classmethod
+    def setJSONCodec(cls, codec):
+        cls.__json = codec
+        codecs = dict(cls.__codecs)
+        codecs['application/json'] = codec
+        cls.__codecs = codecs
+
+    @classmethod
+    def getJSONCodecName(cls):
+        return cls.__json.name
+
+    @classmethod
+    def setCompression(cls, min_size, level):
+        """min_size: smallest response body (bytes) to compress, 0 to disable"""
+        cls.__compressMin = min_size
+        cls.__compressLevel = level
+
+    @classmethod
+    def setBodyLimits(cls, max_body, max_inflated):
+        cls.__maxBody = max_body
+        cls.__maxBodyInflated = max_inflated
+
+    @classmethod
+    def getMaxBody(cls):
+        return cls.__maxBody
+
+    @classmethod
+    def setDrainTimeout(cls, timeout):
+        cls.__drainTimeout = timeout
+
+    @staticmethod
+    def drain(timeout=None):
+        """Refuses further requests (503, connection closed) and waits up to timeout (default setDrainTimeout) for
+        the QAPI calls in flight to be answered.  Returns how many are still in flight."""
+        deadline = monotonic() + (Handler.__drainTimeout if timeout is None else timeout)
+        with Handler.__inflightCond:
+            Handler.__draining = True
+            while Handler.__inflight:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                Handler.__inflightCond.wait(remaining)
+            return Handler.__inflight
+
+    @staticmethod
+    def __begin_call():
+        with Handler.__inflightCond:
+            if Handler.__draining:
+                return False
+            Handler.__inflight += 1
+            return True
+
+    @staticmethod
+    def _end_call():
+        with Handler.__inflightCond:
+            Handler.__inflight -= 1
+            if not Handler.__inflight:
+                Handler.__inflightCond.notify_all()
+
     def setup(self):
         # see https://docs.python.org/3/library/ssl.html#multi-processing
         RAND_add(urandom(1), 0.0)
+        # Bound the handshake too, not just reads after it
+        self.request.settimeout(self.timeout)
         #
         # HTTPS can be disabled by changing this hardcoded setting !
         if self.__secure:
@@ -134,51 +390,222 @@ class Handler(BaseHTTPRequestHandler):
     def __log(cmd, path, headers, body):
         logger.info("%s : %s : %s : %s", headers['epId'], cmd, path, body)
 
-    def _read_body(self):
+    def _read_raw_body(self):
+        """Returns the (decompressed) request body as bytes, None if empty or unreadable
+
+        Raises: PayloadTooLarge (the rest of the body is left unread and the connection will be closed)
+        """
         length = self.headers.get('Content-Length', '')
-        body = None
-        if (length.isnumeric() and
-                int(length) > 0 and
-                self.__contentTypePattern.match(self.headers.get('Content-Type', ''))):
-            try:
-                if self.__encodingTypePattern.match(self.headers.get('Content-Encoding', '')):
-                    body = decompress(self.rfile.read(int(length))).decode('utf-8')
-                else:
-                    body = self.rfile.read(int(length)).decode('utf-8')
-            except:
-                logger.warning('Failed to decode/parse body, ignoring')
-                body = None
-        #
-        if body is not None and len(body):
+        if not length.isnumeric() or int(length) == 0:
+            return None
+        length = int(length)
+        if length > self.__maxBody:
+            self.close_connection = True
+            raise PayloadTooLarge('Content-Length %d > %d' % (length, self.__maxBody))
+        try:
+            # Always consume the body, keep-alive connections would otherwise get out of sync
+            if self.__encodingTypePattern.match(self.headers.get('Content-Encoding', '')):
+                return self.__read_inflate(length) or None
+            body = self.rfile.read(length)
+        except PayloadTooLarge:
+            raise
+        except:
+            logger.warning('Failed to read/decompress body, ignoring')
+            self.close_connection = True
+            return None
+        if len(body) < length:
+            logger.warning('Short body (%d of %d bytes), ignoring', len(body), length)
+            self.close_connection = True
+            return None
+        return body
+
+    def __read_inflate(self, length):
+        """Reads & inflates length bytes of deflate compressed body chunk by chunk, stopping as soon as the inflated
+        size would exceed __maxBodyInflated"""
+        inflate = decompressobj()
+        limit = self.__maxBodyInflated
+        parts = []
+        size = 0
+        while length:
+            chunk = self.rfile.read(min(length, self.__bodyChunk))
+            if not chunk:
+                raise EOFError('body truncated')
+            length -= len(chunk)
+            # Asking for one byte more than allowed is enough to detect overflow without inflating further
+            part = inflate.decompress(chunk, limit - size + 1)
+            size += len(part)
+            if size > limit:
+                if length:
+                    self.close_connection = True
+                raise PayloadTooLarge('inflated body > %d' % limit)
+            parts.append(part)
+        part = inflate.flush()
+        size += len(part)
+        if size > limit:
+            raise PayloadTooLarge('inflated body > %d' % limit)
+        if not inflate.eof:
+            raise ZlibError('incomplete deflate stream')
+        parts.append(part)
+        return b''.join(parts)
+
+    def _read_body(self):
+        body = self._read_raw_body()
+        codec = self.__content_type_codec(self.headers.get('Content-Type', ''))
+        if body is not None and codec is None:
+            logger.warning('Unsupported Content-Type, ignoring body')
+        elif body is not None:
             try:
-                payload = loads(body)
+                return codec.loadb(body)
             except:
-                logger.error("Failed to json.loads payload")
-            return payload
-        return body
+                logger.error("Failed to decode %s payload", codec.name)
+        return None
 
-    def __send_resp(self, code, payload=None):  # todo: deflate large body
-        self.send_response(code)
-        try:
-            if payload is None:
-                self.send_header('Content-Length', 0)
-                self.end_headers()
+    @classmethod
+    def __content_type_codec(cls, header):
+        """Returns BodyCodec for Content-Type header value or None if not supported"""
+        media, _, params = header.partition(';')
+        codec = cls.__codecs.get(media.strip().lower())
+        if codec is not None and not codec.binary:
+            # JSON must be utf-8
+            params = params.strip().lower().replace(' ', '')
+            if params and params not in ('charset=utf-8', 'charset=utf8'):
+                return None
+        return codec
+
+    @classmethod
+    def __accept_codec(cls, header):
+        """Returns BodyCodec for the preferred supported media type in Accept header value, JSON if none"""
+        best, best_q = cls.__json, 0
+        for media, qval in cls.__qlist(header):
+            if media in ('*/*', 'application/*'):
+                codec = cls.__json
             else:
-                payload = dumps(payload).encode('utf-8')
-                self.send_header('Content-Type', 'application/json; charset=utf-8')
-                self.send_header('Content-Length', len(payload))
-                self.end_headers()
-                self.wfile.write(payload)
+                codec = cls.__codecs.get(media)
+            if codec is not None and qval > best_q:
+                best, best_q = codec, qval
+        return best
+
+    @staticmethod
+    def __qlist(header):
+        """Yields (lower case value, q) from Accept style header value"""
+        for item in header.split(','):
+            value, *params = item.split(';')
+            qval = 1.0
+            for param in params:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        qval = float(param[2:])
+                    except ValueError:
+                        qval = 0
+            yield value.strip().lower(), qval
+
+    def __send_resp(self, code, payload=None, body=None, retry_after=None):
+        """Writes status line, headers & body in one go.  body: payload already encoded with the response codec"""
+        self.log_request(code)
+        codec = self.__respCodec or self.__json
+        if body is None and payload is not None:
+            body = codec.dumpb(payload)
+        if Handler.__draining:
+            self.close_connection = True
+        head = [self.__status_line(code), self.__date_line()]
+        if self.close_connection:
+            head.append(b'Connection: close\r\n')
+        if retry_after is not None:
+            head.append(b'Retry-After: %d\r\n' % ceil(retry_after))
+        if body is None:
+            head.append(b'Content-Length: 0\r\n\r\n')
+        else:
+            head.append(self.__content_type_line(codec))
+            body = self.__compress(body, head)
+            head.append(b'Content-Length: %d\r\n\r\n' % len(body))
+            head.append(body)
+        try:
+            self.wfile.write(b''.join(head))
         except:
             logger.error("Failed to send_resp, client closed connection?")
 
-    def __path_arg(self, num):
+    def __send_busy(self):
+        """503 for a long-poll, stream or WebSocket refused by _acquire_poll"""
+        return self.__send_resp(503, {'error': 'busy', 'message': 'too many long-polls, streams & WebSockets'},
+                                retry_after=1)
+
+    def __send_relayed(self, code, headers, body=b''):
+        """Writes a response with the given (header, value) pairs, e.g. one relayed from another cluster node"""
+        self.log_request(code)
+        if Handler.__draining:
+            self.close_connection = True
+        head = [self.__status_line(code), self.__date_line()]
+        if self.close_connection:
+            head.append(b'Connection: close\r\n')
+        for name, value in headers:
+            head.append(('%s: %s\r\n' % (name, value)).encode('latin-1'))
+        head.append(b'Content-Length: %d\r\n\r\n' % len(body))
+        head.append(body)
         try:
-            args = self.path.split('/')
-            return parse.unquote(args[num])
+            self.wfile.write(b''.join(head))
         except:
-            pass
-        return None
+            logger.error("Failed to send_resp, client closed connection?")
+
+    def __send_error(self, code, message):
+        """Sends {'error': message}, message must be constant (the encoded body is cached)"""
+        codec = self.__respCodec or self.__json
+        try:
+            body = self.__errorBodies[(codec, message)]
+        except KeyError:
+            body = self.__errorBodies[(codec, message)] = codec.dumpb({'error': message})
+        return self.__send_resp(code, body=body)
+
+    def __status_line(self, code):
+        try:
+            return self.__statusLines[code]
+        except KeyError:
+            line = self.__statusLines[code] = ('%s %d %s\r\nServer: %s\r\n' % (
+                self.protocol_version, code, self.responses.get(code, ('',))[0], self.version_string())
+            ).encode('latin-1')
+            return line
+
+    def __date_line(self):
+        now = int(time())
+        cached = self.__dateLine
+        if cached[0] != now:
+            cached = Handler.__dateLine = (now, ('Date: %s\r\n' % self.date_time_string(now)).encode('latin-1'))
+        return cached[1]
+
+    def __content_type_line(self, codec):
+        try:
+            return self.__contentTypeLines[codec.content_type]
+        except KeyError:
+            line = self.__contentTypeLines[codec.content_type] = ('Content-Type: %s\r\n' %
+                                                                  codec.content_type).encode('latin-1')
+            return line
+
+    def __compress(self, body, head):
+        """Compresses body (appending Content-Encoding to head) if large enough and the client accepts gzip or
+        deflate"""
+        if not self.__compressMin or len(body) < self.__compressMin:
+            return body
+        encoding = self.__accept_encoding(self.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return body
+        comp = compressobj(self.__compressLevel, DEFLATED, self.__compressWbits[encoding])
+        body = comp.compress(body) + comp.flush()
+        head.append(b'Content-Encoding: %s\r\nVary: Accept-Encoding\r\n' % encoding.encode('ascii'))
+        return body
+
+    @classmethod
+    def __accept_encoding(cls, header):
+        """Returns preferred supported encoding from Accept-Encoding header value or None"""
+        best = None
+        best_q = 0
+        for coding, qval in cls.__qlist(header):
+            if coding == '*':
+                coding = 'gzip'
+            if coding not in cls.__compressWbits:
+                continue
+            if qval > best_q or (qval == best_q and coding == 'gzip'):
+                best, best_q = coding, qval
+        return best
 
     def __xrange(self):
         limit = None
@@ -196,14 +623,6 @@ class Handler(BaseHTTPRequestHandler):
             return self.headers['X-Language']
         return None
 
-    def __str_to_foc(self):
-        # todo: Things named feed with a control etc?
-        if 'feed' in self.path.lower():
-            return IoticAgentCore.Const.R_FEED
-        elif 'control' in self.path.lower():
-            return IoticAgentCore.Const.R_CONTROL
-        return None
-
     def __get_epid_headers(self):
         epId = self.headers['epId']
         if epId is None:
@@ -215,58 +634,203 @@ class Handler(BaseHTTPRequestHandler):
             authToken = self.headers['AuthToken']
         return epId, authToken
 
-    def __qapi_call(self, func, *args, **kwargs):  # noqa (complexity)
+    def __qapi_call(self, func, *args, **kwargs):
+        if not self.__begin_call():
+            self.close_connection = True
+            return self.__send_error(503, 'shutting down')
         try:
             epId, authToken = self.__get_epid_headers()
             evt = func(epId, authToken, *args, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            self._end_call()
+            return self.__qapi_error(exc)
+        return self._qapi_wait(evt)
+
+    def _qapi_wait(self, evt):
+        """Wait for the IoticAgent request event and respond.  Overridden by servers which do not want to block the
+        calling thread while the request completes (see AsyncServer), which must call _end_call() once answered."""
+        try:
             evt.wait(self.timeout)
+            return self._qapi_resp(evt)
+        finally:
+            self._end_call()
+
+    def _poll_wait(self, poll):
+        """Calls poll, which waits for collected data (up to the request's wait) and responds.  Overridden by servers
+        which do not want to block the calling thread meanwhile (see AsyncServer)."""
+        poll()
+
+    def _stream(self, chunks):
+        """Writes chunks (bytes from a generator which blocks waiting for data) until it ends or the client goes
+        away.  Overridden by servers which do not want to block the calling thread meanwhile (see AsyncServer)."""
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except OSError:
+            logger.debug("Stream client %s went away", self.client_address)
+        finally:
+            chunks.close()
+
+    def _websocket(self, ws, pump, idle):
+        """Carries ws over this connection until it is closed, running pump (which sends downstream messages until ws
+        is closed) on a thread of its own.  idle: seconds without anything from the client (pump pings it) before
+        giving up on it.  Overridden by servers which do not want to block the calling thread (see AsyncServer)."""
+        sock = self.connection
+        # Frames are queued by any thread and written by this one, TLS sockets can't be read & written concurrently.
+        # Results of messages (see _ws_result) are sent by this one too.
+        outgoing = deque()
+        completed = deque()
+        # [done, deadline] of the requests in flight, oldest (first to time out) first
+        self.__wsInflight = inflight = deque()
+        wake_r, wake_w = socketpair()
+        wake_w.setblocking(False)
+
+        def wake():
+            try:
+                wake_w.send(b'\0')
+            except OSError:
+                pass  # already woken (buffer full) or closed
+
+        def write(data):
+            outgoing.append(data)
+            wake()
+
+        def complete(entry):
+            completed.append(entry)
+            wake()
+
+        ws.write = write
+        self.__wsComplete = complete
+        Thread(target=pump, name='WebSocket-pump', daemon=True).start()
+        last_read = monotonic()
+        try:
+            while True:
+                while completed:
+                    self.__ws_done(completed.popleft())
+                now = monotonic()
+                while inflight and (inflight[0][0] is None or inflight[0][1] <= now):
+                    self.__ws_done(inflight.popleft())
+                while outgoing:
+                    self.wfile.write(outgoing.popleft())
+                if ws.closed:
+                    break
+                # Data already decrypted by TLS is not seen by select
+                pending = getattr(sock, 'pending', None)
+                if pending is None or not pending():
+                    timeout = max(0, idle - (now - last_read))
+                    if inflight:
+                        timeout = min(timeout, max(0, inflight[0][1] - now))
+                    readable = select([sock, wake_r], [], [], timeout)[0]
+                    if wake_r in readable:
+                        wake_r.recv(4096)
+                    if sock not in readable:
+                        if monotonic() - last_read > idle:
+                            break
+                        continue
+                data = sock.recv(65536)
+                if not data:
+                    break
+                last_read = monotonic()
+                ws.receive(data)
+            while outgoing:
+                self.wfile.write(outgoing.popleft())
+        except OSError:
+            logger.debug("WebSocket client %s went away", self.client_address)
+        finally:
+            ws.closed = True
+            # Results no longer sent, but their calls are no longer in flight (see _end_call)
+            while inflight:
+                self.__ws_done(inflight.popleft())
+            wake_r.close()
+            wake_w.close()
+
+    def _ws_result(self, evt, done):
+        """Calls done (which sends the result of a WebSocket message) once the IoticAgent request event is set or
+        timed out, without blocking the caller.  Overridden by servers which carry WebSockets themselves (see
+        AsyncServer)."""
+        entry = [done, monotonic() + self.timeout]
+        self.__wsInflight.append(entry)
+        run_on_completion = getattr(evt, '_run_on_completion', None)
+        if run_on_completion is None:
+            Thread(target=lambda: (evt.wait(self.timeout), self.__wsComplete(entry)), daemon=True).start()
+        else:
+            run_on_completion(lambda evt: self.__wsComplete(entry))
+
+    @staticmethod
+    def __ws_done(entry):
+        done, entry[0] = entry[0], None
+        if done is not None:
+            done()
+
+    def _acquire_poll(self):
+        """Returns whether a long-poll, event stream or WebSocket may start now.  Servers running those on a bounded
+        pool (see AsyncServer) count them & refuse once it is full."""
+        return True
+
+    def _qapi_resp(self, evt):
+        try:
             if evt.is_set():
-                mtype = IoticAgentCore.Const.E_FAILED
-                if evt.success:
-                    mtype = IoticAgentCore.Const.E_COMPLETE
-                payload = evt.payload
-                for em in evt._messages:
-                    crud = [IoticAgentCore.Const.E_CREATED,
-                            IoticAgentCore.Const.E_DUPLICATED,
-                            IoticAgentCore.Const.E_RENAMED,
-                            IoticAgentCore.Const.E_DELETED,
-                            IoticAgentCore.Const.E_REASSIGNED]
-                    if evt.is_crud and em[IoticAgentCore.Const.M_TYPE] in crud:
-                        mtype = em[IoticAgentCore.Const.M_TYPE]
-                        payload = em[IoticAgentCore.Const.M_PAYLOAD]
-                        break
-                    elif em[IoticAgentCore.Const.M_TYPE] == IoticAgentCore.Const.E_RECENTDATA:
-                        if payload is None:
-                            payload = {'samples': []}
-                        if 'samples' in em[IoticAgentCore.Const.M_PAYLOAD]:
-                            for sample in em[IoticAgentCore.Const.M_PAYLOAD]['samples']:
-                                data, mime = self.__bytes_to_share_data(sample)
-                                payload['samples'].append({'data': data, 'mime': mime, 'time': sample['time']})
-                        else:
-                            logger.warning("Message type E_RECENTDATA but no samples?")
-                if payload and 'samples' in payload:
-                    # If recent data then ensure no bytes left in payload before __send_resp!
-                    payload['samples'] = self.__data_payload_to_b64(payload['samples'])
-                code = 200  # sync' request OK
-                if mtype == IoticAgentCore.Const.E_CREATED:
-                    code = 201
-                elif mtype == IoticAgentCore.Const.E_DELETED:
-                    code = 204
-                return self.__send_resp(code, {IoticAgentCore.Const.M_PAYLOAD: payload,
-                                               IoticAgentCore.Const.M_TYPE: mtype})
-            else:
-                logger.warning("IoticAgent request timeout!")
-                return self.__send_resp(500, {'error': 'request timeout'})
-        except KeyError:
-            return self.__send_resp(403, {'error': 'no such epId'})
-        except ValueError as exc:
-            return self.__send_resp(400, {'error': 'malformed', 'message': str(exc)})
-        except LinkException as exc:
-            logger.exception("IoticAgent linkerror")
-            return self.__send_resp(500, {'error': 'linkerror', 'message': str(exc)})
+                return self.__send_resp(*self.__qapi_result(evt))
+            logger.warning("IoticAgent request timeout!")
+            return self.__send_error(500, 'request timeout')
         except Exception as exc:  # pylint: disable=broad-except
-            logger.exception("IoticAgent Exception")
-            return self.__send_resp(500, {'error': 'internal error', 'message': str(exc)})
+            return self.__qapi_error(exc)
+
+    def __qapi_result(self, evt):  # noqa (complexity)
+        """Returns (status code, payload) for a completed IoticAgent request event"""
+        mtype = IoticAgentCore.Const.E_FAILED
+        if evt.success:
+            mtype = IoticAgentCore.Const.E_COMPLETE
+        payload = evt.payload
+        for em in evt._messages:
+            crud = [IoticAgentCore.Const.E_CREATED,
+                    IoticAgentCore.Const.E_DUPLICATED,
+                    IoticAgentCore.Const.E_RENAMED,
+                    IoticAgentCore.Const.E_DELETED,
+                    IoticAgentCore.Const.E_REASSIGNED]
+            if evt.is_crud and em[IoticAgentCore.Const.M_TYPE] in crud:
+                mtype = em[IoticAgentCore.Const.M_TYPE]
+                payload = em[IoticAgentCore.Const.M_PAYLOAD]
+                break
+            elif em[IoticAgentCore.Const.M_TYPE] == IoticAgentCore.Const.E_RECENTDATA:
+                if payload is None:
+                    payload = {'samples': []}
+                if 'samples' in em[IoticAgentCore.Const.M_PAYLOAD]:
+                    for sample in em[IoticAgentCore.Const.M_PAYLOAD]['samples']:
+                        data, mime = self.__bytes_to_share_data(sample)
+                        payload['samples'].append({'data': data, 'mime': mime, 'time': sample['time']})
+                else:
+                    logger.warning("Message type E_RECENTDATA but no samples?")
+        if payload and 'samples' in payload:
+            # If recent data then ensure no bytes left in payload before __send_resp!
+            payload['samples'] = self.__encode_data(payload['samples'])
+        code = 200  # sync' request OK
+        if mtype == IoticAgentCore.Const.E_CREATED:
+            code = 201
+        elif mtype == IoticAgentCore.Const.E_DELETED:
+            code = 204
+        return code, {IoticAgentCore.Const.M_PAYLOAD: payload, IoticAgentCore.Const.M_TYPE: mtype}
+
+    def __qapi_error(self, exc):
+        code, error, message, retry_after = self.__error_result(exc)
+        if message is None:
+            return self.__send_error(code, error)
+        return self.__send_resp(code, {'error': error, 'message': message}, retry_after=retry_after)
+
+    @staticmethod
+    def __error_result(exc):
+        """Returns (status code, error, message or None, retry_after or None) for an exception of a QAPI call"""
+        if isinstance(exc, KeyError):
+            return 403, 'no such epId', None, None
+        elif isinstance(exc, ValueError):
+            return 400, 'malformed', str(exc), None
+        elif isinstance(exc, AgentUnavailable):
+            return 503, 'agent unavailable', str(exc), exc.retry_after
+        elif isinstance(exc, LinkException):
+            logger.error("IoticAgent linkerror", exc_info=exc)
+            return 500, 'linkerror', str(exc), None
+        logger.error("IoticAgent Exception", exc_info=exc)
+        return 500, 'internal error', str(exc), None
 
     @classmethod
     def __bytes_to_share_data(cls, payload):
@@ -294,206 +858,108 @@ class Handler(BaseHTTPRequestHandler):
         self.send_header('Content-Length', 0)
         self.end_headers()
 
-    def do_POST(self):  # pylint: disable=too-many-return-statements
-        payload = self._read_body()
-        self.__log('POST', self.path, self.headers, payload)
-        #
-        lang = self.__xlang()
-        limit, offset = self.__xrange()
-        if payload is None:
-            return self.__send_resp(410, {'error': 'empty payload or could not decode'})
-        elif self.path.startswith('/entity'):
-            return self.__do_POST_entity(payload, lang)
-        elif self.path.startswith('/point'):
-            return self.__do_POST_point(payload, lang)
-        elif self.path.startswith('/value'):
-            foc = self.__str_to_foc()
-            lid = self.__path_arg(3)
-            pid = self.__path_arg(4)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_value_create,
-                lid,
-                pid,
-                foc,
-                payload['label'] if 'label' in payload else '',
-                payload['vtype'] if 'vtype' in payload else '',
-                payload['lang'] if 'lang' in payload else None,
-                payload['comment'] if 'comment' in payload else None,
-                payload['unit'] if 'unit' in payload else None)
-        elif self.path.startswith('/sub'):
-            return self.__do_POST_sub(payload)
-        elif self.path.startswith('/search'):
-            return self.__qapi_call(
-                self.__qapiManager.request_search,
-                text=payload['text'] if 'text' in payload else None,
-                lang=payload['lang'] if 'lang' in payload else None,
-                location=payload['location'] if 'location' in payload else None,
-                unit=payload['unit'] if 'unit' in payload else None,
-                type_=payload['type'] if 'type' in payload else 'full',
-                local=payload['local'] if 'local' in payload else False,
-                limit=limit,
-                offset=offset)
-        elif self.path.startswith('/describe'):
-            return self.__qapi_call(
-                self.__qapiManager.request_describe,
-                payload['guid'] if 'guid' in payload else '',
-                local=payload['local'] if 'local' in payload else False)
-        else:
-            return self.__send_resp(405, {'error': 'invalid resource'})
-
-    def __do_POST_entity(self, payload, lang):
-        if self.path == '/entity':
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_create,
-                payload['lid'] if 'lid' in payload else None,
-                tepid=payload['epId'] if 'epId' in payload else None)
-        elif self.path.endswith('/tag'):
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_tag_update,
-                lid,
-                payload['tags'] if 'tags' in payload else [])
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(2)
-            code, resp = RDFHelper.add_meta_entity_tags(self.__qapiManager,
-                                                        epId,
-                                                        authToken,
-                                                        lid,
-                                                        payload['tags'] if 'tags' in payload else [])
-            self.__send_resp(code, resp)
-        #
-        else:
-            return self.__send_resp(400, {'error': 'malformed'})
-
-    def __do_POST_point(self, payload, lang):
-        foc = self.__str_to_foc()
-        if self.path.endswith('/tag'):
-            lid = self.__path_arg(3)
-            pid = self.__path_arg(4)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_tag_update,
-                foc,
-                lid,
-                pid,
-                payload['tags'] if 'tags' in payload else '')
-        elif self.path.endswith('/share'):
-            lid = self.__path_arg(2)
-            pid = self.__path_arg(3)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_share,
-                lid,
-                pid,
-                payload['data'] if 'data' in payload else '',
-                payload['mime'] if 'mime' in payload else None)
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(3)
-            pid = self.__path_arg(4)
-            code, resp = RDFHelper.add_meta_point_tags(self.__qapiManager,
-                                                       epId,
-                                                       authToken,
-                                                       foc,
-                                                       lid,
-                                                       pid,
-                                                       payload['tags'] if 'tags' in payload else [])
-            self.__send_resp(code, resp)
-        #
-        else:
-            return self.__qapi_call(
-                self.__qapiManager.request_point_create,
-                foc,
-                payload['lid'] if 'lid' in payload else '',
-                payload['pid'] if 'pid' in payload else '',
-                save_recent=payload['saveRecent'] if 'saveRecent' in payload else 0)
-
-
-    def __do_POST_sub(self, payload):
-        foc = self.__str_to_foc()
-        lid = self.__path_arg(3)
-        if self.path.endswith('/ask'):
-            subid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_ask,
-                subid,
-                payload['data'] if 'data' in payload else '',
-                payload['mime'] if 'mime' in payload else None)
-        elif self.path.endswith('/tell'):
-            subid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_tell,
-                subid,
-                payload['data'] if 'data' in payload else '',
-                payload['mime'] if 'mime' in payload else None)
-        elif 'gpid' in payload:
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_create,
-                lid,
-                foc,
-                payload['gpid'])
-        elif 'slid' in payload:
-            pid = self.__path_arg(4)
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_create_local,
-                payload['slid'],
-                foc,
-                lid,
-                pid)
-        else:
-            return self.__send_resp(400, {'error': 'malformed'})
+    def do_POST(self):
+        self.__dispatch('POST')
 
-    def do_GET(self):  # pylint: disable=too-many-return-statements
-        payload = self._read_body()
-        self.__log('GET', self.path, self.headers, payload)
-        #
-        lang = self.__xlang()
-        limit, offset = self.__xrange()
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_PUT(self):
+        self.__dispatch('PUT')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def __dispatch(self, method):
+        self.__respCodec = self.__accept_codec(self.headers.get('Accept', ''))
+        if self.__cluster is not None:
+            epId = self.__get_epid_headers()[0]
+            if epId is not None and not self.__cluster.owns(epId):
+                return self.__cluster_request(method, epId)
+        route, ctx = self.__routes.match(method, self.path)
+        try:
+            if route is not None and route.raw:
+                payload = self._read_raw_body()
+                self.__log(method, self.path, self.headers, '<%d bytes>' % len(payload) if payload else None)
+            else:
+                payload = self._read_body()
+                self.__log(method, self.path, self.headers, payload)
+        except PayloadTooLarge as exc:
+            logger.warning("%s : %s : %s : rejected, %s", self.headers['epId'], method, self.path, exc)
+            return self.__send_error(413, 'payload too large')
         #
-        if self.path.startswith('/entity'):
-            return self.__do_GET_entity(lang, limit, offset)
-        elif self.path.startswith('/point'):
-            return self.__do_GET_point(lang, limit, offset)
-        elif self.path.startswith('/value'):
-            foc = self.__str_to_foc()
-            lid = self.__path_arg(3)
-            pid = self.__path_arg(4)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_value_list,
-                lid,
-                pid,
-                foc,
-                limit=limit,
-                offset=offset)
-        elif self.path.startswith('/sub'):
-            return self.__do_GET_sub(limit, offset)
-        elif self.path == '/feeddata':
-            return self.__send_resp(200, self.__data_payload_to_b64(
-                self.__qapiManager.get_feeddata(self.headers['epId'], self.headers['authToken'])))
-        elif self.path == '/controlreq':
-            return self.__send_resp(200, self.__data_payload_to_b64(
-                self.__qapiManager.get_controlreq(self.headers['epId'], self.headers['authToken'])))
-        elif self.path == '/unsolicited':
-            return self.__send_resp(200, self.__data_payload_to_b64(
-                self.__qapiManager.get_unsolicited(self.headers['epId'], self.headers['authToken'])))
-        else:
-            return self.__send_resp(405, {'error': 'invalid resource'})
+        if payload is None and method in ('POST', 'PUT'):
+            return self.__send_error(410, 'empty payload or could not decode')
+        if route is None:
+            if self.__routes.is_resource(method, ctx):
+                return self.__send_error(400, 'malformed')
+            return self.__send_error(405, 'invalid resource')
+        ctx.lang = self.__xlang()
+        ctx.limit, ctx.offset = self.__xrange()
+        return route.handler(self, ctx, payload)
+
+    def __cluster_request(self, method, epId):
+        """Forwards the request for epId to the node owning it, or redirects the client there"""
+        try:
+            body = self._read_raw_body()
+        except PayloadTooLarge as exc:
+            logger.warning("%s : %s : %s : rejected, %s", epId, method, self.path, exc)
+            return self.__send_error(413, 'payload too large')
+        owner = self.__cluster.owner(epId)
+        if HOP_HEADER in self.headers:
+            # The sending node thinks we own epId, e.g. while [cluster] nodes is being changed on all nodes
+            return self.__qapi_error(AgentUnavailable('cluster nodes disagree on owner of epId', retry_after=1))
+        route, ctx = self.__routes.match(method, self.path)
+        # Event streams & WebSockets are not carried by forwarding
+        if self.__cluster.redirect or (route is not None and route.handler in (Handler.__stream, Handler.__websocket)):
+            return self.__send_relayed(307, [('Location', owner + self.path)])
+        if not self.__begin_call():
+            self.close_connection = True
+            return self.__send_error(503, 'shutting down')
+        # The forward waits for the owner (a long-poll up to its wait), not on a thread routing requests
+        if not self._acquire_poll():
+            self._end_call()
+            return self.__send_busy()
+        try:
+            # The owner answers long-polls once their wait is over
+            wait = self.__wait(ctx)
+        except ValueError:
+            wait = 0
+        # The body has been inflated already
+        headers = [(name, value) for name, value in self.headers.items() if name.lower() != 'content-encoding']
+
+        def forward():
+            try:
+                logger.info("%s : %s : %s : forwarding to %s", epId, method, self.path, owner)
+                try:
+                    relayed = self.__cluster.forward(owner, method, self.path, headers, body, wait=wait)
+                except (OSError, HTTPException) as exc:
+                    logger.warning("Failed to forward to %s: %r", owner, exc)
+                    return self.__qapi_error(AgentUnavailable('cluster node %s unavailable' % owner, retry_after=1))
+                return self.__send_relayed(*relayed)
+            finally:
+                self._end_call()
+
+        return self._poll_wait(forward)
+
+    def __encode_data(self, datalist):
+        """Share data bytes have to be base64 encoded for JSON responses"""
+        if self.__respCodec is not None and self.__respCodec.binary:
+            return datalist
+        return self.__data_payload_to_b64(datalist)
 
     def __data_payload_to_b64(self, datalist):
+        """Returns copies of the rows with data encoded, the rows may still be kept by the worker"""
         ret = []
         for row in datalist:
-            if isinstance(row['data'], bytes):
-                row['data'] = 'base64/' + b64encode(row['data']).decode('ascii')
-            elif isinstance(row['data'], dict):
-                row['data'] = self.__dict_to_b64(row['data'])
-            elif isinstance(row['data'], list):
+            data = row['data']
+            if isinstance(data, bytes):
+                row = dict(row, data='base64/' + b64encode(data).decode('ascii'))
+            elif isinstance(data, dict):
+                row = dict(row, data=self.__dict_to_b64(data))
+            elif isinstance(data, list):
                 # todo: data payload can be list ?
-                row['data'] = self.__list_to_b64(row['data'])
+                row = dict(row, data=self.__list_to_b64(data))
             ret.append(row)
         return ret
 
@@ -521,300 +987,724 @@ class Handler(BaseHTTPRequestHandler):
             ret.append(value)
         return ret
 
-    def __do_GET_entity(self, lang, limit, offset):  # pylint: disable=too-many-return-statements
-        if self.path == '/entity':
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_list,
-                limit=limit,
-                offset=offset)
-        elif self.path.endswith('/all'):
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_list_all,
-                limit=limit,
-                offset=offset)
-        elif self.path.endswith('/meta'):
-            lid = self.__path_arg(2)
-            fmt = self.__path_arg(3)
-            if fmt == 'meta':
-                fmt = 'n3'
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_meta_get,
-                lid,
-                fmt)
-        elif self.path.endswith('/tag'):
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_tag_list,
-                lid,
-                limit=limit,
-                offset=offset)
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(2)
-            code, resp = RDFHelper.get_meta_entity_tags(self.__qapiManager, epId, authToken, lid, limit=limit,
-                                                        offset=offset)
-            self.__send_resp(code, resp)
-        elif rdflib is not None and self.path.endswith('/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(2)
-            code, resp = RDFHelper.get_meta_entity(self.__qapiManager, epId, authToken, lid, lang)
-            self.__send_resp(code, resp)
-        #
+    def __metahelper(self, ctx, func, *args, **kwargs):
+        """Special RDFHelper functions (only routed if rdflib is available), which wait for their QAPI calls"""
+        if not self.__begin_call():
+            self.close_connection = True
+            return self.__send_error(503, 'shutting down')
+        try:
+            try:
+                epId, authToken = self.__get_epid_headers()
+                code, resp = func(self.__qapiManager, epId, authToken, *args, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                return self.__qapi_error(exc)
+            return self.__send_resp(code, resp)
+        finally:
+            self._end_call()
+
+    def __need_lang(self, ctx):
+        if ctx.lang is None:
+            self.__send_error(400, 'X-Language must be specified for metahelper functions')
+            return True
+        return False
+
+    # Entity
+
+    def __entity_create(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_create,
+            payload['lid'] if 'lid' in payload else None,
+            tepid=payload['epId'] if 'epId' in payload else None)
+
+    def __entity_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_list,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __entity_list_all(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_list_all,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __entity_delete(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_delete,
+            ctx.lid)
+
+    def __entity_rename(self, ctx, payload):
+        if 'newlid' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_rename,
+            ctx.lid,
+            payload['newlid'])
+
+    def __entity_reassign(self, ctx, payload):
+        if 'epId' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_reassign,
+            ctx.lid,
+            payload['epId'])
+
+    def __entity_meta_get(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_meta_get,
+            ctx.lid,
+            ctx.fmt or 'n3')
+
+    def __entity_meta_set(self, ctx, payload):
+        if 'meta' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_meta_set,
+            ctx.lid,
+            payload['meta'],
+            ctx.fmt or 'n3')
+
+    def __entity_setpublic(self, ctx, payload):
+        if 'public' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_meta_setpublic,
+            ctx.lid,
+            payload['public'])
+
+    def __entity_tag_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_tag_list,
+            ctx.lid,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __entity_tag_update(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_tag_update,
+            ctx.lid,
+            payload['tags'] if 'tags' in payload else [])
+
+    def __entity_tag_delete(self, ctx, payload):
+        if payload is None:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_entity_tag_update,
+            ctx.lid,
+            payload['tags'] if 'tags' in payload else [],
+            delete=True)
+
+    def __entity_metahelper_get(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.get_meta_entity, ctx.lid, ctx.lang)
+
+    def __entity_metahelper_set(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.set_meta_entity, ctx.lid, payload, ctx.lang)
+
+    def __entity_metahelper_tags_get(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.get_meta_entity_tags, ctx.lid, limit=ctx.limit, offset=ctx.offset)
+
+    def __entity_metahelper_tags_add(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.add_meta_entity_tags, ctx.lid,
+                                 payload['tags'] if 'tags' in payload else [])
+
+    def __entity_metahelper_tags_delete(self, ctx, payload):
+        if payload is None:
+            return self.__send_error(400, 'malformed')
+        return self.__metahelper(ctx, RDFHelper.del_meta_entity_tags, ctx.lid,
+                                 payload['tags'] if 'tags' in payload else [])
+
+    # Point
+
+    def __point_create(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_create,
+            ctx.foc,
+            payload['lid'] if 'lid' in payload else '',
+            payload['pid'] if 'pid' in payload else '',
+            save_recent=payload['saveRecent'] if 'saveRecent' in payload else 0)
+
+    def __point_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_list,
+            ctx.foc,
+            ctx.lid,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __point_list_detailed(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_list_detailed,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid)
+
+    def __point_rename(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_rename,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            payload['newpid'] if 'newpid' in payload else '')
+
+    def __point_delete(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_delete,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid)
+
+    def __point_meta_get(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_meta_get,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            ctx.fmt or 'n3')
+
+    def __point_meta_set(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_meta_set,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            payload['meta'] if 'meta' in payload else '',
+            ctx.fmt or 'n3')
+
+    def __point_tag_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_tag_list,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __point_tag_update(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_tag_update,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            payload['tags'] if 'tags' in payload else '')
+
+    def __point_tag_delete(self, ctx, payload):
+        if payload is None:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_point_tag_update,
+            ctx.foc,
+            ctx.lid,
+            ctx.pid,
+            payload['tags'] if 'tags' in payload else '',
+            delete=True)
+
+    def __point_share(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_share,
+            ctx.lid,
+            ctx.pid,
+            payload['data'] if 'data' in payload else '',
+            payload['mime'] if 'mime' in payload else None)
+
+    def __point_share_raw(self, ctx, payload):
+        # payload is the body as-is, its media type (with any parameters) becomes the share mime
+        return self.__qapi_call(
+            self.__qapiManager.request_point_share,
+            ctx.lid,
+            ctx.pid,
+            payload,
+            self.headers.get('Content-Type') or 'application/octet-stream')
+
+    def __point_metahelper_get(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.get_meta_point, ctx.foc, ctx.lid, ctx.pid, ctx.lang)
+
+    def __point_metahelper_set(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.set_meta_point, ctx.foc, ctx.lid, ctx.pid, payload, ctx.lang)
+
+    def __point_metahelper_tags_get(self, ctx, payload):
+        return self.__metahelper(ctx, RDFHelper.get_meta_point_tags, ctx.foc, ctx.lid, ctx.pid,
+                                 limit=ctx.limit, offset=ctx.offset)
+
+    def __point_metahelper_tags_add(self, ctx, payload):
+        if self.__need_lang(ctx):
+            return
+        return self.__metahelper(ctx, RDFHelper.add_meta_point_tags, ctx.foc, ctx.lid, ctx.pid,
+                                 payload['tags'] if 'tags' in payload else [])
+
+    def __point_metahelper_tags_delete(self, ctx, payload):
+        if payload is None:
+            return self.__send_error(400, 'malformed')
+        return self.__metahelper(ctx, RDFHelper.del_meta_point_tags, ctx.foc, ctx.lid, ctx.pid,
+                                 payload['tags'] if 'tags' in payload else [])
+
+    # Value
+
+    def __value_create(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_value_create,
+            ctx.lid,
+            ctx.pid,
+            ctx.foc,
+            payload['label'] if 'label' in payload else '',
+            payload['vtype'] if 'vtype' in payload else '',
+            payload['lang'] if 'lang' in payload else None,
+            payload['comment'] if 'comment' in payload else None,
+            payload['unit'] if 'unit' in payload else None)
+
+    def __value_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_value_list,
+            ctx.lid,
+            ctx.pid,
+            ctx.foc,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __value_delete(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_point_value_delete,
+            ctx.lid,
+            ctx.pid,
+            ctx.foc,
+            ctx.label)
+
+    # Subscription
+
+    def __sub_create(self, ctx, payload):
+        if 'gpid' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_create,
+            ctx.lid,
+            ctx.foc,
+            payload['gpid'])
+
+    def __sub_create_local(self, ctx, payload):
+        if 'slid' not in payload:
+            return self.__send_error(400, 'malformed')
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_create_local,
+            payload['slid'],
+            ctx.foc,
+            ctx.lid,
+            ctx.pid)
+
+    def __sub_ask(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_ask,
+            ctx.subid,
+            payload['data'] if 'data' in payload else '',
+            payload['mime'] if 'mime' in payload else None)
+
+    def __sub_tell(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_tell,
+            ctx.subid,
+            payload['data'] if 'data' in payload else '',
+            self.timeout,
+            payload['mime'] if 'mime' in payload else None)
+
+    def __sub_list(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_list,
+            ctx.lid,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __sub_recent(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_recent,
+            ctx.subid,
+            count=ctx.count)
+
+    def __sub_delete(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_sub_delete,
+            ctx.subid)
+
+    # Search & describe
+
+    def __search(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_search,
+            text=payload['text'] if 'text' in payload else None,
+            lang=payload['lang'] if 'lang' in payload else None,
+            location=payload['location'] if 'location' in payload else None,
+            unit=payload['unit'] if 'unit' in payload else None,
+            type_=payload['type'] if 'type' in payload else 'full',
+            local=payload['local'] if 'local' in payload else False,
+            limit=ctx.limit,
+            offset=ctx.offset)
+
+    def __describe(self, ctx, payload):
+        return self.__qapi_call(
+            self.__qapiManager.request_describe,
+            payload['guid'] if 'guid' in payload else '',
+            local=payload['local'] if 'local' in payload else False)
+
+    # Data collected by the QAPIWorker
+
+    def __since(self, ctx):
+        """since query parameter (sequence number of the last item the client has), None if not given"""
+        if 'since' not in ctx.query:
+            return None
+        try:
+            return max(0, int(ctx.query['since'][0]))
+        except ValueError:
+            raise ValueError('since must be an integer')
+
+    def __wait(self, ctx):
+        """Seconds to wait for data if there is none, from the wait query parameter or Prefer: wait=<seconds> header
+        (at most setMaxWait), 0 for none"""
+        value = None
+        if 'wait' in ctx.query:
+            value = ctx.query['wait'][0]
         else:
-            return self.__send_resp(400, {'error': 'malformed'})
-
-    def __do_GET_point(self, lang, limit, offset):
-        foc = self.__str_to_foc()
-        lid = self.__path_arg(3)
-        pid = self.__path_arg(4)
-        if self.path.endswith('/meta'):
-            fmt = self.__path_arg(5)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_meta_get,
-                foc,
-                lid,
-                pid,
-                fmt)
-        elif self.path.endswith('/tag'):
-            return self.__qapi_call(
-                self.__qapiManager.request_point_tag_list,
-                foc,
-                lid,
-                pid,
-                limit=limit,
-                offset=offset)
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
+            for pref in self.headers.get('Prefer', '').split(','):
+                name, _, pref_value = pref.partition('=')
+                if name.strip().lower() == 'wait':
+                    value = pref_value.strip()
+        if value is None:
+            return 0
+        try:
+            wait = float(value)
+        except ValueError:
+            raise ValueError('wait must be a number of seconds')
+        return min(max(0, wait), self.__maxWait)
+
+    def __collected(self, ctx, func, **filters):
+        try:
+            since = self.__since(ctx)
+            wait = self.__wait(ctx)
             epId, authToken = self.__get_epid_headers()
-            code, resp = RDFHelper.get_meta_point_tags(self.__qapiManager,
-                                                       epId,
-                                                       authToken,
-                                                       foc,
-                                                       lid,
-                                                       pid,
-                                                       limit=limit,
-                                                       offset=offset)
-            self.__send_resp(code, resp)
-        elif rdflib is not None and self.path.endswith('/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
+            rows = func(epId, authToken, since=since, **filters)
+        except Exception as exc:  # pylint: disable=broad-except
+            return self.__qapi_error(exc)
+        if rows or not wait:
+            return self.__send_resp(200, self.__encode_data(rows))
+        if Handler.__draining:
+            self.close_connection = True
+            return self.__send_error(503, 'shutting down')
+        if not self._acquire_poll():
+            return self.__send_busy()
+
+        def poll():
+            try:
+                rows = func(epId, authToken, since=since, wait=wait, **filters)
+            except Exception as exc:  # pylint: disable=broad-except
+                return self.__qapi_error(exc)
+            return self.__send_resp(200, self.__encode_data(rows))
+
+        return self._poll_wait(poll)
+
+    def __stream(self, ctx, payload):
+        """Server-Sent Events: feeddata, controlreq & unsolicited items as they arrive, with their seq as event id
+        (resumed from Last-Event-ID).  Ends once the agent is no longer available (e.g. removed from the config)."""
+        try:
+            since = self.headers.get('Last-Event-ID')
+            since = self.__since(ctx) if since is None else int(since)
             epId, authToken = self.__get_epid_headers()
-            code, resp = RDFHelper.get_meta_point(self.__qapiManager, epId, authToken, foc, lid, pid, lang)
-            self.__send_resp(code, resp)
-        #
-        else:
-            if pid is not None:
-                return self.__qapi_call(
-                    self.__qapiManager.request_point_list_detailed,
-                    foc,
-                    lid,
-                    pid)
-            else:
-                return self.__qapi_call(
-                    self.__qapiManager.request_point_list,
-                    foc,
-                    lid,
-                    limit=limit,
-                    offset=offset)
-
-    def __do_GET_sub(self, limit, offset):
-        if self.path.endswith('/recent'):
-            sub_id = self.__path_arg(2)
-            count = self.__path_arg(3)
-            if count == 'recent':
-                count = None
+            # Checks the agent & authToken before the response starts
+            events = self.__qapiManager.get_events(epId, authToken, since=since or 0)
+        except Exception as exc:  # pylint: disable=broad-except
+            return self.__qapi_error(exc)
+        if not self._acquire_poll():
+            return self.__send_busy()
+        self.log_request(200)
+        self.close_connection = True
+        return self._stream(self.__event_stream(epId, authToken, since or 0, events))
+
+    def __event_stream(self, epId, authToken, since, events):
+        chunked = self.request_version != 'HTTP/1.0'
+        head = [self.__status_line(200), self.__date_line(),
+                b'Content-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n']
+        if chunked:
+            head.append(b'Transfer-Encoding: chunked\r\n')
+        head.append(b'\r\n')
+        yield b''.join(head)
+        while True:
+            if events:
+                since = events[-1][0]
+                body = b''.join(b'id: %d\nevent: %s\ndata: %s\n\n' % (
+                    seq, kind.encode('ascii'), self.__json.dumpb(self.__data_payload_to_b64([row])[0])
+                ) for seq, kind, row in events)
             else:
+                body = b': keep-alive\n\n'
+            yield b'%x\r\n%s\r\n' % (len(body), body) if chunked else body
+            if Handler.__draining:
+                break
+            try:
+                events = self.__qapiManager.get_events(epId, authToken, since=since, wait=self.__streamKeepalive)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.info("%s : ending stream, %r", epId, exc)
+                break
+        if chunked:
+            yield b'0\r\n\r\n'
+
+    def __websocket(self, ctx, payload):
+        """WebSocket carrying shares, asks & tells from the client and feeddata, controlreq & unsolicited items to it
+        (see README.md).  Browsers can't set headers on WebSockets, epId & authToken can be query parameters."""
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or \
+                'upgrade' not in self.headers.get('Connection', '').lower():
+            return self.__send_error(400, 'websocket upgrade required')
+        if self.headers.get('Sec-WebSocket-Version') != '13':
+            return self.__send_relayed(426, [('Sec-WebSocket-Version', '13')])
+        key = self.headers.get('Sec-WebSocket-Key')
+        if not key:
+            return self.__send_error(400, 'malformed')
+        epId, authToken = self.__get_epid_headers()
+        if epId is None:
+            epId = ctx.query.get('epId', [None])[0]
+        if authToken is None:
+            authToken = ctx.query.get('authToken', [None])[0]
+        if self.__cluster is not None and epId is not None and not self.__cluster.owns(epId):
+            return self.__send_relayed(307, [('Location', self.__cluster.owner(epId) + self.path)])
+        try:
+            since = self.__since(ctx) or 0
+            # Checks epId & authToken, creating (lazy mode) & waking the agent for the shares to come
+            self.__qapiManager.default_lang(epId, authToken)
+        except Exception as exc:  # pylint: disable=broad-except
+            return self.__qapi_error(exc)
+        if not self._acquire_poll():
+            return self.__send_busy()
+        codec, protocol = self.__ws_codec()
+        # Also used for __encode_data & __qapi_result
+        self.__respCodec = codec
+        head = [self.__status_line(101), b'Upgrade: websocket\r\nConnection: Upgrade\r\n',
+                b'Sec-WebSocket-Accept: %s\r\n' % accept_key(key).encode('ascii')]
+        if protocol is not None:
+            head.append(b'Sec-WebSocket-Protocol: %s\r\n' % protocol.encode('ascii'))
+        head.append(b'\r\n')
+        self.log_request(101)
+        self.close_connection = True
+        try:
+            self.wfile.write(b''.join(head))
+        except OSError:
+            return
+        self.__wsLock = Lock()
+        self.__wsPending = 0
+        ws = WebSocket(lambda ws, opcode, data: self.__ws_message(ws, codec, epId, authToken, data), self.__maxBody)
+        return self._websocket(ws, lambda: self.__ws_pump(ws, codec, epId, authToken, since),
+                               2 * self.__streamKeepalive + self.timeout)
+
+    def __ws_codec(self):
+        """Returns (codec, subprotocol) for the first of the client's Sec-WebSocket-Protocol we have (json, ubjson,
+        msgpack), (JSON codec, None) if none"""
+        codecs = {codec.name: codec for codec in self.__codecs.values() if codec.binary}
+        codecs['json'] = self.__json
+        for protocol in self.headers.get('Sec-WebSocket-Protocol', '').split(','):
+            protocol = protocol.strip().lower()
+            if protocol in codecs:
+                return codecs[protocol], protocol
+        return self.__json, None
+
+    @staticmethod
+    def __ws_send(ws, codec, message):
+        ws.send(OP_BINARY if codec.binary else OP_TEXT, codec.dumpb(message))
+
+    def __ws_message(self, ws, codec, epId, authToken, data):
+        """Makes the request of a share, ask or tell message, its result is sent once it completes (see _ws_result)
+        so that several messages of a connection can be in flight, told apart by their id"""
+        try:
+            message = codec.loadb(data)
+        except Exception:  # pylint: disable=broad-except
+            return ws.close(CLOSE_INVALID_DATA)
+        ref = message.get('id') if isinstance(message, dict) else None
+        if not self.__begin_call():
+            self.__ws_send(ws, codec, {'op': 'result', 'id': ref, 'code': 503, 'body': {'error': 'shutting down'}})
+            return ws.close(CLOSE_GOING_AWAY)
+        with self.__wsLock:
+            busy = self.__wsPending >= self.__wsMaxInflight
+            if not busy:
+                self.__wsPending += 1
+        if busy:
+            self._end_call()
+            return self.__ws_send(ws, codec, {'op': 'result', 'id': ref, 'code': 503,
+                                              'body': {'error': 'too many messages in flight'}})
+        try:
+            evt = self.__ws_request(epId, authToken, message)
+        except Exception as exc:  # pylint: disable=broad-except
+            return self.__ws_result(ws, codec, ref, None, exc)
+        self._ws_result(evt, lambda: self.__ws_result(ws, codec, ref, evt))
+
+    def __ws_result(self, ws, codec, ref, evt, exc=None):
+        """Sends the result of a message: of its request event (set or timed out) or exc raised making it"""
+        try:
+            if exc is None:
                 try:
-                    count = int(count)  # pylint: disable=redefined-variable-type
-                except ValueError:
-                    count = None
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_recent,
-                sub_id,
-                count=count)
-        else:
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_list,
-                lid,
-                limit=limit,
-                offset=offset)
+                    if evt.is_set():
+                        code, body = self.__qapi_result(evt)
+                    else:
+                        logger.warning("IoticAgent request timeout!")
+                        code, body = 500, {'error': 'request timeout'}
+                except Exception as result_exc:  # pylint: disable=broad-except
+                    exc = result_exc
+            if exc is not None:
+                code, error, error_message, _ = self.__error_result(exc)
+                body = {'error': error}
+                if error_message is not None:
+                    body['message'] = error_message
+            self.__ws_send(ws, codec, {'op': 'result', 'id': ref, 'code': code, 'body': body})
+        finally:
+            with self.__wsLock:
+                self.__wsPending -= 1
+            self._end_call()
 
-    def do_PUT(self):
-        payload = self._read_body()
-        self.__log('PUT', self.path, self.headers, payload)
-        lang = self.__xlang()
-        #
-        if payload is None:
-            return self.__send_resp(410, {'error': 'empty payload or could not decode'})
+    def __ws_request(self, epId, authToken, message):
+        """Returns the IoticAgent request event for a message
+
+        Raises: ValueError if malformed
+        """
+        if not isinstance(message, dict):
+            raise ValueError('message must be a map')
+        op = message.get('op')
+        data = message.get('data', '')
+        mime = message.get('mime')
+        if op == 'share':
+            if 'lid' not in message or 'pid' not in message:
+                raise ValueError('share needs lid & pid')
+            return self.__qapiManager.request_point_share(epId, authToken, message['lid'], message['pid'], data, mime)
+        elif op in ('ask', 'tell'):
+            if 'subid' not in message:
+                raise ValueError('%s needs subid' % op)
+            if op == 'ask':
+                return self.__qapiManager.request_sub_ask(epId, authToken, message['subid'], data, mime)
+            return self.__qapiManager.request_sub_tell(epId, authToken, message['subid'], data, self.timeout, mime)
+        raise ValueError('op must be share, ask or tell')
+
+    def __ws_pump(self, ws, codec, epId, authToken, since):
+        """Sends feeddata, controlreq & unsolicited items as they arrive (ping if none for a while) until ws is
+        closed"""
+        while not ws.closed:
+            try:
+                events = self.__qapiManager.get_events(epId, authToken, since=since, wait=self.__streamKeepalive)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.info("%s : closing WebSocket, %r", epId, exc)
+                ws.close(CLOSE_GOING_AWAY)
+                break
+            if ws.closed:
+                break
+            for seq, kind, row in events:
+                since = seq
+                self.__ws_send(ws, codec, {'op': kind, 'seq': seq, 'data': self.__encode_data([row])[0]})
+            if not events:
+                ws.send(OP_PING)
+            if Handler.__draining:
+                ws.close(CLOSE_GOING_AWAY)
+
+    def __feeddata(self, ctx, payload):
+        # ?pid=<pid>: only the feed data of that point
+        if 'pid' in ctx.query:
+            return self.__collected(ctx, self.__qapiManager.get_feeddata, pid=ctx.query['pid'][0])
+        return self.__collected(ctx, self.__qapiManager.get_feeddata)
+
+    def __controlreq(self, ctx, payload):
+        return self.__collected(ctx, self.__qapiManager.get_controlreq)
+
+    def __unsolicited(self, ctx, payload):
+        return self.__collected(ctx, self.__qapiManager.get_unsolicited)
+
+    __routes = [
+        ('POST', '/entity', __entity_create),
+        ('POST', '/entity/{lid}/tag', __entity_tag_update),
+        ('GET', '/entity', __entity_list),
+        ('GET', '/entity/all', __entity_list_all),
+        ('GET', '/entity/{lid}/meta', __entity_meta_get),
+        ('GET', '/entity/{lid}/{fmt}/meta', __entity_meta_get),
+        ('GET', '/entity/{lid}/tag', __entity_tag_list),
+        ('PUT', '/entity/{lid}/rename', __entity_rename),
+        ('PUT', '/entity/{lid}/reassign', __entity_reassign),
+        ('PUT', '/entity/{lid}/meta', __entity_meta_set),
+        ('PUT', '/entity/{lid}/{fmt}/meta', __entity_meta_set),
+        ('PUT', '/entity/{lid}/setpublic', __entity_setpublic),
+        ('DELETE', '/entity/{lid}/tag', __entity_tag_delete),
+        ('DELETE', '/entity/{lid}', __entity_delete),
         #
-        elif self.path.startswith('/entity'):
-            return self.__do_PUT_entity(payload, lang)
-        elif self.path.startswith('/point'):
-            return self.__do_PUT_point(payload, lang)
-        else:
-            return self.__send_resp(405, {'error': 'invalid resource'})
-
-    def __do_PUT_entity(self, payload, lang):
-        if self.path.endswith('/rename') and 'newlid' in payload:
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_rename,
-                lid,
-                payload['newlid'])
-        elif self.path.endswith('/reassign') and 'epId' in payload:
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_reassign,
-                lid,
-                payload['epId'])
-        elif self.path.endswith('/meta') and 'meta' in payload:
-            lid = self.__path_arg(2)
-            fmt = self.__path_arg(3)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_meta_set,
-                lid,
-                payload['meta'],
-                fmt)
-        elif self.path.endswith('/setpublic') and 'public' in payload:
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_meta_setpublic,
-                lid,
-                payload['public'])
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(2)
-            code, resp = RDFHelper.set_meta_entity(self.__qapiManager, epId, authToken, lid, payload, lang)
-            self.__send_resp(code, resp)
+        ('POST', '/point/{foc}', __point_create),
+        ('POST', '/point/{foc}/{lid}/{pid}/tag', __point_tag_update),
+        ('POST', '/point/{lid}/{pid}/share', __point_share),
+        ('POST', '/point/{lid}/{pid}/share/raw', __point_share_raw, True),
+        ('GET', '/point/{foc}/{lid}', __point_list),
+        ('GET', '/point/{foc}/{lid}/{pid}', __point_list_detailed),
+        ('GET', '/point/{foc}/{lid}/{pid}/meta', __point_meta_get),
+        ('GET', '/point/{foc}/{lid}/{pid}/{fmt}/meta', __point_meta_get),
+        ('GET', '/point/{foc}/{lid}/{pid}/tag', __point_tag_list),
+        ('PUT', '/point/{foc}/{lid}/{pid}/rename', __point_rename),
+        ('PUT', '/point/{foc}/{lid}/{pid}/meta', __point_meta_set),
+        ('PUT', '/point/{foc}/{lid}/{pid}/{fmt}/meta', __point_meta_set),
+        ('DELETE', '/point/{foc}/{lid}/{pid}/tag', __point_tag_delete),
+        ('DELETE', '/point/{foc}/{lid}/{pid}', __point_delete),
         #
-        else:
-            return self.__send_resp(400, {'error': 'malformed'})
-
-    def __do_PUT_point(self, payload, lang):
-        foc = self.__str_to_foc()
-        lid = self.__path_arg(3)
-        pid = self.__path_arg(4)
-        if self.path.endswith('/rename'):
-            return self.__qapi_call(
-                self.__qapiManager.request_point_rename,
-                foc,
-                lid,
-                pid,
-                payload['newpid'] if 'newpid' in payload else '')
-        elif self.path.endswith('/meta'):
-            fmt = self.__path_arg(5)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_meta_set,
-                foc,
-                lid,
-                pid,
-                payload['meta'] if 'meta' in payload else '',
-                fmt)
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('/metahelper'):
-            if lang is None:
-                return self.__send_resp(400, {'error': 'X-Language must be specified for metahelper functions'})
-            epId, authToken = self.__get_epid_headers()
-            code, resp = RDFHelper.set_meta_point(self.__qapiManager, epId, authToken, foc, lid, pid, payload, lang)
-            self.__send_resp(code, resp)
+        ('POST', '/value/{foc}/{lid}/{pid}', __value_create),
+        ('GET', '/value/{foc}/{lid}/{pid}', __value_list),
+        ('DELETE', '/value/{foc}/{lid}/{pid}/{label}', __value_delete),
+        ('DELETE', '/value/{foc}/{lid}/{pid}/{label}/*', __value_delete),
         #
-        else:
-            return self.__send_resp(400, {'error': 'malformed'})
-
-    def do_DELETE(self):  # noqa (complexity) # pylint: disable=too-many-branches
-        payload = self._read_body()
-        self.__log('DELETE', self.path, self.headers, payload)
+        ('POST', '/sub/{foc}/{lid}', __sub_create),
+        ('POST', '/sub/{foc}/{lid}/{pid}', __sub_create_local),
+        ('POST', '/sub/{subid}/ask', __sub_ask),
+        ('POST', '/sub/{subid}/tell', __sub_tell),
+        ('GET', '/sub/{lid}', __sub_list),
+        ('GET', '/sub/{subid}/recent', __sub_recent),
+        ('GET', '/sub/{subid}/{count}/recent', __sub_recent),
+        ('DELETE', '/sub/{subid}', __sub_delete),
         #
-        if self.path.startswith('/entity'):
-            return self.__do_DELETE_entity(payload)
-        elif self.path.startswith('/point'):
-            return self.__do_DELETE_point(payload)
-        elif self.path.startswith('/value'):
-            foc = self.__str_to_foc()
-            lid = self.__path_arg(3)
-            pid = self.__path_arg(4)
-            label = self.__path_arg(5)
-            return self.__qapi_call(
-                self.__qapiManager.request_point_value_delete,
-                lid,
-                pid,
-                foc,
-                label)
-        elif self.path.startswith('/sub'):
-            subid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_sub_delete,
-                subid)
-        else:
-            return self.__send_resp(405, {'error': 'invalid resource'})
-
-    def __do_DELETE_entity(self, payload):
-        if self.path.endswith('/tag'):
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_tag_update,
-                lid,
-                payload['tags'] if 'tags' in payload else [],
-                delete=True)
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
-            epId, authToken = self.__get_epid_headers()
-            lid = self.__path_arg(2)
-            code, resp = RDFHelper.del_meta_entity_tags(self.__qapiManager,
-                                                        epId,
-                                                        authToken,
-                                                        lid,
-                                                        payload['tags'] if 'tags' in payload else [])
-            self.__send_resp(code, resp)
+        ('POST', '/search', __search),
+        ('POST', '/describe', __describe),
         #
-        else:
-            lid = self.__path_arg(2)
-            return self.__qapi_call(
-                self.__qapiManager.request_entity_delete,
-                lid)
-
-    def __do_DELETE_point(self, payload):
-        foc = self.__str_to_foc()
-        lid = self.__path_arg(3)
-        pid = self.__path_arg(4)
-        if self.path.endswith('/tag'):
-            if payload is not None:
-                return self.__qapi_call(
-                    self.__qapiManager.request_point_tag_update,
-                    foc,
-                    lid,
-                    pid,
-                    payload['tags'] if 'tags' in payload else '',
-                    delete=True)
-            else:
-                return self.__send_resp(400, {'error': 'malformed'})
-        # Special RDFHelper functions if rdflib is available
-        elif rdflib is not None and self.path.endswith('tag/metahelper'):
-            epId, authToken = self.__get_epid_headers()
-            code, resp = RDFHelper.del_meta_point_tags(self.__qapiManager,
-                                                       epId,
-                                                       authToken,
-                                                       foc,
-                                                       lid,
-                                                       pid,
-                                                       payload['tags'] if 'tags' in payload else [])
-            self.__send_resp(code, resp)
-        #
-        else:
-            return self.__qapi_call(
-                self.__qapiManager.request_point_delete,
-                foc,
-                lid,
-                pid)
+        ('GET', '/feeddata', __feeddata),
+        ('GET', '/controlreq', __controlreq),
+        ('GET', '/unsolicited', __unsolicited),
+        ('GET', '/stream', __stream),
+        ('GET', '/ws', __websocket)
+    ]
+    if rdflib is not None:
+        __routes += [
+            ('POST', '/entity/{lid}/tag/metahelper', __entity_metahelper_tags_add),
+            ('GET', '/entity/{lid}/metahelper', __entity_metahelper_get),
+            ('GET', '/entity/{lid}/tag/metahelper', __entity_metahelper_tags_get),
+            ('PUT', '/entity/{lid}/metahelper', __entity_metahelper_set),
+            ('DELETE', '/entity/{lid}/tag/metahelper', __entity_metahelper_tags_delete),
+            ('POST', '/point/{foc}/{lid}/{pid}/tag/metahelper', __point_metahelper_tags_add),
+            ('GET', '/point/{foc}/{lid}/{pid}/metahelper', __point_metahelper_get),
+            ('GET', '/point/{foc}/{lid}/{pid}/tag/metahelper', __point_metahelper_tags_get),
+            ('PUT', '/point/{foc}/{lid}/{pid}/metahelper', __point_metahelper_set),
+            ('DELETE', '/point/{foc}/{lid}/{pid}/tag/metahelper', __point_metahelper_tags_delete)
+        ]
+    __routes = RouteTable(__routes)
+
+
+class BusyHandler(Handler):
+    """Answers the first request on a connection with 503 & Retry-After then closes (see PooledHTTPServer)"""
+
+    # One thread answers all rejected connections, a slow client (handshake or request line) must not hold it up
+    timeout = 1
+
+    def handle(self):
+        self.close_connection = True
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:
+            return  # timed out or reset
+        if not self.raw_requestline or not self.parse_request():
+            return
+        self.send_response(503)
+        self.send_header('Retry-After', self.server.retry_after)
+        self.send_header('Connection', 'close')
+        self.send_header('Content-Length', 0)
+        self.end_headers()
 
 
 def getSSLContext(capath, crtpath, keypath, keypass=None):
@@ -828,9 +1718,36 @@ def getSSLContext(capath, crtpath, keypath, keypass=None):
     return ctx
 
 
-def setupServer(hostaddr, capath, crtpath, keypath, keypass, qapiManager, insecure_mode=False):
+def makeServer(server_mode, hostaddr, ctx, options, reuse_port=False):
+    if server_mode == 'asyncio':
+        from .AsyncServer import AsyncHTTPServer
+        return AsyncHTTPServer(hostaddr, Handler,
+                               ssl_context=ctx,
+                               keepalive=int(options.get('keepalive', 60)),
+                               dispatch_threads=int(options.get('dispatch_threads', 16)),
+                               poll_threads=int(options.get('poll_threads', 64)),
+                               reuse_port=reuse_port)
+    elif server_mode == 'pool':
+        return PooledHTTPServer(hostaddr, Handler, BusyHandler,
+                                pool_size=int(options.get('pool_size', 32)),
+                                queue_size=int(options.get('pool_queue', 64)),
+                                retry_after=int(options.get('retry_after', 1)),
+                                reuse_port=reuse_port)
+    elif server_mode == 'threading':
+        return ThreadingHTTPServer(hostaddr, Handler, reuse_port=reuse_port)
+    raise ValueError("server_mode must be 'threading', 'pool' or 'asyncio'")
+
+
+def setupServer(hostaddr, capath, crtpath, keypath, keypass, qapiManager, insecure_mode=False, options=None,
+                cluster=None):
+    """Create & start the HTTP server in a new thread.  options is the [https] config section (dict), see README.md for
+    the server settings it can contain.  cluster: Cluster (see getCluster) in cluster mode."""
+    if options is None:
+        options = {}
+    ctx = None
     if not insecure_mode:
-        Handler.setSSLContext(getSSLContext(capath, crtpath, keypath, keypass))
+        ctx = getSSLContext(capath, crtpath, keypath, keypass)
+        Handler.setSSLContext(ctx)
     else:
         Handler.setSecureMode(False)
         logger.warning("*" * 50)
@@ -839,15 +1756,50 @@ def setupServer(hostaddr, capath, crtpath, keypath, keypass, qapiManager, insecu
         logger.warning("*")
         logger.warning("*" * 50)
     Handler.setQapiManager(qapiManager)
-    # server = ForkingHTTPServer(hostaddr, Handler)
-    server = ThreadingHTTPServer(hostaddr, Handler)
+    Handler.setCluster(cluster)
+    Handler.setJSONCodec(get_json_codec(options.get('json_codec', 'auto')))
+    Handler.setCompression(int(options.get('compress_min', 1024)), int(options.get('compress_level', 6)))
+    Handler.setBodyLimits(int(options.get('max_body', 1048576)), int(options.get('max_body_inflated', 4194304)))
+    Handler.setDrainTimeout(float(options.get('drain_timeout', 10)))
+    Handler.setMaxWait(float(options.get('max_wait', 30)))
+    #
+    server_mode = options.get('server_mode', 'threading').strip().lower()
+    processes = int(options.get('processes', 0))
+    if processes > 0:
+        if hasattr(qapiManager, 'proxy'):
+            # Sharded (QAPIShardedManager): children call the shard processes directly
+            remote = None
+
+            def make_manager():
+                return qapiManager.proxy()
+        else:
+            remote = QAPIRemoteServer(qapiManager)
+
+            def make_manager():
+                return QAPIManagerProxy(remote.address, remote.authkey, timeout=Handler.timeout)
+
+        def make_child_server():
+            Handler.setQapiManager(make_manager())
+            return makeServer(server_mode, hostaddr, ctx, options, reuse_port=True)
+
+        server = PreforkHTTPServer(hostaddr, make_child_server, remote, processes)
+        server_mode = '%s x %d' % (server_mode, processes)
+    else:
+        server = makeServer(server_mode, hostaddr, ctx, options)
     thread = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.2})
     thread.start()
-    logger.info('Started on %s:%s', server.server_name, server.server_port)
+    logger.info('Started (%s, %s) on %s:%s', server_mode, Handler.getJSONCodecName(), server.server_name,
+                server.server_port)
     return server, thread
 
 
-def stopServer(server, thread):
+def stopServer(server, thread, drain_timeout=None):
+    """Stops accepting connections, waits up to drain_timeout (default [https] drain_timeout) for QAPI calls in
+    flight to be answered, then stops & closes the server"""
+    server.stop_accepting()
+    inflight = Handler.drain(drain_timeout)
+    if inflight:
+        logger.warning('%d requests still in flight, stopping anyway', inflight)
     server.shutdown()
     thread.join()
     server.server_close()
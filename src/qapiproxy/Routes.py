@@ -0,0 +1,141 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Route table for RESTServer.Handler
+
+Templates are split into '/' separated segments: literals must match exactly, {name} captures one (non-empty,
+unquoted) segment into the RequestContext attribute of the same name and * matches any segment.  Routes are grouped by
+method & segment count and tried most-literal first, so /entity/all wins over /entity/{lid} and a lid containing
+"feed" or "control" is never mistaken for the point type.  Raw routes receive the request body as bytes instead of
+decoded by Content-Type.
+"""
+
+from urllib.parse import unquote, parse_qs
+
+from IoticAgent.Core.Const import R_FEED, R_CONTROL
+
+
+class RequestContext(object):
+    """Request path parsed once: captures from the matched route, X-Range/X-Language and the query string"""
+
+    __slots__ = ('path', 'query', 'lid', 'pid', 'foc', 'fmt', 'subid', 'label', 'count', 'limit', 'offset', 'lang')
+
+    def __init__(self, path, query):
+        self.path = path
+        self.query = query
+        self.lid = self.pid = self.foc = self.fmt = self.subid = self.label = self.count = None
+        self.limit = self.offset = self.lang = None
+
+
+# Returned by a capture type when the segment does not match
+NO_MATCH = object()
+
+_FOC = {'feed': R_FEED, 'control': R_CONTROL}
+
+
+def _cap_str(value):
+    return value if value else NO_MATCH
+
+
+def _cap_foc(value):
+    return _FOC.get(value.lower(), NO_MATCH)
+
+
+def _cap_count(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+CAPTURES = {
+    'lid': _cap_str,
+    'pid': _cap_str,
+    'foc': _cap_foc,
+    'fmt': _cap_str,
+    'subid': _cap_str,
+    'label': _cap_str,
+    'count': _cap_count
+}
+
+
+def split_path(path):
+    """Returns path (without query), list of unquoted segments (first is empty) & parsed query"""
+    path, _, query = path.partition('?')
+    segments = path.split('/')
+    if len(segments) > 2 and not segments[-1]:
+        segments.pop()  # trailing slash
+    return path, [unquote(seg) for seg in segments], parse_qs(query) if query else {}
+
+
+class Route(object):
+
+    __slots__ = ('method', 'template', 'handler', 'raw', 'length', 'literals', 'captures')
+
+    def __init__(self, method, template, handler, raw=False):
+        self.method = method
+        self.template = template
+        self.handler = handler
+        self.raw = raw
+        segments = template.split('/')
+        self.length = len(segments)
+        self.literals = []
+        self.captures = []
+        for idx, seg in enumerate(segments):
+            if seg.startswith('{') and seg.endswith('}'):
+                name = seg[1:-1]
+                self.captures.append((idx, name, CAPTURES[name]))
+            elif seg != '*':
+                self.literals.append((idx, seg))
+
+    def match(self, segments, ctx):
+        for idx, literal in self.literals:
+            if segments[idx] != literal:
+                return False
+        values = []
+        for idx, name, cap in self.captures:
+            value = cap(segments[idx])
+            if value is NO_MATCH:
+                return False
+            values.append((name, value))
+        for name, value in values:
+            setattr(ctx, name, value)
+        return True
+
+
+class RouteTable(object):
+    """routes: iterable of (method, template, handler[, raw])"""
+
+    def __init__(self, routes):
+        self.__routes = {}
+        self.__resources = {}
+        for method, template, *options in routes:
+            route = Route(method, template, *options)
+            self.__routes.setdefault((method, route.length), []).append(route)
+            self.__resources.setdefault(method, set()).add(template.split('/')[1])
+        for routes in self.__routes.values():
+            routes.sort(key=lambda route: len(route.literals), reverse=True)
+
+    def match(self, method, path):
+        """Returns (Route or None, RequestContext)"""
+        path, segments, query = split_path(path)
+        ctx = RequestContext(path, query)
+        for route in self.__routes.get((method, len(segments)), ()):
+            if route.match(segments, ctx):
+                return route, ctx
+        return None, ctx
+
+    def is_resource(self, method, ctx):
+        """Whether the first path segment is known for method (i.e. the request was malformed rather than invalid)"""
+        segments = ctx.path.split('/')
+        return len(segments) > 1 and segments[1] in self.__resources.get(method, ())
@@ -0,0 +1,144 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+logger = logging.getLogger(__name__)
+
+from threading import Thread, Condition, Lock
+from concurrent.futures import Future
+from queue import Queue
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+
+SCHEDULER_THREADS = 16      # Size of the pool running submitted (potentially blocking) work
+
+
+class Scheduler(object):
+    """Housekeeping for all QAPIWorkers on one timer thread: schedule() runs a function after a delay (heap ordered,
+    timers must not block) and submit() runs work that may block (e.g. starting or stopping a client) on a small
+    thread pool.
+    """
+
+    def __init__(self, threads=SCHEDULER_THREADS):
+        # [when, seq, func, args], func is None once cancelled
+        self.__heap = []
+        self.__seq = count()
+        self.__cond = Condition()
+        self.__stop = False
+        self.__thread = None
+        # (Future, func, args) for the pool, None to stop a pool thread
+        self.__tasks = Queue()
+        self.__threads = max(1, int(threads))
+        self.__pool_lock = Lock()
+        self.__running = 0      # Pool threads started & not stopped
+        self.__blocked = set()  # Futures of tasks whose thread has been replaced (see replace_blocked)
+
+    def start(self):
+        self.__thread = Thread(target=self.__run, name='Scheduler', daemon=True)
+        self.__thread.start()
+        for _ in range(self.__threads):
+            self.__start_pool_thread()
+
+    def stop(self):
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        # Pool threads finish their current task (not waited for), queued tasks are dropped
+        with self.__pool_lock:
+            running, self.__running = self.__running, 0
+        for _ in range(running):
+            self.__tasks.put(None)
+
+    def schedule(self, delay, func, *args):
+        """Calls func(*args) on the timer thread after delay seconds.  Returns handle for cancel()"""
+        entry = [monotonic() + delay, next(self.__seq), func, args]
+        with self.__cond:
+            heappush(self.__heap, entry)
+            if self.__heap[0] is entry:
+                self.__cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        """Cancels scheduled call (no-op if already run)"""
+        if entry is not None:
+            entry[2] = None
+
+    def submit(self, func, *args):
+        """Calls func(*args) on the pool.  Returns Future"""
+        future = Future()
+        self.__tasks.put((future, func, args))
+        return future
+
+    def replace_blocked(self, future):
+        """The task of future (from submit) is blocked, possibly for good: starts another pool thread in its place.
+        The blocked thread exits once the task returns."""
+        with self.__pool_lock:
+            if not self.__running or future.done() or future in self.__blocked:
+                return
+            self.__blocked.add(future)
+        self.__start_pool_thread()
+
+    def __start_pool_thread(self):
+        with self.__pool_lock:
+            self.__running += 1
+        Thread(target=self.__pool, name='Scheduler-pool', daemon=True).start()
+
+    def __pool(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            future, func, args = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args)
+                except BaseException as exc:  # pylint: disable=broad-except
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            with self.__pool_lock:
+                if future in self.__blocked:
+                    self.__blocked.discard(future)
+                    self.__running = max(0, self.__running - 1)
+                    return
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def __run(self):
+        with self.__cond:
+            while not self.__stop:
+                if not self.__heap:
+                    self.__cond.wait()
+                    continue
+                delay = self.__heap[0][0] - monotonic()
+                if delay > 0:
+                    self.__cond.wait(delay)
+                    continue
+                _, _, func, args = heappop(self.__heap)
+                if func is None:
+                    continue
+                self.__cond.release()
+                try:
+                    func(*args)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Scheduled %s failed", func)
+                finally:
+                    self.__cond.acquire()
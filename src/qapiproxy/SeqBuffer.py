@@ -0,0 +1,174 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from heapq import merge
+from threading import Condition
+
+
+class SeqBuffer(object):
+    """Keeps the last items of each kind (e.g. feeddata), numbered by one increasing sequence across kinds so that a
+    reader can ask for what was added since the last item it saw without removing anything, or wait for it.
+
+    Items can be added with a key (e.g. the point feed data came from), read & taken by key.  Once a kind is full its
+    oldest item of the key with the most items is dropped, so a busy key does not push out the items of quiet ones.
+
+    maxlens: {kind: how many items to keep}, 0 to discard items of that kind
+    key_maxlens: {kind: how many items to keep per key}, 0 (default) for no limit but the kind's
+    """
+
+    def __init__(self, maxlens, key_maxlens=None):
+        key_maxlens = key_maxlens or {}
+        self.__cond = Condition()
+        self.__seq = 0      # of the last item added
+        self.__closed = False
+        self.__maxlens = {kind: maxlen for kind, maxlen in maxlens.items() if maxlen > 0}
+        self.__key_maxlens = {kind: key_maxlens.get(kind) or None for kind in self.__maxlens}
+        # kind -> key -> [(seq, item)], keys with no items are removed
+        self.__items = {kind: {} for kind in self.__maxlens}
+        self.__counts = {kind: 0 for kind in self.__maxlens}
+        # kind -> number of items -> {key: None} of the keys with that many, so the longest key is found without a scan
+        self.__by_len = {kind: {} for kind in self.__maxlens}
+        self.__longest = {kind: 0 for kind in self.__maxlens}
+        self.__last = {kind: 0 for kind in self.__maxlens}  # seq of the last item of kind added
+
+    @property
+    def seq(self):
+        return self.__seq
+
+    def append(self, kind, item, key=None):
+        keys = self.__items.get(kind)
+        if keys is None:
+            return
+        with self.__cond:
+            self.__seq += 1
+            items = keys.get(key)
+            if items is None:
+                items = keys[key] = deque(maxlen=self.__key_maxlens[kind])
+            length = len(items)
+            if length == items.maxlen:
+                self.__counts[kind] -= 1
+            else:
+                self.__resize(kind, key, length, length + 1)
+            items.append((self.__seq, item))
+            self.__counts[kind] += 1
+            if self.__counts[kind] > self.__maxlens[kind]:
+                self.__drop_longest(kind, keys)
+                self.__counts[kind] -= 1
+            self.__last[kind] = self.__seq
+            self.__cond.notify_all()
+
+    def __drop_longest(self, kind, keys):
+        longest = self.__longest[kind]
+        key = next(iter(self.__by_len[kind][longest]))
+        items = keys[key]
+        items.popleft()
+        self.__resize(kind, key, longest, longest - 1)
+        if not items:
+            del keys[key]
+
+    def __resize(self, kind, key, old, new):
+        """Moves key from the keys with old to those with new items (0: none)"""
+        by_len = self.__by_len[kind]
+        if old:
+            keys = by_len[old]
+            del keys[key]
+            if not keys:
+                del by_len[old]
+        if new:
+            by_len.setdefault(new, {})[key] = None
+        if new > self.__longest[kind]:
+            self.__longest[kind] = new
+        else:
+            while self.__longest[kind] and self.__longest[kind] not in by_len:
+                self.__longest[kind] -= 1
+
+    def wait(self, kind, since=None, timeout=None, key=None):
+        """Waits up to timeout seconds for an item of kind (None: of any kind) which read(kind, since, key) would
+        return (any item if since is None).  Returns whether there is one."""
+        kinds = list(self.__items) if kind is None else [kind]
+        with self.__cond:
+            return self.__cond.wait_for(
+                lambda: self.__closed or any(self.__newer(kind, since, key) for kind in kinds), timeout
+            ) and not self.__closed
+
+    def __newer(self, kind, since, key):
+        keys = self.__items.get(kind)
+        if not keys:
+            return False
+        if key is None:
+            last = self.__last[kind]
+        elif key in keys:
+            last = keys[key][-1][0]
+        else:
+            return False
+        return since is None or since > self.__seq or last > since
+
+    def close(self):
+        """Ends current & further waits"""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+
+    def read(self, kind, since=None, key=None):
+        """Returns [(seq, item)] of kind (of key, if not None) added after since, oldest first.  All kept if since is
+        None or later than the last item (i.e. a sequence of an earlier buffer, e.g. before the agent was restarted)"""
+        keys = self.__items.get(kind)
+        if keys is None:
+            return []
+        with self.__cond:
+            if since is not None and since > self.__seq:
+                since = None
+            if key is not None:
+                return self.__newer_items(keys[key], since) if key in keys else []
+            if len(keys) == 1:
+                return self.__newer_items(next(iter(keys.values())), since)
+            return list(merge(*(self.__newer_items(items, since) for items in keys.values())))
+
+    @staticmethod
+    def __newer_items(items, since):
+        if since is None or not items or items[0][0] > since:
+            return list(items)
+        # Newest last: only the new items are copied
+        ret = []
+        for entry in reversed(items):
+            if entry[0] <= since:
+                break
+            ret.append(entry)
+        ret.reverse()
+        return ret
+
+    def read_all(self, since=None):
+        """Returns [(seq, kind, item)] of all kinds added after since (see read), oldest first"""
+        with self.__cond:
+            return list(merge(*([(seq, kind, item) for seq, item in self.read(kind, since)]
+                                for kind in self.__items)))
+
+    def take(self, kind, key=None):
+        """Removes & returns [(seq, item)] of kind (of key, if not None), oldest first"""
+        keys = self.__items.get(kind)
+        if keys is None:
+            return []
+        with self.__cond:
+            if key is None:
+                ret = list(merge(*keys.values()))
+                keys.clear()
+                self.__by_len[kind].clear()
+                self.__longest[kind] = 0
+            else:
+                ret = list(keys.pop(key, ()))
+                if ret:
+                    self.__resize(kind, key, len(ret), 0)
+            self.__counts[kind] -= len(ret)
+        return ret
@@ -0,0 +1,74 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock, BoundedSemaphore
+from time import monotonic, sleep
+from random import uniform
+
+
+START_CONCURRENT = 16   # How many clients may be connecting at once?
+START_RATE = 20         # How many client connects to begin per second, 0 for no limit
+START_JITTER = 10       # Initial starts are spread randomly over this many seconds
+
+
+class _Slot(object):
+    released = False
+
+
+class StartupScheduler(object):
+    """Paces IoticAgent client starts (connects) shared by all QAPIWorkers: at most `concurrent` at once, begun at no
+    more than `rate` per second, first starts spread over `jitter` seconds.  Counts ready (started) workers.
+    """
+
+    def __init__(self, concurrent=START_CONCURRENT, rate=START_RATE, jitter=START_JITTER):
+        self.__slots = BoundedSemaphore(max(1, int(concurrent)))
+        rate = float(rate)
+        self.__interval = 1.0 / rate if rate > 0 else 0
+        self.__jitter = float(jitter)
+        self.__lock = Lock()
+        self.__next = 0     # Earliest time (monotonic) the next connect may begin
+        self.__ready = 0
+
+    def initial_delay(self):
+        """Seconds a new worker should wait before its first start"""
+        return uniform(0, self.__jitter)
+
+    def acquire(self):
+        """Waits for a connect slot and rate limit.  Returns the slot for release()"""
+        self.__slots.acquire()
+        if self.__interval:
+            with self.__lock:
+                now = monotonic()
+                delay = self.__next - now
+                self.__next = max(now, self.__next) + self.__interval
+            if delay > 0:
+                sleep(delay)
+        return _Slot()
+
+    def release(self, slot):
+        """Frees slot once the connect is done or given up on (further calls for the same slot do nothing)"""
+        with self.__lock:
+            if slot.released:
+                return
+            slot.released = True
+        self.__slots.release()
+
+    def set_ready(self, ready):
+        """Worker started (True) or, having been ready, stopped (False)"""
+        with self.__lock:
+            self.__ready += 1 if ready else -1
+
+    @property
+    def ready(self):
+        return self.__ready
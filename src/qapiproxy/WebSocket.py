@@ -0,0 +1,190 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Server side of the WebSocket protocol (RFC 6455) for RESTServer.Handler (GET /ws), independent of how the
+connection is read & written so that both the threaded servers and AsyncServer can carry it.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from base64 import b64encode
+from hashlib import sha1
+from struct import pack, unpack_from
+
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+CLOSE_INTERNAL_ERROR = 1011
+
+
+class ProtocolError(Exception):
+    """The client broke the protocol, the connection is closed with code"""
+
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+def accept_key(key):
+    """Sec-WebSocket-Accept value for the client's Sec-WebSocket-Key"""
+    return b64encode(sha1((key + GUID).encode('ascii')).digest()).decode('ascii')
+
+
+def frame(opcode, payload=b''):
+    """Unfragmented (unmasked, server) frame"""
+    length = len(payload)
+    if length < 126:
+        head = pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        head = pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = pack('!BBQ', 0x80 | opcode, 127, length)
+    return head + payload
+
+
+def _unmask(mask, data):
+    length = len(data)
+    if not length:
+        return data
+    mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+class FrameParser(object):
+    """Incremental parser of (masked) client frames, fragmented messages are joined.  max_message: largest message
+    (bytes) accepted"""
+
+    def __init__(self, max_message):
+        self.__max_message = max_message
+        self.__buffer = bytearray()
+        self.__fragments = []
+        self.__fragments_opcode = None
+        self.__fragments_size = 0
+
+    def feed(self, data):
+        """Returns [(opcode, payload)] of the messages (and control frames) completed by data, in order
+
+        Raises: ProtocolError
+        """
+        buf = self.__buffer
+        buf += data
+        ret = []
+        while len(buf) >= 2:
+            first, second = buf[0], buf[1]
+            if first & 0x70:
+                raise ProtocolError('reserved bits set')
+            if not second & 0x80:
+                raise ProtocolError('client frame not masked')
+            fin = first & 0x80
+            opcode = first & 0x0F
+            length = second & 0x7F
+            offset = 2
+            if length == 126:
+                if len(buf) < 4:
+                    break
+                length = unpack_from('!H', buf, 2)[0]
+                offset = 4
+            elif length == 127:
+                if len(buf) < 10:
+                    break
+                length = unpack_from('!Q', buf, 2)[0]
+                offset = 10
+            if opcode & 0x8:
+                if not fin or length > 125:
+                    raise ProtocolError('fragmented or long control frame')
+            elif length + self.__fragments_size > self.__max_message:
+                raise ProtocolError('message > %d bytes' % self.__max_message, CLOSE_TOO_BIG)
+            if len(buf) < offset + 4 + length:
+                break
+            payload = _unmask(bytes(buf[offset:offset + 4]), bytes(buf[offset + 4:offset + 4 + length]))
+            del buf[:offset + 4 + length]
+            if opcode & 0x8:
+                ret.append((opcode, payload))
+                continue
+            if opcode == OP_CONTINUATION:
+                if self.__fragments_opcode is None:
+                    raise ProtocolError('continuation without message')
+            elif opcode in (OP_TEXT, OP_BINARY):
+                if self.__fragments_opcode is not None:
+                    raise ProtocolError('new message before previous one ended')
+                self.__fragments_opcode = opcode
+            else:
+                raise ProtocolError('unknown opcode %d' % opcode)
+            self.__fragments.append(payload)
+            self.__fragments_size += length
+            if fin:
+                ret.append((self.__fragments_opcode, b''.join(self.__fragments)))
+                self.__fragments = []
+                self.__fragments_opcode = None
+                self.__fragments_size = 0
+        return ret
+
+
+class WebSocket(object):
+    """One accepted WebSocket connection.  The transport passes what it reads to receive() and sets write (callable
+    with bytes, safe to call from any thread) to what writes to the connection.  on_message(ws, opcode, payload) is
+    called for each text or binary message, pings & closes are answered here.
+    """
+
+    def __init__(self, on_message, max_message):
+        self.__on_message = on_message
+        self.__parser = FrameParser(max_message)
+        self.write = None
+        self.closed = False
+        self.__close_sent = False
+
+    def receive(self, data):
+        """Handles data read from the connection, returns False once the connection should be closed"""
+        try:
+            messages = self.__parser.feed(data)
+        except ProtocolError as exc:
+            logger.info("WebSocket protocol error: %s", exc)
+            self.close(exc.code)
+            return False
+        for opcode, payload in messages:
+            if self.closed:
+                break
+            if opcode == OP_PING:
+                self.send(OP_PONG, payload)
+            elif opcode == OP_CLOSE:
+                self.close()
+            elif opcode != OP_PONG:
+                self.__on_message(self, opcode, payload)
+        return not self.closed
+
+    def send(self, opcode, payload=b''):
+        if self.__close_sent:
+            return
+        try:
+            self.write(frame(opcode, payload))
+        except OSError:
+            self.closed = True
+
+    def close(self, code=CLOSE_NORMAL):
+        """Sends close frame (once), the transport closes the connection"""
+        self.send(OP_CLOSE, pack('!H', code))
+        self.__close_sent = True
+        self.closed = True
@@ -22,7 +22,9 @@ from os import environ
 import logging
 
 from .QAPIManager import QAPIManager
+from .QAPIShards import QAPIShardedManager
 from .QAPIConfig import QAPIConfig
+from .Cluster import getCluster
 from . import RESTServer
 
 logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)s [%(name)s] {%(threadName)s} %(message)s',
@@ -55,8 +57,13 @@ def main():
 
     # TODO: config validation etc
 
-    qapimanager = QAPIManager(config)
-    qapimanager.start()
+    # The same ring decides which agents this node runs and which requests it forwards
+    cluster = getCluster(config)
+    shards = int(config['qapimanager'].get('shards', 0))
+    if shards > 1:
+        qapimanager = QAPIShardedManager(config, shards, timeout=RESTServer.Handler.timeout, cluster=cluster)
+    else:
+        qapimanager = QAPIManager(config, cluster=cluster)
 
     insecure_mode = False
     if 'insecure_mode' in config['https']:
@@ -70,8 +77,13 @@ def main():
         config['https']['ssl_key'],
         config['https']['ssl_pass'],
         qapimanager,
-        insecure_mode
+        insecure_mode,
+        options=config['https'],
+        cluster=cluster
     )
+    # Started after the server since processes > 0 forks HTTP processes, which should not inherit the worker threads
+    # (nor shard processes the HTTP server).
+    qapimanager.start()
 
     if 'IOTIC_BACKGROUND' in environ:
         from signal import signal, SIGINT, SIGTERM
@@ -0,0 +1,114 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from qapiproxy.Cluster import HashRing, Cluster, getCluster, HOP_HEADER
+
+
+KEYS = ['epid%d' % i for i in range(2000)]
+
+
+class TestHashRing(TestCase):
+
+    def test_owner(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = [ring.owner(key) for key in KEYS]
+        # Same on every node, i.e. independent of the order nodes are listed in
+        self.assertEqual(owners, [HashRing(['c', 'a', 'b']).owner(key) for key in KEYS])
+        for node in 'abc':
+            self.assertGreater(owners.count(node), len(KEYS) / 6)
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+    def test_add_remove(self):
+        """Only the keys of the node added or removed move"""
+        three = HashRing(['a', 'b', 'c'])
+        four = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in KEYS if three.owner(key) != four.owner(key)]
+        self.assertTrue(moved)
+        self.assertEqual({four.owner(key) for key in moved}, {'d'})
+        two = HashRing(['a', 'c'])
+        for key in KEYS:
+            if three.owner(key) != 'b':
+                self.assertEqual(two.owner(key), three.owner(key))
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.requests.append((self.path, dict(self.headers), self.client_address))
+        body = b'{"ok":true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Keep-Alive', 'timeout=5')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class TestCluster(TestCase):
+
+    def test_nodes(self):
+        cluster = Cluster(['http://a:1/', ' http://b:1'], 'http://b:1/')
+        self.assertEqual(cluster.node, 'http://b:1')
+        self.assertFalse(cluster.redirect)
+        for key in KEYS[:100]:
+            self.assertIn(cluster.owner(key), ('http://a:1', 'http://b:1'))
+            self.assertEqual(cluster.owns(key), cluster.owner(key) == 'http://b:1')
+        with self.assertRaises(ValueError):
+            Cluster(['http://a:1'], 'http://c:1')
+
+    def test_config(self):
+        self.assertIsNone(getCluster({}))
+        self.assertIsNone(getCluster({'cluster': {'nodes': '\n'}}))
+        options = {'nodes': 'http://a:1\nhttp://b:1', 'self': 'http://a:1', 'mode': 'Redirect', 'timeout': '2'}
+        cluster = getCluster({'cluster': options})
+        self.assertTrue(cluster.redirect)
+        self.assertTrue(cluster.owns('x') or cluster.owner('x') == 'http://b:1')
+        with self.assertRaises(ValueError):
+            getCluster({'cluster': dict(options, mode='proxy')})
+
+    def test_forward(self):
+        server = HTTPServer(('127.0.0.1', 0), _Handler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        node = 'http://127.0.0.1:%d' % server.server_address[1]
+        cluster = Cluster(['http://me:1', node], 'http://me:1', timeout=5)
+        try:
+            _Handler.requests.clear()
+            for _ in range(2):
+                status, headers, body = cluster.forward(node, 'GET', '/entity?limit=1',
+                                                        [('epId', 'e1'), ('Connection', 'close'), ('Host', 'me')])
+                self.assertEqual((status, body), (200, b'{"ok":true}'))
+                names = [name.lower() for name, _ in headers]
+                self.assertIn('content-type', names)
+                self.assertNotIn('keep-alive', names)
+            (path, sent, client), (_, _, client2) = _Handler.requests
+            self.assertEqual((path, sent['epId'], sent[HOP_HEADER]), ('/entity?limit=1', 'e1', 'http://me:1'))
+            self.assertNotEqual(sent.get('Connection'), 'close')
+            # The connection was kept for the second request
+            self.assertEqual(client, client2)
+        finally:
+            cluster.close()
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,76 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+
+from qapiproxy.Codec import JSON_CONTENT_TYPE, available_json_codecs, get_json_codec, get_binary_codecs
+
+
+DOC = {'lid': 'thing/é', 'values': [1, 2.5, None, True, False], 'nested': {'a': []}, 'empty': ''}
+
+
+class TestJsonCodecs(TestCase):
+
+    def test_available(self):
+        available = available_json_codecs()
+        self.assertEqual(available[-1], 'json')
+        self.assertEqual(get_json_codec('auto').name, available[0])
+        self.assertEqual(get_json_codec(' JSON ').name, 'json')
+        with self.assertRaises(ValueError):
+            get_json_codec('nosuchcodec')
+
+    def test_round_trip(self):
+        for name in available_json_codecs():
+            with self.subTest(codec=name):
+                codec = get_json_codec(name)
+                self.assertEqual(codec.content_type, JSON_CONTENT_TYPE)
+                self.assertFalse(codec.binary)
+                data = codec.dumpb(DOC)
+                self.assertIsInstance(data, bytes)
+                self.assertEqual(codec.loadb(data), DOC)
+
+    def test_same_bytes(self):
+        """All codecs send compact UTF-8 (not \\u escaped) JSON, as the stdlib one"""
+        expected = '{"a":"é/x","b":[1,null]}'.encode('utf-8')
+        for name in available_json_codecs():
+            with self.subTest(codec=name):
+                self.assertEqual(get_json_codec(name).dumpb({'a': 'é/x', 'b': [1, None]}), expected)
+
+    def test_big_int(self):
+        for name in available_json_codecs():
+            with self.subTest(codec=name):
+                codec = get_json_codec(name)
+                self.assertEqual(codec.loadb(codec.dumpb({'n': 2 ** 70})), {'n': 2 ** 70})
+
+
+class TestBinaryCodecs(TestCase):
+
+    def test_media_types(self):
+        codecs = get_binary_codecs()
+        self.assertEqual(codecs['application/ubjson'].name, 'ubjson')
+        for media_type, codec in codecs.items():
+            with self.subTest(media_type=media_type):
+                self.assertTrue(codec.binary)
+                self.assertIn(codec.content_type, codecs)
+        if 'application/msgpack' in codecs:
+            self.assertIs(codecs['application/x-msgpack'], codecs['application/msgpack'])
+
+    def test_raw_bytes(self):
+        """Share data is carried as bytes, not base64"""
+        doc = dict(DOC, data=bytes(range(256)))
+        for media_type, codec in get_binary_codecs().items():
+            with self.subTest(media_type=media_type):
+                data = codec.dumpb(doc)
+                self.assertIn(bytes(range(256)), data)
+                self.assertEqual(codec.loadb(data), doc)
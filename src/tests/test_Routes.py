@@ -0,0 +1,85 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase, SkipTest
+
+try:
+    from IoticAgent.Core.Const import R_FEED, R_CONTROL
+except ImportError:
+    raise SkipTest('py-IoticAgent not installed')
+
+from qapiproxy.Routes import RouteTable, split_path
+
+
+ROUTES = (
+    ('GET', '/entity', 'entity_list'),
+    ('GET', '/entity/all', 'entity_list_all'),
+    ('GET', '/entity/{lid}/meta', 'entity_meta_get'),
+    ('GET', '/entity/{lid}/{fmt}/meta', 'entity_meta_get'),
+    ('DELETE', '/entity/{lid}', 'entity_delete'),
+    ('POST', '/point/{lid}/{pid}/share/raw', 'point_share_raw', True),
+    ('GET', '/point/{foc}/{lid}/{pid}', 'point_list_detailed'),
+    ('POST', '/sub/{foc}/{lid}', 'sub_create'),
+    ('POST', '/sub/{subid}/ask', 'sub_ask'),
+    ('GET', '/sub/{subid}/{count}/recent', 'sub_recent'),
+    ('DELETE', '/value/{foc}/{lid}/{pid}/{label}/*', 'value_delete')
+)
+
+
+class TestRoutes(TestCase):
+
+    def setUp(self):
+        self.table = RouteTable(ROUTES)
+
+    def match(self, method, path):
+        route, ctx = self.table.match(method, path)
+        return (route.handler if route else None), ctx
+
+    def test_split_path(self):
+        self.assertEqual(split_path('/entity/a%20b/?limit=5&limit=6'),
+                         ('/entity/a%20b/', ['', 'entity', 'a b'], {'limit': ['5', '6']}))
+        self.assertEqual(split_path('/'), ('/', ['', ''], {}))
+
+    def test_literal_before_capture(self):
+        self.assertEqual(self.match('GET', '/entity/all')[0], 'entity_list_all')
+        self.assertEqual(self.match('POST', '/sub/s1/ask')[0], 'sub_ask')
+        handler, ctx = self.match('POST', '/sub/feed/e1')
+        self.assertEqual((handler, ctx.foc, ctx.lid), ('sub_create', R_FEED, 'e1'))
+
+    def test_captures(self):
+        handler, ctx = self.match('GET', '/entity/my%2Fthing/n3/meta?lang=en')
+        self.assertEqual((handler, ctx.lid, ctx.fmt, ctx.query), ('entity_meta_get', 'my/thing', 'n3', {'lang': ['en']}))
+        handler, ctx = self.match('GET', '/point/Control/e1/p1/')
+        self.assertEqual((handler, ctx.foc, ctx.lid, ctx.pid), ('point_list_detailed', R_CONTROL, 'e1', 'p1'))
+        handler, ctx = self.match('GET', '/sub/s1/x/recent')
+        self.assertEqual((handler, ctx.subid, ctx.count), ('sub_recent', 's1', None))
+        self.assertEqual(self.match('DELETE', '/value/feed/e1/p1/l1/anything')[0], 'value_delete')
+
+    def test_no_match(self):
+        self.assertIsNone(self.match('GET', '/point/other/e1/p1')[0])
+        self.assertIsNone(self.match('GET', '/entity//meta')[0])
+        self.assertIsNone(self.match('PUT', '/entity')[0])
+        self.assertIsNone(self.match('GET', '/entity/e1/meta/extra')[0])
+        # A failed capture leaves nothing behind on the context
+        self.assertIsNone(self.match('GET', '/point/other/e1/p1')[1].lid)
+
+    def test_raw(self):
+        route, _ = self.table.match('POST', '/point/e1/p1/share/raw')
+        self.assertTrue(route.raw)
+        self.assertFalse(self.table.match('GET', '/entity')[0].raw)
+
+    def test_is_resource(self):
+        self.assertTrue(self.table.is_resource('GET', self.table.match('GET', '/entity/e1/bad')[1]))
+        self.assertFalse(self.table.is_resource('GET', self.table.match('GET', '/nothing')[1]))
+        self.assertFalse(self.table.is_resource('PUT', self.table.match('PUT', '/entity/e1')[1]))
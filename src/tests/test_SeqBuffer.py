@@ -0,0 +1,146 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+from random import Random
+from threading import Timer
+from time import monotonic
+
+from qapiproxy.SeqBuffer import SeqBuffer
+
+
+class TestSeqBuffer(TestCase):
+
+    def setUp(self):
+        self.buf = SeqBuffer({'feed': 3, 'control': 2, 'off': 0})
+
+    def test_sequence(self):
+        self.buf.append('feed', 'f1')
+        self.buf.append('control', 'c1')
+        self.buf.append('feed', 'f2')
+        self.buf.append('off', 'o1')
+        self.buf.append('nosuchkind', 'x')
+        self.assertEqual(self.buf.seq, 3)
+        self.assertEqual(self.buf.read('feed'), [(1, 'f1'), (3, 'f2')])
+        self.assertEqual(self.buf.read('off'), [])
+        self.assertEqual(self.buf.read('nosuchkind'), [])
+        self.assertEqual(self.buf.read_all(), [(1, 'feed', 'f1'), (2, 'control', 'c1'), (3, 'feed', 'f2')])
+
+    def test_since(self):
+        for i in range(5):
+            self.buf.append('feed', i)
+        # Oldest dropped once full
+        self.assertEqual(self.buf.read('feed'), [(3, 2), (4, 3), (5, 4)])
+        self.assertEqual(self.buf.read('feed', since=4), [(5, 4)])
+        self.assertEqual(self.buf.read('feed', since=5), [])
+        self.assertEqual(self.buf.read('feed', since=1), [(3, 2), (4, 3), (5, 4)])
+        # From an earlier buffer (e.g. agent restarted): all
+        self.assertEqual(self.buf.read('feed', since=99), [(3, 2), (4, 3), (5, 4)])
+        self.assertEqual(self.buf.read_all(since=4), [(5, 'feed', 4)])
+
+    def test_take(self):
+        self.buf.append('feed', 'f1')
+        self.buf.append('feed', 'f2')
+        self.assertEqual(self.buf.take('feed'), [(1, 'f1'), (2, 'f2')])
+        self.assertEqual(self.buf.read('feed'), [])
+        self.assertEqual(self.buf.take('off'), [])
+        # Sequence carries on, the kind has room for maxlen again
+        for i in range(3):
+            self.buf.append('feed', i)
+        self.assertEqual(self.buf.read('feed'), [(3, 0), (4, 1), (5, 2)])
+
+    def test_wait(self):
+        self.assertFalse(self.buf.wait('feed', timeout=0.01))
+        self.buf.append('control', 'c1')
+        self.assertTrue(self.buf.wait(None, timeout=0))
+        self.assertFalse(self.buf.wait('feed', timeout=0))
+        self.assertFalse(self.buf.wait('control', since=1, timeout=0))
+        Timer(0.05, self.buf.append, ('feed', 'f1')).start()
+        start = monotonic()
+        self.assertTrue(self.buf.wait('feed', since=1, timeout=5))
+        self.assertLess(monotonic() - start, 4)
+        self.assertEqual(self.buf.read('feed', since=1), [(2, 'f1')])
+
+    def test_close(self):
+        Timer(0.05, self.buf.close).start()
+        start = monotonic()
+        self.assertFalse(self.buf.wait(None, timeout=5))
+        self.assertLess(monotonic() - start, 4)
+        self.buf.append('feed', 'f1')
+        self.assertFalse(self.buf.wait('feed', timeout=0))
+
+
+class TestSeqBufferKeys(TestCase):
+
+    def test_busy_key(self):
+        """A busy key does not push out the items of quiet ones"""
+        buf = SeqBuffer({'feed': 4})
+        buf.append('feed', 'q1', key='quiet')
+        for i in range(10):
+            buf.append('feed', i, key='busy')
+        self.assertEqual(buf.read('feed', key='quiet'), [(1, 'q1')])
+        self.assertEqual(buf.read('feed', key='busy'), [(9, 7), (10, 8), (11, 9)])
+        self.assertEqual(buf.read('feed'), [(1, 'q1'), (9, 7), (10, 8), (11, 9)])
+        self.assertEqual(buf.read('feed', key='nosuchkey'), [])
+
+    def test_key_maxlen(self):
+        buf = SeqBuffer({'feed': 10}, {'feed': 2})
+        for i in range(5):
+            buf.append('feed', i, key='a')
+        buf.append('feed', 'b1', key='b')
+        self.assertEqual(buf.read('feed'), [(4, 3), (5, 4), (6, 'b1')])
+        # The kind still holds up to its maxlen once the keys are cut to theirs
+        for key in 'cdef':
+            for i in range(2):
+                buf.append('feed', i, key=key)
+        self.assertEqual(len(buf.read('feed')), 10)
+
+    def test_longest_dropped(self):
+        """Always from a key with the most items, also after keys are taken"""
+        buf = SeqBuffer({'feed': 6})
+        for key, count in (('a', 3), ('b', 2), ('c', 1)):
+            for i in range(count):
+                buf.append('feed', i, key=key)
+        buf.append('feed', 'c2', key='c')
+        self.assertEqual([item for _, item in buf.read('feed', key='a')], [1, 2])
+        self.assertEqual(buf.take('feed', key='a'), [(2, 1), (3, 2)])
+        for i in range(3):
+            buf.append('feed', 'd%d' % i, key='d')
+        # b: 2, c: 2, d: 3 > 6 so one of d (the longest) goes
+        self.assertEqual([item for _, item in buf.read('feed', key='d')], ['d1', 'd2'])
+        self.assertEqual(len(buf.read('feed', key='b')) + len(buf.read('feed', key='c')), 4)
+
+    def test_random(self):
+        """Appends to random keys (with takes between) only ever drop the oldest item of a longest key"""
+        rnd = Random(25)
+        buf = SeqBuffer({'feed': 12}, {'feed': 5})
+        keys = 'abcdef'
+        for seq in range(1, 3000):
+            action = rnd.random()
+            if action < 0.05:
+                buf.take('feed', key=rnd.choice(keys))
+            elif action < 0.06:
+                buf.take('feed')
+            before = {key: buf.read('feed', key=key) for key in keys}
+            key = rnd.choice(keys)
+            buf.append('feed', seq, key=key)
+            after = {key: buf.read('feed', key=key) for key in keys}
+            before[key] = (before[key] + [(buf.seq, seq)])[-5:]
+            dropped = [key for key in keys if after[key] != before[key]]
+            if sum(len(items) for items in before.values()) > 12:
+                self.assertEqual(len(dropped), 1)
+                self.assertEqual(len(before[dropped[0]]), max(len(items) for items in before.values()))
+                self.assertEqual(after[dropped[0]], before[dropped[0]][1:])
+            else:
+                self.assertEqual(dropped, [])
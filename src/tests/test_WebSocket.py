@@ -0,0 +1,130 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/IoticHttp/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+from struct import pack
+from random import Random
+
+from qapiproxy.WebSocket import (accept_key, frame, FrameParser, WebSocket, ProtocolError, OP_CONTINUATION, OP_TEXT,
+                                 OP_BINARY, OP_CLOSE, OP_PING, OP_PONG, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG)
+
+
+def client_frame(opcode, payload=b'', fin=True, mask=b'\x37\xfa\x21\x3d', masked=True):
+    """Frame as a client sends it (masked)"""
+    first = (0x80 if fin else 0) | opcode
+    length = len(payload)
+    if length < 126:
+        head = pack('!BB', first, length | (0x80 if masked else 0))
+    elif length < 65536:
+        head = pack('!BBH', first, 126 | (0x80 if masked else 0), length)
+    else:
+        head = pack('!BBQ', first, 127 | (0x80 if masked else 0), length)
+    if not masked:
+        return head + payload
+    return head + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+class TestHandshake(TestCase):
+
+    def test_accept_key(self):
+        # RFC 6455 section 1.3
+        self.assertEqual(accept_key('dGhlIHNhbXBsZSBub25jZQ=='), 's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+
+class TestFrames(TestCase):
+
+    def test_frame(self):
+        self.assertEqual(frame(OP_TEXT, b'Hello'), b'\x81\x05Hello')
+        self.assertEqual(frame(OP_BINARY, bytes(200))[:4], b'\x82\x7e\x00\xc8')
+        self.assertEqual(frame(OP_BINARY, bytes(70000))[:10], b'\x82\x7f' + pack('!Q', 70000))
+        self.assertEqual(frame(OP_PONG), b'\x8a\x00')
+
+    def test_parse(self):
+        parser = FrameParser(1 << 20)
+        # RFC 6455 section 5.7 masked "Hello"
+        self.assertEqual(parser.feed(b'\x81\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58'), [(OP_TEXT, b'Hello')])
+        rnd = Random(6455)
+        for length in (0, 125, 126, 65535, 65536):
+            payload = bytes(rnd.getrandbits(8) for _ in range(length))
+            self.assertEqual(parser.feed(client_frame(OP_BINARY, payload)), [(OP_BINARY, payload)])
+
+    def test_incremental(self):
+        parser = FrameParser(1 << 20)
+        data = client_frame(OP_TEXT, b'first') + client_frame(OP_PING, b'p') + client_frame(OP_BINARY, bytes(300))
+        got = []
+        for i in range(len(data)):
+            got.extend(parser.feed(data[i:i + 1]))
+        self.assertEqual(got, [(OP_TEXT, b'first'), (OP_PING, b'p'), (OP_BINARY, bytes(300))])
+
+    def test_fragments(self):
+        parser = FrameParser(10)
+        data = (client_frame(OP_TEXT, b'abc', fin=False) + client_frame(OP_PING, b'p') +
+                client_frame(OP_CONTINUATION, b'def', fin=False) + client_frame(OP_CONTINUATION, b'g'))
+        # Control frames may come between fragments
+        self.assertEqual(parser.feed(data), [(OP_PING, b'p'), (OP_TEXT, b'abcdefg')])
+        with self.assertRaises(ProtocolError) as ctx:
+            parser.feed(client_frame(OP_TEXT, b'123456', fin=False) + client_frame(OP_CONTINUATION, b'78901'))
+        self.assertEqual(ctx.exception.code, CLOSE_TOO_BIG)
+
+    def test_errors(self):
+        for data in (client_frame(OP_TEXT, b'x', masked=False),
+                     b'\xc1\x80' + bytes(4),    # reserved bit
+                     client_frame(OP_CONTINUATION, b'x'),
+                     client_frame(OP_TEXT, b'x', fin=False) + client_frame(OP_TEXT, b'y'),
+                     client_frame(OP_PING, b'p', fin=False),
+                     client_frame(OP_PING, bytes(126)),
+                     client_frame(0x3, b'x')):
+            with self.subTest(data=data[:2]):
+                with self.assertRaises(ProtocolError) as ctx:
+                    FrameParser(1 << 20).feed(data)
+                self.assertEqual(ctx.exception.code, CLOSE_PROTOCOL_ERROR)
+        with self.assertRaises(ProtocolError) as ctx:
+            FrameParser(100).feed(client_frame(OP_BINARY, bytes(101)))
+        self.assertEqual(ctx.exception.code, CLOSE_TOO_BIG)
+
+
+class TestWebSocket(TestCase):
+
+    def setUp(self):
+        self.messages = []
+        self.written = []
+        self.ws = WebSocket(lambda ws, opcode, payload: self.messages.append((opcode, payload)), 1 << 20)
+        self.ws.write = self.written.append
+
+    def test_messages(self):
+        self.assertTrue(self.ws.receive(client_frame(OP_TEXT, b'{}') + client_frame(OP_PING, b'p') +
+                                        client_frame(OP_PONG) + client_frame(OP_BINARY, b'\x00')))
+        self.assertEqual(self.messages, [(OP_TEXT, b'{}'), (OP_BINARY, b'\x00')])
+        self.assertEqual(self.written, [frame(OP_PONG, b'p')])
+
+    def test_close(self):
+        self.assertFalse(self.ws.receive(client_frame(OP_CLOSE, pack('!H', 1000)) + client_frame(OP_TEXT, b'late')))
+        self.assertEqual(self.messages, [])
+        self.assertEqual(self.written, [frame(OP_CLOSE, pack('!H', 1000))])
+        # Nothing is sent after the close frame
+        self.ws.send(OP_TEXT, b'x')
+        self.ws.close()
+        self.assertEqual(len(self.written), 1)
+
+    def test_protocol_error(self):
+        self.assertFalse(self.ws.receive(client_frame(OP_TEXT, b'x', masked=False)))
+        self.assertTrue(self.ws.closed)
+        self.assertEqual(self.written, [frame(OP_CLOSE, pack('!H', CLOSE_PROTOCOL_ERROR))])
+
+    def test_write_error(self):
+        def write(data):
+            raise BrokenPipeError()
+        self.ws.write = write
+        self.ws.send(OP_TEXT, b'x')
+        self.assertTrue(self.ws.closed)